@@ -0,0 +1,28 @@
+"""Redis connections counting the round trips made through them."""
+import redis
+try:
+    from fakeredis import FakeRedisConnection as FakeConnection
+except ImportError:
+    # older fakeredis versions, the ones supporting Python 3.8
+    from fakeredis import FakeConnection
+
+
+class RoundTripCounter:
+    """Count the requests sent to Redis.
+
+    A pipeline is sent as a single request, so this is the number of
+    round trips.
+    """
+    round_trips = 0
+
+    def send_packed_command(self, *args, **kwargs):
+        RoundTripCounter.round_trips += 1
+        return super().send_packed_command(*args, **kwargs)
+
+
+class CountingConnection(RoundTripCounter, redis.Connection):
+    pass
+
+
+class CountingFakeConnection(RoundTripCounter, FakeConnection):
+    pass
@@ -0,0 +1,234 @@
+"""Measure how the event views scale with the number of events and
+attendees.
+
+Seeds a throwaway database with N events, each attended by M users, and
+requests the event list, joining an event and creating an event a number
+of times, both with the Redis cache and while it cannot be trusted. The
+latency percentiles, database queries and Redis round trips of each view
+are written as JSON, so results of different releases can be compared.
+
+    python -m benchmarks.run --events 1000 --attendees 100 --output out.json
+
+By default it uses an in-memory SQLite database and a fake Redis, so it
+runs anywhere the dev dependencies are installed. With --redis local it
+uses the Redis of the settings, whose event cache is overwritten.
+"""
+import argparse
+import os
+import platform
+import statistics
+import sys
+import time
+from json import dumps
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the views of the events app'
+    )
+    parser.add_argument('--events', type=int, default=1000,
+                        help='Number of events to seed')
+    parser.add_argument('--attendees', type=int, default=10,
+                        help='Number of attendees of each event')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Measured requests per view and mode')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='Requests per view and mode not measured')
+    parser.add_argument('--database', choices=['sqlite', 'postgres'],
+                        default='sqlite',
+                        help='sqlite in memory, or a test database '
+                        'created in the Postgres of the settings')
+    parser.add_argument('--redis', choices=['fake', 'local'],
+                        default='fake',
+                        help='fakeredis in the process, or the Redis of '
+                        'the settings')
+    parser.add_argument('--output', help='File to write the JSON to, '
+                        'stdout by default')
+    return parser.parse_args(argv)
+
+
+def _summary(latencies, queries, round_trips):
+    """Statistics of the measured requests of a view"""
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentiles[49] * 1000, 3),
+        'p99_ms': round(percentiles[98] * 1000, 3),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'queries': statistics.mean(queries),
+        'max_queries': max(queries),
+        'redis_round_trips': statistics.mean(round_trips),
+        'max_redis_round_trips': max(round_trips),
+    }
+
+
+class Benchmark:
+    def __init__(self, options):
+        self.options = options
+        self.users = []
+        self.event_pks = []
+        self.clients = []
+
+    def seed(self):
+        """Create the users, events and attendance with bulk inserts"""
+        from django.contrib.auth.models import User
+        from django.utils import timezone
+        from events_users.models import Event
+        from datetime import timedelta
+        # one more user than attendees, who has not joined any event
+        User.objects.bulk_create([
+            User(username='user{}'.format(i),
+                 email='user{}@example.com'.format(i))
+            for i in range(self.options.attendees + 1)
+        ])
+        self.users = list(User.objects.order_by('pk'))
+        now = timezone.now()
+        Event.objects.bulk_create([
+            Event(
+                title='event {}'.format(i), description='description',
+                date=now + timedelta(hours=i), creator=self.users[0]
+            )
+            for i in range(self.options.events)
+        ], batch_size=500)
+        Attendance = Event.users.through
+        pks = list(Event.objects.values_list('pk', flat=True))
+        batch = []
+        for pk in pks:
+            for user in self.users[1:]:
+                batch.append(Attendance(event_id=pk, user_id=user.id))
+            if len(batch) >= 5000:
+                Attendance.objects.bulk_create(batch)
+                batch = []
+        Attendance.objects.bulk_create(batch)
+        self.event_pks = pks
+
+    def log_in(self):
+        """Log in a client as each of the first users, so pages are
+        requested by different users like in production.
+        """
+        from django.test import Client
+        for user in self.users[:10] + self.users[-1:]:
+            client = Client()
+            client.force_login(user)
+            self.clients.append(client)
+
+    def _client(self, i):
+        return self.clients[i % (len(self.clients) - 1)]
+
+    def _measure(self, request):
+        """Run a request a number of times, measuring each of them.
+
+        :param request: function getting the number of the request and
+        doing it.
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from benchmarks.connections import RoundTripCounter
+        for i in range(self.options.warmup):
+            request(i)
+        latencies, queries, round_trips = [], [], []
+        for i in range(self.options.warmup,
+                       self.options.warmup + self.options.requests):
+            before = RoundTripCounter.round_trips
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                request(i)
+                latencies.append(time.perf_counter() - start)
+            queries.append(len(captured))
+            round_trips.append(RoundTripCounter.round_trips - before)
+        return _summary(latencies, queries, round_trips)
+
+    def _check(self, response, status):
+        if response.status_code != status:
+            raise RuntimeError('Unexpected {} response'.format(
+                response.status_code
+            ))
+
+    def all_events(self, i):
+        self._check(self._client(i).get('/events/all'), 200)
+
+    def join_event(self, i):
+        # the last user attends no event, so every join adds a row
+        pk = self.event_pks[i % len(self.event_pks)]
+        response = self.clients[-1].post('/events/{}/join'.format(pk))
+        self._check(response, 302)
+
+    def create_event(self, i):
+        response = self._client(0).post('/events/', {
+            'title': 'new event {}'.format(i),
+            'description': 'description',
+            'date': '2030-01-01 10:00',
+        })
+        self._check(response, 302)
+
+    def run(self):
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+        from events_users import cache, event_cache
+        from events_users.models import Event
+        from io import StringIO
+        client = cache.get_client()
+        client.flushall()
+        results = {}
+        views = ('all_events', 'join_event', 'create_event')
+        call_command('rebuild_event_cache', stdout=StringIO())
+        results['cache'] = {
+            view: self._measure(getattr(self, view)) for view in views
+        }
+        # every read goes to the database while the cache is not trusted
+        client.delete(event_cache.GENERATION_KEY)
+        Event.users.through.objects.filter(
+            user_id=self.users[-1].id
+        ).delete()
+        with override_settings(EVENTS_FALLBACK_FRESH_FOR=0,
+                               EVENTS_FALLBACK_STALE_FOR=0):
+            results['no_cache'] = {
+                view: self._measure(getattr(self, view)) for view in views
+            }
+        return results
+
+
+def main(argv=None):
+    options = _parse_args(argv)
+    os.environ['BENCHMARK_DATABASE'] = options.database
+    os.environ['BENCHMARK_REDIS'] = options.redis
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.utils import (
+        setup_databases, setup_test_environment, teardown_databases,
+        teardown_test_environment
+    )
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        benchmark = Benchmark(options)
+        benchmark.seed()
+        benchmark.log_in()
+        results = benchmark.run()
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        teardown_test_environment()
+    output = dumps({
+        'config': {
+            'events': options.events,
+            'attendees': options.attendees,
+            'requests': options.requests,
+            'warmup': options.warmup,
+            'database': connection.vendor,
+            'redis': options.redis,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+        },
+        'results': results,
+    }, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+Django settings for running the benchmarks locally.
+
+The database is an in-memory SQLite one unless BENCHMARK_DATABASE is
+postgres, and Redis is faked in the process unless BENCHMARK_REDIS is
+local. Both are set by benchmarks/run.py from its command line.
+"""
+import os
+
+from events.settings import *  # noqa: F401,F403
+
+if os.environ.get('BENCHMARK_DATABASE', 'sqlite') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+    }
+
+if os.environ.get('BENCHMARK_REDIS', 'fake') == 'fake':
+    REDIS_CONNECTION_CLASS = 'benchmarks.connections.CountingFakeConnection'
+else:
+    REDIS_CONNECTION_CLASS = 'benchmarks.connections.CountingConnection'
+
+# users are logged in without their password
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+# the benchmarks make hundreds of writes as a single user, which must
+# measure the views rather than their rate limits
+EVENTS_RATE_LIMITS = {}
+EVENTS_SHED_DB_LATENCY = float('inf')
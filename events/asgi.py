@@ -2,6 +2,8 @@
 ASGI config for events project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+It uses the ASGI settings profile, which serves the hottest views as
+coroutines.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -11,6 +13,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'events.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'events.settings_asgi')
 
 application = get_asgi_application()
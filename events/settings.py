@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'events_users.metrics.metrics_middleware',
+    'events_users.db_router.replica_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,9 +85,25 @@ DATABASES = {
         'PASSWORD': 'sherpany',
         'HOST': 'db',
         'PORT': 5432,
-    }
+    },
+    # stand-in for a read replica, only used by the tests of the routing
+    # of reads to EVENTS_READ_REPLICAS
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+    },
 }
 
+# Send the reads of events made by GET requests to the read replicas
+# below, and everything else to the default database
+DATABASE_ROUTERS = ['events_users.db_router.ReplicaRouter']
+# Aliases of DATABASES replicating the default one, e.g. a 'replica'
+# entry pointing to a Postgres standby. Reads are spread over them
+EVENTS_READ_REPLICAS = []
+# Seconds a client reads events from the default database after
+# changing one, so it sees its own writes while the replicas lag behind
+EVENTS_REPLICA_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -115,8 +133,6 @@ TIME_ZONE = 'UTC'
 
 USE_I18N = True
 
-USE_L10N = True
-
 USE_TZ = True
 
 
@@ -124,5 +140,115 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 LOGIN_REDIRECT_URL = 'home'
 CRISPY_TEMPLATE_PACK = "bootstrap4"
+
+# Redis instance used to cache the events. All the connections of a
+# process are taken from a single pool.
+REDIS_HOST = 'cache'
+REDIS_PORT = 6379
+REDIS_DB = 1
+REDIS_MAX_CONNECTIONS = 50
+# classes of the connections of the regular and asyncio pools, which
+# count round trips for the metrics
+REDIS_CONNECTION_CLASS = 'events_users.metrics.InstrumentedConnection'
+REDIS_ASYNC_CONNECTION_CLASS = \
+    'events_users.metrics.InstrumentedAsyncConnection'
+# seconds before giving up on a Redis connection or command
+REDIS_SOCKET_TIMEOUT = 0.5
+# consecutive Redis failures after which it is skipped for a while
+REDIS_BREAKER_FAILURE_THRESHOLD = 5
+# seconds Redis is skipped for before trying it again
+REDIS_BREAKER_COOLDOWN = 30
+
+# Number of events shown per page in the event list
+EVENTS_PAGE_SIZE = 50
+# Number of events read from Postgres and written to Redis at once
+# when rebuilding the cache
+EVENTS_CACHE_REBUILD_BATCH_SIZE = 500
+# When the cache cannot be used, a page of events is computed from
+# Postgres by a single request at a time. It is reused for FRESH_FOR
+# seconds, and served for STALE_FOR seconds more while it is computed
+# again. Other requests wait up to WAIT seconds for it to be computed,
+# and are answered 503 after that. The request computing it keeps the
+# others from doing so for LOCK_TTL seconds at most, in case it died.
+EVENTS_FALLBACK_FRESH_FOR = 2
+EVENTS_FALLBACK_STALE_FOR = 30
+EVENTS_FALLBACK_WAIT = 1
+EVENTS_FALLBACK_LOCK_TTL = 30
+# Number of decoded pages of events each process keeps in memory, and
+# for how many seconds at most. They are only used while no event
+# changes in Redis.
+EVENTS_LOCAL_CACHE_SIZE = 256
+EVENTS_LOCAL_CACHE_TTL = 60
+# Number of events whose rendered markup each process keeps in memory
+# for the event list
+EVENTS_FRAGMENT_CACHE_SIZE = 10000
+# Hours after their date events are archived by archive_events, which
+# moves them out of the event cache
+EVENTS_ARCHIVE_AFTER_HOURS = 24
+# Seconds pages of past events are kept in the cold cache
+EVENTS_ARCHIVE_CACHE_TTL = 300
+# Serve the event list, join and withdraw views as coroutines. Enabled
+# by the ASGI profile in events/settings_asgi.py
+EVENTS_ASYNC_VIEWS = False
+# Streams of the changes of events served by the ASGI profile: seconds
+# between keepalive comments, seconds after which a stream is closed for
+# the browser to reconnect, and changes queued for a slow browser before
+# its stream is closed
+EVENTS_STREAM_KEEPALIVE = 15
+EVENTS_STREAM_MAX_AGE = 300
+EVENTS_STREAM_QUEUE_SIZE = 100
+# Number of events written to Postgres and Redis at once by bulk
+# imports and bulk attendance changes
+EVENTS_BULK_BATCH_SIZE = 500
+# Number of events read from Redis or Postgres at once by the streamed
+# export of all the events
+EVENTS_EXPORT_BATCH_SIZE = 500
+# Maximum number of events a single bulk attendance request can change
+EVENTS_BULK_MAX_EVENTS = 1000
+# Record joins and withdrawals in Redis only, and save them in Postgres
+# later on in batches with flush_attendance
+EVENTS_WRITE_BEHIND_ATTENDANCE = False
+# Number of attendance changes flush_attendance saves at once
+EVENTS_ATTENDANCE_FLUSH_BATCH_SIZE = 1000
+# Seconds pages of search results are kept in Redis
+EVENTS_SEARCH_CACHE_TTL = 30
+# Longest search query accepted, and deepest page of results served
+EVENTS_SEARCH_MAX_QUERY_LENGTH = 200
+EVENTS_SEARCH_MAX_PAGES = 20
+# Seconds pages of the events each user attends or created are kept in
+# Redis at most. They are dropped as soon as the user joins or withdraws
+# from an event or one of their events is edited, but attendee counts
+# may lag behind for this long
+EVENTS_USER_LISTS_CACHE_TTL = 60
+# Seconds sessions are kept in Redis at most by the Redis session engine
+# of the production profile, before being read from Postgres again. A
+# session logged out while Redis could not be reached may still be
+# accepted by other processes for this long
+EVENTS_SESSION_CACHE_TTL = 60
+# Seconds the users of authenticated requests are kept in Redis by the
+# cached authentication backend of the production profile. Changes to a
+# user which could not reach Redis may take this long to be seen
+EVENTS_USER_CACHE_TTL = 30
+# Requests each user, or IP address for anonymous requests, can make to
+# the views writing to Postgres, as (requests, seconds). Short bursts of
+# up to that many requests are allowed. Views left out are not limited.
+# Bulk attendance requests change up to EVENTS_BULK_MAX_EVENTS events
+EVENTS_RATE_LIMITS = {
+    'join_event': (30, 60),
+    'withdraw_event': (30, 60),
+    'bulk_attendance': (5, 60),
+    'create_event': (10, 60),
+    'sign_up': (5, 300),
+}
+# Seconds the queries of a process to Postgres take on average, over the
+# last EVENTS_SHED_WINDOW seconds, above which the rate limited views
+# answer 503 for clients to retry after EVENTS_SHED_RETRY_AFTER seconds
+EVENTS_SHED_DB_LATENCY = 0.5
+EVENTS_SHED_WINDOW = 10
+EVENTS_SHED_RETRY_AFTER = 5
+# Record metrics of the hot paths and expose them on /metrics in the
+# Prometheus text format. Nothing is recorded while it is disabled.
+METRICS_ENABLED = False
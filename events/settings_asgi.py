@@ -0,0 +1,11 @@
+"""
+Django settings for serving the events project with an ASGI server.
+
+The event list, join and withdraw views are served as coroutines which
+use an asyncio Redis client, so a single process can handle many
+concurrent requests.
+"""
+
+from events.settings import *  # noqa: F401,F403
+
+EVENTS_ASYNC_VIEWS = True
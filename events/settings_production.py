@@ -0,0 +1,13 @@
+"""
+Django settings for running the events project in production.
+
+Sessions are read from Redis and the users of authenticated requests are
+cached in it for a few seconds, so requests do not query the session and
+user tables before doing their own work. Both fall back to Postgres
+while Redis cannot be used.
+"""
+
+from events.settings import *  # noqa: F401,F403
+
+SESSION_ENGINE = 'events_users.sessions'
+AUTHENTICATION_BACKENDS = ['events_users.user_cache.CachedModelBackend']
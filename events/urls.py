@@ -15,12 +15,14 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from events_users.views import sign_up, all_events
+from events_users.views import prometheus_metrics, sign_up
+from events_users.urls import event_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('events/', include('events_users.urls')),
     path("accounts/", include('django.contrib.auth.urls')),
     path('accounts/sign_up/', sign_up, name='sign_up'),
-    path('', all_events),
+    path('', event_views.all_events),
+    path('metrics', prometheus_metrics, name='metrics'),
 ]
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class EventsUsersConfig(AppConfig):
     name = 'events_users'
+
+    def ready(self):
+        # count the queries of every database connection for the metrics
+        from events_users import metrics  # noqa: F401
+        # drop the cached users when they change
+        from events_users import user_cache  # noqa: F401
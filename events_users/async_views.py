@@ -0,0 +1,221 @@
+"""Coroutine versions of the hottest views, served by the ASGI profile.
+
+They talk to Redis with the asyncio client, and only use a thread for
+the ORM, so a single process can handle many concurrent requests while
+they wait on Redis.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import redirect
+from events_users.models import Event
+from events_users import (
+    broadcast, cache, db_router, event_cache, metrics, ratelimit, seats,
+    views
+)
+from functools import wraps
+import asyncio
+import logging
+import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+def _login_required(view):
+    """Same as login_required, for coroutine views.
+
+    The user is loaded in a thread as the ORM cannot be used from the
+    event loop.
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        request.user = await sync_to_async(get_user)(request)
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def _get_events_from_db(after, limit, user_id, use_redis, start, end):
+    """Postgres fallback of the event list, run in a thread.
+
+    :param use_redis: whether Redis works and can coordinate the
+    requests querying Postgres.
+    """
+    client = None
+    if use_redis:
+        try:
+            client = views._get_redis_client()
+        except Exception:
+            pass
+    return views._get_shared_events_page_from_db(
+        client, after, limit, user_id, start, end
+    )
+
+
+async def _get_all_events(user_id, after, limit, window):
+    """Same as views._get_all_events, with the asyncio Redis client"""
+    if window == 'past':
+        with metrics.stage_duration.time(stage='past'):
+            return await sync_to_async(views._get_past_events)(
+                user_id, after, limit
+            )
+    start, end = views._window_bounds(window)
+    try:
+        with cache.tracked(), metrics.stage_duration.time(stage='redis'):
+            client = cache.get_async_client()
+            await event_cache.aapply_pending_invalidation(client)
+            page = await event_cache.aget_page(
+                client, after, limit, user_id, start, end
+            )
+        metrics.cache_lookups.inc(result='hit')
+        return page
+    except event_cache.StaleCache:
+        metrics.cache_lookups.inc(result='miss')
+        use_redis = True
+    except Exception:
+        metrics.cache_lookups.inc(result='error')
+        use_redis = False
+    with metrics.stage_duration.time(stage='db_fallback'):
+        return await sync_to_async(_get_events_from_db)(
+            after, limit, user_id, use_redis, start, end
+        )
+
+
+@_login_required
+@views._unavailable_while_busy
+async def all_events(request):
+    """Render a page of events."""
+    after = event_cache.decode_cursor(request.GET.get('after'))
+    window = views._get_window(request)
+    with metrics.stage_duration.time(stage='get_all_events'):
+        events_as_dict, next_cursor = await _get_all_events(
+            request.user.id, after, settings.EVENTS_PAGE_SIZE, window
+        )
+    context = {
+        "events": events_as_dict,
+        "user": request.user,
+        "next_cursor": next_cursor,
+        "window": window,
+    }
+    with metrics.stage_duration.time(stage='render'):
+        return views._render_event_list(request, context)
+
+
+async def _get_event_or_404(event_id):
+    try:
+        return await Event.objects.aget(pk=event_id, is_archived=False)
+    except Event.DoesNotExist:
+        raise Http404('No Event matches the given query.')
+
+
+async def _update_attendance(obj, user, update):
+    """Same as views._update_attendance, with the asyncio Redis client"""
+    try:
+        with cache.tracked():
+            client = cache.get_async_client()
+            await event_cache.aapply_pending_invalidation(client)
+            await update(client, obj.pk, user.id)
+    except (cache.CacheUnavailable, redis.RedisError):
+        logger.warning('Could not cache attendees of event %s', obj.pk)
+        event_cache.invalidate_later()
+
+
+async def _record_attendance(event_id, user, join):
+    """Same as views._record_attendance, with the asyncio Redis client"""
+    if not settings.EVENTS_WRITE_BEHIND_ATTENDANCE:
+        return False
+    update = event_cache.areserve_seat if join \
+        else event_cache.arelease_seat
+    try:
+        with cache.tracked():
+            client = cache.get_async_client()
+            await event_cache.aapply_pending_invalidation(client)
+            return await update(
+                client, event_id, user.id, write_behind=True
+            ) is not None
+    except (event_cache.StaleCache, cache.CacheUnavailable,
+            redis.RedisError):
+        return False
+
+
+@_login_required
+@db_router.use_primary
+@ratelimit.rate_limit('join_event')
+async def join_event(request, event_id):
+    """Add the logged user to a particular event"""
+    if await _record_attendance(event_id, request.user, join=True):
+        return redirect('home')
+    obj = await _get_event_or_404(event_id)
+    if obj.capacity is not None:
+        await sync_to_async(seats.join)(obj.pk, request.user.id)
+        return redirect('home')
+    await obj.users.aadd(request.user)
+    await _update_attendance(obj, request.user, event_cache.aadd_attendee)
+    return redirect('home')
+
+
+@_login_required
+@db_router.use_primary
+@ratelimit.rate_limit('withdraw_event')
+async def withdraw_event(request, event_id):
+    """Withdraw the logged user from a particular event"""
+    if await _record_attendance(event_id, request.user, join=False):
+        return redirect('home')
+    obj = await _get_event_or_404(event_id)
+    if obj.capacity is not None:
+        await sync_to_async(seats.withdraw)(obj.pk, request.user.id)
+        return redirect('home')
+    await obj.users.aremove(request.user)
+    await _update_attendance(
+        obj, request.user, event_cache.aremove_attendee
+    )
+    return redirect('home')
+
+
+# milliseconds browsers wait before reconnecting to a closed stream
+STREAM_RETRY = 3000
+
+
+async def _stream_changes():
+    queue = broadcast.subscribe()
+    loop = asyncio.get_running_loop()
+    # streams are closed after a while, as a browser which went away is
+    # only noticed when its stream ends
+    deadline = loop.time() + settings.EVENTS_STREAM_MAX_AGE
+    try:
+        yield 'retry: {}\n\n'.format(STREAM_RETRY)
+        while loop.time() < deadline:
+            try:
+                message = await asyncio.wait_for(
+                    queue.get(), settings.EVENTS_STREAM_KEEPALIVE
+                )
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if message is None:
+                return
+            yield 'data: {}\n\n'.format(message)
+    finally:
+        broadcast.unsubscribe(queue)
+
+
+@_login_required
+async def event_stream(request):
+    """Stream the changes of events as server-sent events, so browsers
+    can patch the event list instead of reloading it.
+
+    Each message is a JSON object with the id of the event and its type,
+    event for events which were created or edited, along with their
+    fields, or attendance along with the number of attendees.
+    """
+    response = StreamingHttpResponse(
+        _stream_changes(), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # proxies must not buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,102 @@
+"""Fan-out of the changes of events to the streams of the ASGI profile.
+
+Each event loop has a single Redis connection subscribed to the changes
+channel, whose messages are copied to a queue per open stream, so the
+number of browsers following the changes does not add connections to
+Redis. Streams which fall too far behind are closed, as are all of them
+when Redis fails, and browsers reconnect to them on their own.
+"""
+from django.conf import settings
+from events_users import cache, event_cache
+import asyncio
+import logging
+import weakref
+import redis
+
+
+logger = logging.getLogger(__name__)
+# seconds the listener waits for a message before checking it is needed
+_POLL_TIMEOUT = 1.0
+
+
+class _Broadcaster:
+    def __init__(self):
+        self._queues = set()
+        self._task = None
+
+    def subscribe(self):
+        """Queue getting the messages published from now on, None once
+        the stream has to be closed.
+        """
+        queue = asyncio.Queue(settings.EVENTS_STREAM_QUEUE_SIZE)
+        self._queues.add(queue)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._listen())
+        return queue
+
+    def unsubscribe(self, queue):
+        self._queues.discard(queue)
+
+    def _close(self, queue):
+        self._queues.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def _send(self, message):
+        for queue in list(self._queues):
+            if queue.full():
+                logger.warning('Closing a stream which fell behind')
+                self._close(queue)
+            else:
+                queue.put_nowait(message)
+
+    async def _listen(self):
+        """Copy the messages of the channel to the queues while there
+        are streams open.
+        """
+        pubsub = None
+        try:
+            with cache.tracked():
+                pubsub = cache.get_async_client().pubsub()
+                await pubsub.subscribe(event_cache.CHANGES_CHANNEL)
+            while self._queues:
+                with cache.tracked():
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True,
+                        timeout=_POLL_TIMEOUT
+                    )
+                if message is not None:
+                    self._send(message['data'].decode())
+        except (cache.CacheUnavailable, redis.RedisError):
+            logger.warning('Could not listen to the changes of events')
+            for queue in list(self._queues):
+                self._close(queue)
+        finally:
+            # no await before this, so streams opened from now on start
+            # a new listener
+            self._task = None
+            if pubsub is not None:
+                await pubsub.reset()
+
+
+_broadcasters = weakref.WeakKeyDictionary()
+
+
+def subscribe():
+    """Follow the changes of events from the running event loop.
+
+    :return: asyncio queue getting each change as a JSON string, and
+    None when the stream has to be closed.
+    """
+    loop = asyncio.get_running_loop()
+    broadcaster = _broadcasters.get(loop)
+    if broadcaster is None:
+        broadcaster = _broadcasters[loop] = _Broadcaster()
+    return broadcaster.subscribe()
+
+
+def unsubscribe(queue):
+    broadcaster = _broadcasters.get(asyncio.get_running_loop())
+    if broadcaster is not None:
+        broadcaster.unsubscribe(queue)
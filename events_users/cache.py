@@ -0,0 +1,221 @@
+"""Shared Redis client for the event cache.
+
+All the processes' Redis traffic goes through a single connection pool,
+or one per event loop for the asyncio client.
+A circuit breaker keeps track of failures so that, when the cache server
+is down, requests go straight to Postgres instead of waiting for their
+own connection timeout.
+"""
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.module_loading import import_string
+import asyncio
+import logging
+import threading
+import time
+import weakref
+import redis
+import redis.asyncio
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheUnavailable(Exception):
+    """Raised when the circuit breaker does not let calls reach Redis"""
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, cooldown, clock=time.monotonic):
+        """Create a closed circuit breaker.
+
+        :param failure_threshold: consecutive failures needed to open it.
+        :param cooldown: seconds to wait before letting a call through
+        again once it is open.
+        :param clock: function returning the current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_at = None
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """Tell whether a call to Redis may be attempted.
+
+        Once the cooldown is over a single trial call is let through,
+        and its result decides whether the breaker closes again. A trial
+        whose result is not recorded within another cooldown is given
+        up, and a new one is let through.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            now = self._clock()
+            started = self._opened_at if self._state == self.OPEN \
+                else self._trial_at
+            if now - started >= self.cooldown:
+                self._state = self.HALF_OPEN
+                self._trial_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.warning('Redis is reachable again, closing circuit')
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(
+                        'Redis failed %s times, opening circuit for %ss',
+                        self._failures, self.cooldown
+                    )
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+    def status(self):
+        """Dictionary describing the breaker, suitable for monitoring"""
+        with self._lock:
+            retry_in = None
+            if self._state == self.OPEN:
+                elapsed = self._clock() - self._opened_at
+                retry_in = max(0.0, self.cooldown - elapsed)
+            return {
+                'state': self._state,
+                'failures': self._failures,
+                'retry_in': retry_in,
+            }
+
+
+breaker = CircuitBreaker(
+    settings.REDIS_BREAKER_FAILURE_THRESHOLD, settings.REDIS_BREAKER_COOLDOWN
+)
+_pool = None
+_pool_lock = threading.Lock()
+# asyncio connections can only be used in the loop they were made in
+_async_pools = weakref.WeakKeyDictionary()
+
+
+def _pool_options():
+    return {
+        'host': settings.REDIS_HOST,
+        'port': settings.REDIS_PORT,
+        'db': settings.REDIS_DB,
+        'max_connections': settings.REDIS_MAX_CONNECTIONS,
+        'socket_timeout': settings.REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': settings.REDIS_SOCKET_TIMEOUT,
+    }
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = redis.ConnectionPool(
+                    connection_class=import_string(
+                        settings.REDIS_CONNECTION_CLASS
+                    ),
+                    **_pool_options()
+                )
+    return _pool
+
+
+def get_client():
+    """Return a Redis client backed by the process-wide pool.
+
+    :raises CacheUnavailable: if the circuit breaker is open.
+    """
+    if not breaker.allow():
+        raise CacheUnavailable('Redis circuit breaker is open')
+    return redis.Redis(connection_pool=_get_pool())
+
+
+def get_async_client():
+    """Return an asyncio Redis client backed by the pool of the loop.
+
+    :raises CacheUnavailable: if the circuit breaker is open.
+    """
+    if not breaker.allow():
+        raise CacheUnavailable('Redis circuit breaker is open')
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+    if pool is None:
+        pool = redis.asyncio.ConnectionPool(
+            connection_class=import_string(
+                settings.REDIS_ASYNC_CONNECTION_CLASS
+            ),
+            **_pool_options()
+        )
+        _async_pools[loop] = pool
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+# deletes a lock, or sets its TTL, only if it still holds the token of
+# its owner, as it may have expired and been taken by someone else
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def release_lock(client, key, token):
+    """Delete a lock set to a token, unless someone else holds it"""
+    client.eval(_RELEASE_LOCK_SCRIPT, 1, key, token)
+
+
+def renew_lock(client, key, token, ttl):
+    """Keep a lock set to a token for ttl more seconds.
+
+    :return: whether the lock is still held.
+    """
+    return bool(client.eval(_RENEW_LOCK_SCRIPT, 1, key, token, ttl))
+
+
+@contextmanager
+def tracked():
+    """Report the outcome of the Redis calls in the block to the breaker.
+
+    Only Redis errors count as failures, anything else raised in the
+    block means Redis itself answered.
+    """
+    reached = True
+    try:
+        yield
+    except CacheUnavailable:
+        reached = False
+        raise
+    except redis.RedisError:
+        reached = False
+        breaker.record_failure()
+        raise
+    finally:
+        if reached:
+            breaker.record_success()
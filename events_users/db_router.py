@@ -0,0 +1,149 @@
+"""Routing of the reads of events to read replicas.
+
+Reads of the models of this app made by GET and HEAD requests go to one
+of the EVENTS_READ_REPLICAS databases, picked at random, so the event
+list and its Postgres fallback do not load the primary. Everything else
+goes to the default database: writes, the reads of requests which may
+write, and the ones of management commands and any other code running
+outside requests, which must not read stale data.
+
+Clients which changed events keep reading from the primary for
+EVENTS_REPLICA_STICKY_SECONDS, so they see their own writes even if the
+replicas lag behind. It is remembered in a signed cookie.
+"""
+from asgiref.sync import iscoroutinefunction
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.decorators import sync_and_async_middleware
+from functools import wraps
+import random
+
+
+STICKY_COOKIE = 'events_primary'
+_STICKY_SALT = 'events_users.db_router'
+SAFE_METHODS = ('GET', 'HEAD')
+_DONE = object()
+
+
+class _State:
+    """Databases of a request, shared by all the threads it uses"""
+
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+_state = ContextVar('events_db_state', default=None)
+
+
+def _routed(model):
+    return model._meta.app_label == 'events_users'
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is not None and state.use_replica and _routed(model) \
+                and settings.EVENTS_READ_REPLICAS:
+            return random.choice(settings.EVENTS_READ_REPLICAS)
+        # not None, or objects read from a replica would be saved there
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and _routed(model):
+            # the rest of the request and the next ones see the write
+            state.use_replica = False
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+
+def use_primary(view):
+    """Make a view read from the primary, for the ones writing on GET
+    requests.
+    """
+    def _use_primary():
+        state = _state.get()
+        if state is not None:
+            state.use_replica = False
+
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            _use_primary()
+            return await view(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        _use_primary()
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def _start(request):
+    sticky = request.get_signed_cookie(
+        STICKY_COOKIE, default=None, salt=_STICKY_SALT,
+        max_age=settings.EVENTS_REPLICA_STICKY_SECONDS
+    )
+    return _State(request.method in SAFE_METHODS and sticky is None)
+
+
+def _iterate(state, content):
+    """Iterate over a streamed response with the databases of its
+    request.
+    """
+    content = iter(content)
+    while True:
+        token = _state.set(state)
+        try:
+            chunk = next(content, _DONE)
+        finally:
+            _state.reset(token)
+        if chunk is _DONE:
+            return
+        yield chunk
+
+
+def _finish(state, response):
+    if response.streaming and not getattr(response, 'is_async', False):
+        response.streaming_content = _iterate(
+            state, response.streaming_content
+        )
+    if state.wrote:
+        response.set_signed_cookie(
+            STICKY_COOKIE, '1', salt=_STICKY_SALT,
+            max_age=settings.EVENTS_REPLICA_STICKY_SECONDS,
+            httponly=True, samesite='Lax'
+        )
+    return response
+
+
+@sync_and_async_middleware
+def replica_middleware(get_response):
+    """Pick the databases of each request"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            state = _start(request)
+            token = _state.set(state)
+            try:
+                response = await get_response(request)
+            finally:
+                _state.reset(token)
+            return _finish(state, response)
+        return middleware
+
+    def middleware(request):
+        state = _start(request)
+        token = _state.set(state)
+        try:
+            response = get_response(request)
+        finally:
+            _state.reset(token)
+        return _finish(state, response)
+    return middleware
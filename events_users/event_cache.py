@@ -0,0 +1,1220 @@
+"""Redis structures holding the cached events.
+
+ - ``events`` hash: live events by pk, encoded with ``event_codec``.
+   Archived events are removed from all the structures.
+ - ``events:by_date`` sorted set: event pks scored by date, used as an
+   index to paginate the event list.
+ - ``event:<pk>:users`` sets: ids of the users attending each event, so
+   joining or withdrawing does not rewrite the whole event.
+ - ``user:<id>:events`` sets: ids of the events each user joined, the
+   reverse index of the attendee sets.
+ - ``events:capacity`` hash: capacity of the live events which have one.
+ - ``event:<pk>:waitlist`` sorted sets: ids of the users waiting for a
+   seat of each full event, scored by the time they joined it.
+ - ``user:<id>:waitlist`` sets: ids of the events each user is waiting
+   for, the reverse index of the waitlists.
+ - ``user:<id>:lists`` hashes: pages of the events each user attends or
+   created, computed from Postgres. They are dropped whenever those
+   events change, which also increases ``user:<id>:lists:version``.
+ - ``events:generation``: id of the rebuild which populated the cache.
+   Readers only trust the cache while it is set, so it is removed
+   whenever the cache may have missed a write.
+ - ``events:version``: counter increased by every write, so readers can
+   tell whether the pages they keep in memory are still valid.
+ - ``events:modified``: timestamp of the last write.
+ - ``events:invalidations``: counter increased whenever a write could
+   not reach the cache, so a rebuild running meanwhile is not published.
+ - ``events:rebuild:dirty`` set: pks of the events written while a
+   rebuild runs, which is flagged by ``events:rebuild:running``. They
+   are read again from Postgres before the rebuild is published.
+ - ``events:attendance`` stream: joins and withdrawals recorded in
+   write-behind mode which were not flushed to Postgres yet.
+ - ``events:attendance:joins`` hash: number of joins of each event pk
+   waiting in the stream, which Postgres does not know of yet.
+"""
+from datetime import datetime, timezone
+from django.conf import settings
+from events_users import cache, event_codec, metrics
+from events_users.local_cache import LocalCache
+from json import loads, dumps
+import math
+import threading
+import time
+import uuid
+
+
+EVENTS_KEY = 'events'
+EVENTS_BY_DATE_KEY = 'events:by_date'
+CAPACITY_KEY = 'events:capacity'
+GENERATION_KEY = 'events:generation'
+GENERATION_COUNTER_KEY = 'events:generation:counter'
+VERSION_KEY = 'events:version'
+MODIFIED_KEY = 'events:modified'
+INVALIDATIONS_KEY = 'events:invalidations'
+REBUILD_LOCK_KEY = 'events:rebuild:lock'
+REBUILD_RUNNING_KEY = 'events:rebuild:running'
+REBUILD_DIRTY_KEY = 'events:rebuild:dirty'
+# temporary keys are dropped if a rebuild dies before publishing them
+REBUILD_KEYS_TTL = 3600
+# times the events written during a rebuild are read again before it
+# gives up, as they keep changing
+REBUILD_PASSES = 10
+ATTENDANCE_STREAM_KEY = 'events:attendance'
+ATTENDANCE_JOINS_KEY = 'events:attendance:joins'
+ATTENDANCE_FLUSH_LOCK_KEY = 'events:attendance:lock'
+# a flusher which dies keeps the lock at most this many seconds
+ATTENDANCE_FLUSH_LOCK_TTL = 60
+# channel where events which are created, edited, joined or withdrawn
+# from are published, as JSON messages
+CHANGES_CHANNEL = 'events:changes'
+
+
+# results of reserving a seat
+JOINED = 'joined'
+WAITLISTED = 'waitlisted'
+
+
+class StaleCache(Exception):
+    """Raised when the cache is not complete or may be outdated"""
+
+
+class RebuildInterrupted(Exception):
+    """Raised when the cache missed a write while it was being rebuilt,
+    or events kept changing until it gave up.
+    """
+
+
+def event_score(date):
+    """Score used to keep events sorted by date in Redis"""
+    return date.timestamp()
+
+
+def score_date(score):
+    """Date of the events with the given score"""
+    return datetime.fromtimestamp(score, tz=timezone.utc)
+
+
+def index_member(pk):
+    """Member used for an event in the sorted set.
+
+    Zero padded so events sharing the same date are sorted by pk.
+    """
+    return '{:010d}'.format(int(pk))
+
+
+def encode_cursor(score, pk):
+    return '{!r}_{}'.format(score, pk)
+
+
+def decode_cursor(cursor):
+    """Turn a cursor from the query string into a (score, pk) tuple.
+
+    Returns None if the cursor is missing or malformed, which means
+    the first page will be served. Scores which are not the date of an
+    event, like nan or inf, are malformed as well, as Redis and Postgres
+    would reject them.
+    """
+    if not cursor:
+        return None
+    score, _, pk = cursor.partition('_')
+    try:
+        score, pk = float(score), int(pk)
+        if not math.isfinite(score):
+            return None
+        score_date(score)
+    except (ValueError, OverflowError, OSError):
+        return None
+    return score, pk
+
+
+def attendees_key(pk):
+    return 'event:{}:users'.format(pk)
+
+
+def user_events_key(user_id):
+    return 'user:{}:events'.format(user_id)
+
+
+def user_lists_key(user_id):
+    return 'user:{}:lists'.format(user_id)
+
+
+def user_lists_version_key(user_id):
+    return 'user:{}:lists:version'.format(user_id)
+
+
+def waitlist_key(pk):
+    return 'event:{}:waitlist'.format(pk)
+
+
+def user_waitlist_key(user_id):
+    return 'user:{}:waitlist'.format(user_id)
+
+
+class _RoundTrip:
+    """Commands sent to Redis in a single pipeline.
+
+    Calling a Redis command on it queues the command.
+    """
+
+    def __init__(self, transaction=False):
+        self.transaction = transaction
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return queue
+
+    def pipeline(self, client):
+        pipe = client.pipeline(transaction=self.transaction)
+        for name, args, kwargs in self.commands:
+            getattr(pipe, name)(*args, **kwargs)
+        return pipe
+
+
+def _run(client, steps):
+    """Run the round trips yielded by a generator with a Redis client.
+
+    The cache is read and written by generators which yield round trips
+    and get their results back, so the same code works both with the
+    regular and the asyncio Redis clients.
+    """
+    results = None
+    while True:
+        try:
+            trip = steps.send(results)
+        except StopIteration as stop:
+            return stop.value
+        results = trip.pipeline(client).execute()
+
+
+async def _arun(client, steps):
+    """Same as _run, with an asyncio Redis client"""
+    results = None
+    while True:
+        try:
+            trip = steps.send(results)
+        except StopIteration as stop:
+            return stop.value
+        results = await trip.pipeline(client).execute()
+
+
+def _queue_flags(trip, pks, user_id):
+    """Ask which of the events the user joined or is waiting for.
+
+    Only the events of the page are checked, so the cost does not grow
+    with the number of events the user ever joined.
+    """
+    trip.smismember(user_events_key(user_id), pks)
+    trip.smismember(user_waitlist_key(user_id), pks)
+
+
+def _flags(pks, joined, waitlisted):
+    """Sets of the pks flagged by the replies to _queue_flags"""
+    return (
+        {pk for pk, member in zip(pks, joined) if member},
+        {pk for pk, member in zip(pks, waitlisted) if member},
+    )
+
+
+def _read_page(after, limit, start=None, end=None, user_id=None):
+    """Read a page of events using the sorted set as an index.
+
+    Events sharing the same date as the cursor which were already served
+    in the previous page are skipped. The number of attendees of each
+    event is taken from the attendee sets.
+
+    :param user_id: user whose flags are read along with the events, if
+    any.
+    :return: (events, next_cursor, (joined, waitlisted)) tuple, the last
+    item holding the pks of the events the user joined or is waiting for.
+    """
+    min_score = '-inf' if after is None else after[0]
+    if start is not None and (after is None or event_score(start) > after[0]):
+        min_score = event_score(start)
+    max_score = '+inf' if end is None else event_score(end)
+    offset = 0
+    page = []
+    while len(page) <= limit:
+        trip = _RoundTrip()
+        trip.zrangebyscore(
+            EVENTS_BY_DATE_KEY, min_score, max_score,
+            start=offset, num=limit + 1, withscores=True
+        )
+        batch, = yield trip
+        offset += len(batch)
+        for member, score in batch:
+            if after is not None and score == after[0] and \
+                    int(member) <= after[1]:
+                continue
+            page.append((member, score))
+        if len(batch) < limit + 1:
+            break
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1][1], int(page[-1][0]))
+    if not page:
+        return [], None, (set(), set())
+    pks = [int(member) for member, _ in page]
+    trip = _RoundTrip()
+    trip.hmget(EVENTS_KEY, pks)
+    for pk in pks:
+        trip.scard(attendees_key(pk))
+    flags = (set(), set())
+    if user_id is not None:
+        _queue_flags(trip, pks, user_id)
+        data, *attendees, joined, waitlisted = yield trip
+        flags = _flags(pks, joined, waitlisted)
+    else:
+        data, *attendees = yield trip
+    events = []
+    with metrics.stage_duration.time(stage='decode'):
+        for event, count in zip(data, attendees):
+            if event is None:
+                continue
+            event = event_codec.decode(event)
+            event['fields']['attendees'] = count
+            events.append(event)
+    return events, next_cursor, flags
+
+
+_local_pages = LocalCache(settings.EVENTS_LOCAL_CACHE_SIZE)
+
+
+def _get_page(after, limit, user_id, start, end):
+    key = (after, limit, start, end)
+    entry = _local_pages.get(key, settings.EVENTS_LOCAL_CACHE_TTL)
+    # the flags of the page kept in memory are read along with the
+    # version, so serving it still takes a single round trip
+    pks = [e['pk'] for e in entry[0][1][0]] if entry is not None else []
+    trip = _RoundTrip()
+    trip.get(GENERATION_KEY)
+    trip.get(VERSION_KEY)
+    if pks:
+        _queue_flags(trip, pks, user_id)
+    generation, version, *flags = yield trip
+    if generation is None:
+        raise StaleCache()
+    version = (generation, version)
+    if entry is not None and entry[0][0] == version:
+        metrics.local_pages.inc(result='hit')
+        events, next_cursor = entry[0][1]
+        joined, waitlisted = _flags(pks, *flags) if pks else (set(), set())
+    else:
+        metrics.local_pages.inc(result='miss')
+        events, next_cursor, (joined, waitlisted) = yield from _read_page(
+            after, limit, start, end, user_id
+        )
+        _local_pages.set(key, (version, (events, next_cursor)))
+    return flag_events(events, joined, waitlisted), next_cursor
+
+
+def flag_events(events, joined, waitlisted):
+    """Copies of the events flagging the ones in the sets of pks"""
+    # the page may be shared with other requests, so it is not modified
+    return [
+        dict(e, fields=dict(
+            e['fields'], joined=e['pk'] in joined,
+            waitlisted=e['pk'] in waitlisted
+        ))
+        for e in events
+    ]
+
+
+def get_page(client, after, limit, user_id, start=None, end=None):
+    """Get a page of events, flagging the ones the user joined or is
+    waiting for.
+
+    Decoded pages are kept in the process while the version of the cache
+    does not change, so a page which was read before only costs a round
+    trip to check the version and get the events the user joined.
+
+    :param start: date of the earliest event in the page, if any.
+    :param end: date of the latest event in the page, if any.
+    :raises StaleCache: if the cache cannot be trusted.
+    """
+    return _run(client, _get_page(after, limit, user_id, start, end))
+
+
+async def aget_page(client, after, limit, user_id, start=None, end=None):
+    """Same as get_page, with an asyncio Redis client"""
+    return await _arun(
+        client, _get_page(after, limit, user_id, start, end)
+    )
+
+
+def _read_events(after, limit, user_id, generation):
+    trip = _RoundTrip()
+    trip.get(GENERATION_KEY)
+    current, = yield trip
+    if current is None or generation not in (None, current):
+        raise StaleCache()
+    events, next_cursor, (joined, waitlisted) = yield from _read_page(
+        after, limit, user_id=user_id
+    )
+    return flag_events(events, joined, waitlisted), next_cursor, current
+
+
+def read_events(client, after, limit, user_id, generation=None):
+    """Read a batch of live events, flagging the ones the user joined or
+    is waiting for, to go through all of them in date order.
+
+    Unlike get_page, batches are not kept in the process, as each of
+    them is only read once.
+
+    :param generation: generation marker returned along with the
+    previous batch, None for the first one.
+    :return: (events, next_cursor, generation) tuple.
+    :raises StaleCache: if the cache cannot be trusted, or was rebuilt
+    since the previous batch.
+    """
+    return _run(client, _read_events(after, limit, user_id, generation))
+
+
+def _get_version():
+    trip = _RoundTrip()
+    trip.mget(GENERATION_KEY, VERSION_KEY, MODIFIED_KEY)
+    (generation, version, modified), = yield trip
+    if generation is None:
+        raise StaleCache()
+    return (
+        generation.decode(),
+        int(version or 0),
+        float(modified) if modified is not None else None,
+    )
+
+
+def get_version(client):
+    """Get the version of the cache, which changes with every write.
+
+    :return: (generation, version, modified) tuple, where modified is
+    the timestamp of the last write.
+    :raises StaleCache: if the cache cannot be trusted.
+    """
+    return _run(client, _get_version())
+
+
+def _bump_version(trip):
+    trip.incr(VERSION_KEY)
+    trip.set(MODIFIED_KEY, time.time())
+
+
+# the events are only flagged while a rebuild runs
+_MARK_CHANGED_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then return end
+for _, pk in ipairs(ARGV) do redis.call('sadd', KEYS[2], pk) end
+"""
+
+
+def _mark_changed(trip, pks):
+    """Flag events for a rebuild running meanwhile to read them again"""
+    trip.eval(
+        _MARK_CHANGED_SCRIPT, 2, REBUILD_RUNNING_KEY, REBUILD_DIRTY_KEY, *pks
+    )
+
+
+def _mark_changed_of(pks):
+    trip = _RoundTrip()
+    _mark_changed(trip, pks)
+    yield trip
+
+
+def mark_changed(client, pks):
+    """Tell a rebuild running meanwhile that events changed in Postgres
+    after their last write to the cache, so it reads them again.
+    """
+    if pks:
+        _run(client, _mark_changed_of(pks))
+
+
+def _invalidate_user_lists(trip, user_ids):
+    for user_id in set(user_ids):
+        version_key = user_lists_version_key(user_id)
+        trip.incr(version_key)
+        trip.expire(version_key, settings.EVENTS_USER_LISTS_CACHE_TTL)
+        trip.delete(user_lists_key(user_id))
+
+
+def _publish_attendance(trip, pk):
+    """Publish the number of attendees of an event, as counted once the
+    commands queued before in the transaction are run.
+    """
+    trip.eval(
+        _PUBLISH_ATTENDANCE_SCRIPT, 2, attendees_key(pk), CHANGES_CHANNEL, pk
+    )
+
+
+def _store_event(obj, creator_name):
+    trip = _RoundTrip(transaction=True)
+    trip.hset(EVENTS_KEY, obj.pk, event_codec.encode(obj, creator_name))
+    trip.zadd(
+        EVENTS_BY_DATE_KEY, {index_member(obj.pk): event_score(obj.date)}
+    )
+    if obj.capacity is None:
+        trip.hdel(CAPACITY_KEY, obj.pk)
+    else:
+        trip.hset(CAPACITY_KEY, obj.pk, obj.capacity)
+    _bump_version(trip)
+    _mark_changed(trip, [obj.pk])
+    trip.publish(CHANGES_CHANNEL, dumps({
+        'type': 'event', 'id': obj.pk,
+        'event': event_codec.to_dict(obj, creator_name)['fields'],
+    }))
+    yield trip
+
+
+def store_event(client, obj, creator_name):
+    """Add or replace an event in the cache"""
+    _run(client, _store_event(obj, creator_name))
+
+
+def _store_events(events, batch_size):
+    events = list(events)
+    for start in range(0, len(events), batch_size):
+        batch = events[start:start + batch_size]
+        trip = _RoundTrip(transaction=True)
+        trip.hset(EVENTS_KEY, mapping={
+            obj.pk: event_codec.encode(obj, creator_name)
+            for obj, creator_name in batch
+        })
+        trip.zadd(EVENTS_BY_DATE_KEY, {
+            index_member(obj.pk): event_score(obj.date) for obj, _ in batch
+        })
+        capacities = {
+            obj.pk: obj.capacity for obj, _ in batch
+            if obj.capacity is not None
+        }
+        if capacities:
+            trip.hset(CAPACITY_KEY, mapping=capacities)
+        unlimited = [obj.pk for obj, _ in batch if obj.capacity is None]
+        if unlimited:
+            trip.hdel(CAPACITY_KEY, *unlimited)
+        _bump_version(trip)
+        _mark_changed(trip, [obj.pk for obj, _ in batch])
+        yield trip
+
+
+def store_events(client, events, batch_size):
+    """Add or replace many events in the cache.
+
+    :param events: iterable of (event, creator name) tuples.
+    :param batch_size: number of events written per round trip.
+    """
+    _run(client, _store_events(events, batch_size))
+
+
+def _add_attendee(pk, user_id):
+    trip = _RoundTrip(transaction=True)
+    trip.sadd(attendees_key(pk), user_id)
+    trip.sadd(user_events_key(user_id), pk)
+    _invalidate_user_lists(trip, [user_id])
+    _bump_version(trip)
+    _mark_changed(trip, [pk])
+    _publish_attendance(trip, pk)
+    yield trip
+
+
+def add_attendee(client, pk, user_id):
+    _run(client, _add_attendee(pk, user_id))
+
+
+async def aadd_attendee(client, pk, user_id):
+    await _arun(client, _add_attendee(pk, user_id))
+
+
+def _remove_attendee(pk, user_id):
+    trip = _RoundTrip(transaction=True)
+    trip.srem(attendees_key(pk), user_id)
+    trip.srem(user_events_key(user_id), pk)
+    _invalidate_user_lists(trip, [user_id])
+    _bump_version(trip)
+    _mark_changed(trip, [pk])
+    _publish_attendance(trip, pk)
+    yield trip
+
+
+def remove_attendee(client, pk, user_id):
+    _run(client, _remove_attendee(pk, user_id))
+
+
+async def aremove_attendee(client, pk, user_id):
+    await _arun(client, _remove_attendee(pk, user_id))
+
+
+def _update_attendees(command, pks, user_id, batch_size):
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        trip = _RoundTrip(transaction=True)
+        for pk in batch:
+            getattr(trip, command)(attendees_key(pk), user_id)
+        getattr(trip, command)(user_events_key(user_id), *batch)
+        _invalidate_user_lists(trip, [user_id])
+        _bump_version(trip)
+        _mark_changed(trip, batch)
+        for pk in batch:
+            _publish_attendance(trip, pk)
+        yield trip
+
+
+def add_attendees(client, pks, user_id, batch_size):
+    """Add a user to the attendees of many events.
+
+    :param pks: list of event pks.
+    :param batch_size: number of events written per round trip.
+    """
+    if pks:
+        _run(client, _update_attendees('sadd', pks, user_id, batch_size))
+
+
+def remove_attendees(client, pks, user_id, batch_size):
+    """Remove a user from the attendees of many events"""
+    if pks:
+        _run(client, _update_attendees('srem', pks, user_id, batch_size))
+
+
+def _archive_events(pks, attendees, waitlisted):
+    trip = _RoundTrip(transaction=True)
+    trip.hdel(EVENTS_KEY, *pks)
+    trip.zrem(EVENTS_BY_DATE_KEY, *[index_member(pk) for pk in pks])
+    trip.hdel(CAPACITY_KEY, *pks)
+    for pk in pks:
+        trip.delete(attendees_key(pk), waitlist_key(pk))
+        for user_id in attendees.get(pk, []):
+            trip.srem(user_events_key(user_id), pk)
+        for user_id, _ in waitlisted.get(pk, []):
+            trip.srem(user_waitlist_key(user_id), pk)
+    _bump_version(trip)
+    _mark_changed(trip, pks)
+    yield trip
+
+
+def archive_events(client, pks, attendees, waitlisted):
+    """Remove archived events, their attendance and waitlists from the
+    cache.
+
+    :param pks: list of event pks.
+    :param attendees: dictionary with the attendee ids of each event pk.
+    :param waitlisted: dictionary with the (user id, timestamp) tuples
+    of the waitlist of each event pk.
+    """
+    if pks:
+        _run(client, _archive_events(pks, attendees, waitlisted))
+
+
+# Seats are reserved by scripts so that checking the capacity and taking
+# a seat is atomic, without any lock. The keys of the users given a seat
+# from the waitlist can only be known by the script, so they are built
+# there, the same way the *_key functions do.
+_INVALIDATE_USER_LISTS = """
+local function invalidate_lists(user)
+    local version = 'user:' .. user .. ':lists:version'
+    redis.call('incr', version)
+    redis.call('expire', version, ARGV[5])
+    redis.call('del', 'user:' .. user .. ':lists')
+end
+"""
+_PUBLISH_ATTENDANCE = """
+local function publish_attendance(channel, pk, attendees)
+    redis.call('publish', channel, cjson.encode({
+        type = 'attendance', id = tonumber(pk),
+        attendees = redis.call('scard', attendees),
+    }))
+end
+"""
+_MARK_CHANGED = """
+local function mark_changed(pk)
+    if redis.call('exists', KEYS[11]) == 1 then
+        redis.call('sadd', KEYS[12], pk)
+    end
+end
+"""
+_PUBLISH_ATTENDANCE_SCRIPT = _PUBLISH_ATTENDANCE + """
+publish_attendance(KEYS[2], ARGV[1], KEYS[1])
+"""
+_RESERVE_SCRIPT = _INVALIDATE_USER_LISTS + _PUBLISH_ATTENDANCE + \
+    _MARK_CHANGED + """
+if redis.call('exists', KEYS[1]) == 0 then return -1 end
+if redis.call('hexists', KEYS[2], ARGV[1]) == 0 then return 0 end
+if redis.call('sismember', KEYS[4], ARGV[2]) == 1 then return 1 end
+if redis.call('zscore', KEYS[5], ARGV[2]) then return 2 end
+local capacity = redis.call('hget', KEYS[3], ARGV[1])
+local action = 'join'
+if capacity and redis.call('scard', KEYS[4]) >= tonumber(capacity) then
+    redis.call('zadd', KEYS[5], ARGV[3], ARGV[2])
+    redis.call('sadd', 'user:' .. ARGV[2] .. ':waitlist', ARGV[1])
+    action = 'waitlist'
+else
+    redis.call('sadd', KEYS[4], ARGV[2])
+    redis.call('sadd', 'user:' .. ARGV[2] .. ':events', ARGV[1])
+    publish_attendance(KEYS[9], ARGV[1], KEYS[4])
+end
+invalidate_lists(ARGV[2])
+if ARGV[4] == '1' then
+    redis.call('xadd', KEYS[8], '*',
+               'event', ARGV[1], 'user', ARGV[2], 'action', action)
+    if action == 'join' then redis.call('hincrby', KEYS[10], ARGV[1], 1) end
+end
+redis.call('incr', KEYS[6])
+redis.call('set', KEYS[7], ARGV[3])
+mark_changed(ARGV[1])
+if action == 'join' then return 1 end
+return 2
+"""
+_RELEASE_SCRIPT = _INVALIDATE_USER_LISTS + _PUBLISH_ATTENDANCE + \
+    _MARK_CHANGED + """
+if redis.call('exists', KEYS[1]) == 0 then return {-1} end
+if redis.call('hexists', KEYS[2], ARGV[1]) == 0 then return {0} end
+if ARGV[2] ~= '' then
+    redis.call('srem', KEYS[4], ARGV[2])
+    redis.call('zrem', KEYS[5], ARGV[2])
+    redis.call('srem', 'user:' .. ARGV[2] .. ':events', ARGV[1])
+    redis.call('srem', 'user:' .. ARGV[2] .. ':waitlist', ARGV[1])
+    invalidate_lists(ARGV[2])
+    if ARGV[4] == '1' then
+        redis.call('xadd', KEYS[8], '*',
+                   'event', ARGV[1], 'user', ARGV[2], 'action', 'withdraw')
+    end
+end
+local result = {1}
+local free = redis.call('zcard', KEYS[5])
+local capacity = redis.call('hget', KEYS[3], ARGV[1])
+if capacity then
+    free = math.min(free, tonumber(capacity) - redis.call('scard', KEYS[4]))
+end
+if free > 0 then
+    local users = redis.call('zrange', KEYS[5], 0, free - 1)
+    redis.call('zremrangebyrank', KEYS[5], 0, free - 1)
+    for _, user in ipairs(users) do
+        redis.call('sadd', KEYS[4], user)
+        redis.call('sadd', 'user:' .. user .. ':events', ARGV[1])
+        redis.call('srem', 'user:' .. user .. ':waitlist', ARGV[1])
+        invalidate_lists(user)
+        if ARGV[4] == '1' then
+            redis.call('xadd', KEYS[8], '*',
+                       'event', ARGV[1], 'user', user, 'action', 'join')
+            redis.call('hincrby', KEYS[10], ARGV[1], 1)
+        end
+        table.insert(result, tonumber(user))
+    end
+end
+if ARGV[2] ~= '' or free > 0 then
+    publish_attendance(KEYS[9], ARGV[1], KEYS[4])
+end
+redis.call('incr', KEYS[6])
+redis.call('set', KEYS[7], ARGV[3])
+mark_changed(ARGV[1])
+return result
+"""
+# moves an attendee to the end of the waitlist, once a flush found their
+# join did not fit in the event any more
+_WAITLIST_SCRIPT = _INVALIDATE_USER_LISTS + _PUBLISH_ATTENDANCE + \
+    _MARK_CHANGED + """
+if redis.call('exists', KEYS[1]) == 0 then return -1 end
+if redis.call('sismember', KEYS[4], ARGV[2]) == 0 then return 0 end
+redis.call('srem', KEYS[4], ARGV[2])
+redis.call('srem', 'user:' .. ARGV[2] .. ':events', ARGV[1])
+redis.call('zadd', KEYS[5], ARGV[3], ARGV[2])
+redis.call('sadd', 'user:' .. ARGV[2] .. ':waitlist', ARGV[1])
+invalidate_lists(ARGV[2])
+publish_attendance(KEYS[9], ARGV[1], KEYS[4])
+redis.call('incr', KEYS[6])
+redis.call('set', KEYS[7], ARGV[3])
+mark_changed(ARGV[1])
+return 2
+"""
+
+
+def _seat_script(script, pk, user_id, write_behind, trip=None):
+    if trip is None:
+        trip = _RoundTrip()
+    trip.eval(
+        script, 12, GENERATION_KEY, EVENTS_KEY, CAPACITY_KEY,
+        attendees_key(pk), waitlist_key(pk), VERSION_KEY, MODIFIED_KEY,
+        ATTENDANCE_STREAM_KEY, CHANGES_CHANNEL, ATTENDANCE_JOINS_KEY,
+        REBUILD_RUNNING_KEY, REBUILD_DIRTY_KEY,
+        pk, '' if user_id is None else user_id, time.time(),
+        1 if write_behind else 0, settings.EVENTS_USER_LISTS_CACHE_TTL
+    )
+    return trip
+
+
+def _reserve_seat(pk, user_id, write_behind):
+    result, = yield _seat_script(_RESERVE_SCRIPT, pk, user_id, write_behind)
+    if result == -1:
+        raise StaleCache()
+    return {0: None, 1: JOINED, 2: WAITLISTED}[result]
+
+
+def reserve_seat(client, pk, user_id, write_behind=False):
+    """Make a user join an event, or its waitlist if it is full.
+
+    :param write_behind: whether to queue the change in the attendance
+    stream, to be saved in Postgres later on by flush_attendance.
+    :return: JOINED or WAITLISTED, also if the user already was, or None
+    if the event is not in the cache, so it is archived or does not
+    exist.
+    :raises StaleCache: if the cache cannot be trusted.
+    """
+    return _run(client, _reserve_seat(pk, user_id, write_behind))
+
+
+async def areserve_seat(client, pk, user_id, write_behind=False):
+    """Same as reserve_seat, with an asyncio Redis client"""
+    return await _arun(client, _reserve_seat(pk, user_id, write_behind))
+
+
+def _release_seat(pk, user_id, write_behind):
+    result = yield _seat_script(_RELEASE_SCRIPT, pk, user_id, write_behind)
+    status, *promoted = result[0]
+    if status == -1:
+        raise StaleCache()
+    return promoted if status else None
+
+
+def release_seat(client, pk, user_id, write_behind=False):
+    """Withdraw a user from an event or its waitlist, giving the seats
+    which are free to the first users of the waitlist.
+
+    :param user_id: None to only give away the free seats, e.g. after
+    the capacity of the event was increased.
+    :param write_behind: same as for reserve_seat.
+    :return: ids of the users who got a seat, or None if the event is
+    not in the cache.
+    :raises StaleCache: if the cache cannot be trusted.
+    """
+    return _run(client, _release_seat(pk, user_id, write_behind))
+
+
+async def arelease_seat(client, pk, user_id, write_behind=False):
+    """Same as release_seat, with an asyncio Redis client"""
+    return await _arun(client, _release_seat(pk, user_id, write_behind))
+
+
+def _move_to_waitlist(pairs):
+    trip = _RoundTrip()
+    for pk, user_id in pairs:
+        _seat_script(_WAITLIST_SCRIPT, pk, user_id, False, trip)
+    results = yield trip
+    return [pair for pair, result in zip(pairs, results) if result == 2]
+
+
+def move_to_waitlist(client, pairs):
+    """Move attendees to the end of the waitlist of their events, in a
+    single round trip.
+
+    :param pairs: list of (event pk, user id) tuples.
+    :return: the pairs which were moved, leaving out the users who did
+    not attend the event any more and, if the cache cannot be trusted,
+    all of them.
+    """
+    if not pairs:
+        return []
+    return _run(client, _move_to_waitlist(pairs))
+
+
+def read_attendance(client, count, after=None):
+    """Oldest attendance changes which were not flushed yet.
+
+    :param after: id of the entry after which to read, None to read
+    from the first one.
+    :return: list of (entry id, event pk, user id, action) tuples, in
+    the order they were recorded, where the action is join, waitlist or
+    withdraw.
+    """
+    return [
+        (entry_id, int(fields[b'event']), int(fields[b'user']),
+         fields[b'action'].decode())
+        for entry_id, fields in client.xrange(
+            ATTENDANCE_STREAM_KEY,
+            min='-' if after is None else b'(' + after, count=count
+        )
+    ]
+
+
+def _iter_attendance(client, batch_size):
+    """All the attendance changes which were not flushed yet"""
+    after = None
+    while True:
+        entries = read_attendance(client, batch_size, after)
+        yield from entries
+        if len(entries) < batch_size:
+            return
+        after = entries[-1][0]
+
+
+def _entry_time(entry_id):
+    """Timestamp at which a stream entry was added"""
+    return int(entry_id.split(b'-')[0]) / 1000
+
+
+# joins are only uncounted once they are removed, so removing them twice
+# does not count them twice, and the counts are dropped with the stream
+_DELETE_ATTENDANCE_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    if redis.call('xdel', KEYS[1], ARGV[i]) == 1 and ARGV[i + 2] == 'join'
+            and redis.call('hincrby', KEYS[2], ARGV[i + 1], -1) <= 0 then
+        redis.call('hdel', KEYS[2], ARGV[i + 1])
+    end
+end
+if redis.call('xlen', KEYS[1]) == 0 then redis.call('del', KEYS[2]) end
+"""
+
+
+def delete_attendance(client, entries):
+    """Remove flushed attendance changes from the stream.
+
+    :param entries: list of tuples returned by read_attendance.
+    """
+    if entries:
+        client.eval(
+            _DELETE_ATTENDANCE_SCRIPT, 2,
+            ATTENDANCE_STREAM_KEY, ATTENDANCE_JOINS_KEY,
+            *[value for entry_id, pk, _, action in entries
+              for value in (entry_id, pk, action)]
+        )
+
+
+def pending_joins(client, pk):
+    """Number of joins of an event waiting in the attendance stream"""
+    return int(client.hget(ATTENDANCE_JOINS_KEY, pk) or 0)
+
+
+def _get_user_list_page(user_id, field):
+    trip = _RoundTrip()
+    trip.get(GENERATION_KEY)
+    trip.get(user_lists_version_key(user_id))
+    trip.hget(user_lists_key(user_id), field)
+    generation, version, page = yield trip
+    if generation is None:
+        raise StaleCache()
+    if page is not None:
+        page = loads(page)
+    return page, (version or b'').decode()
+
+
+def get_user_list_page(client, user_id, field):
+    """Get a cached page of a list of events of a user.
+
+    :param field: name of the page, made of the list and pagination
+    parameters.
+    :return: (page, version) tuple, where the page is None if it is not
+    cached, and the version has to be given to cache_user_list_page.
+    :raises StaleCache: if the cache cannot be trusted.
+    """
+    return _run(client, _get_user_list_page(user_id, field))
+
+
+# the page is only cached if the lists were not invalidated while it was
+# computed
+_CACHE_USER_LIST_PAGE_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '') ~= ARGV[1] then return 0 end
+redis.call('hset', KEYS[1], ARGV[2], ARGV[3])
+redis.call('expire', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+def cache_user_list_page(client, user_id, field, version, page):
+    """Cache a page of a list of events of a user for
+    EVENTS_USER_LISTS_CACHE_TTL seconds.
+
+    :param version: version returned by get_user_list_page before the
+    page was computed.
+    :param page: JSON serializable page.
+    """
+    client.eval(
+        _CACHE_USER_LIST_PAGE_SCRIPT, 2,
+        user_lists_key(user_id), user_lists_version_key(user_id),
+        version, field, dumps(page), settings.EVENTS_USER_LISTS_CACHE_TTL
+    )
+
+
+def _invalidate_user_lists_of(user_ids):
+    trip = _RoundTrip()
+    _invalidate_user_lists(trip, user_ids)
+    yield trip
+
+
+def invalidate_user_lists(client, user_ids):
+    """Drop the cached lists of events of some users"""
+    if user_ids:
+        _run(client, _invalidate_user_lists_of(user_ids))
+
+
+_pending_invalidation = threading.Event()
+
+
+def invalidate_later():
+    """Remember that a write could not reach the cache.
+
+    The generation marker will be removed as soon as Redis can be
+    reached again, so readers stop trusting the cache until it is
+    rebuilt.
+    """
+    _pending_invalidation.set()
+
+
+def _apply_pending_invalidation():
+    if _pending_invalidation.is_set():
+        trip = _RoundTrip()
+        trip.delete(GENERATION_KEY)
+        # a rebuild running meanwhile may have read Postgres before the
+        # write, and must not publish the cache either
+        trip.incr(INVALIDATIONS_KEY)
+        yield trip
+        _pending_invalidation.clear()
+
+
+def apply_pending_invalidation(client):
+    _run(client, _apply_pending_invalidation())
+
+
+async def aapply_pending_invalidation(client):
+    await _arun(client, _apply_pending_invalidation())
+
+
+def get_client():
+    """Redis client of the process, once the cache was invalidated if a
+    write missed it.
+
+    :raises CacheUnavailable: if the circuit breaker is open.
+    """
+    client = cache.get_client()
+    apply_pending_invalidation(client)
+    return client
+
+
+# Publishes a rebuild unless events were written since they were read
+# from Postgres, in which case their pks are returned to read them again,
+# or unless a write could not reach the cache. Keys are given in (live,
+# temporary) pairs followed by the stale live keys to delete, and a live
+# key whose temporary key is empty is deleted too.
+_PUBLISH_REBUILD_SCRIPT = """
+local dirty = redis.call('smembers', KEYS[1])
+if #dirty > 0 then
+    redis.call('del', KEYS[1])
+    return dirty
+end
+if (redis.call('get', KEYS[2]) or '') ~= ARGV[1] then return -1 end
+local renamed = tonumber(ARGV[3])
+for i = 7, 6 + renamed * 2, 2 do
+    if redis.call('exists', KEYS[i + 1]) == 1 then
+        redis.call('rename', KEYS[i + 1], KEYS[i])
+        redis.call('persist', KEYS[i])
+    else
+        redis.call('del', KEYS[i])
+    end
+end
+for i = 7 + renamed * 2, #KEYS do redis.call('del', KEYS[i]) end
+redis.call('set', KEYS[4], ARGV[2])
+redis.call('incr', KEYS[5])
+redis.call('set', KEYS[6], ARGV[4])
+redis.call('del', KEYS[3])
+return redis.call('hlen', KEYS[7])
+"""
+
+
+def rebuild(client, events, reload, attendees, waitlisted, batch_size):
+    """Populate the cache from scratch and publish it atomically.
+
+    Events, their capacities, attendees and waitlists, and the events
+    each user joined or is waiting for are written in pipelined batches
+    under temporary keys which then replace the live ones in a single
+    script, along with the new generation marker. Live sets which were
+    not rebuilt are removed by it too.
+
+    Events written to the cache while Postgres is read may be missing
+    from the rebuilt keys, so they are flagged by the writes and read
+    again before publishing, until none was written since. Changes of
+    the attendance stream which were not flushed yet are applied on top
+    of Postgres. A write which could not reach the cache cannot be
+    accounted for, so the rebuild is dropped instead.
+
+    :param client: Redis client.
+    :param events: iterable of Event objects with their creator loaded.
+    :param reload: function returning the live events among the list of
+    pks it gets, with their creator loaded.
+    :param attendees: function returning a dictionary with the attendee
+    ids of each event pk in the list of pks it gets.
+    :param waitlisted: function returning a dictionary with the (user
+    id, timestamp) tuples of the waitlist of each event pk in the list of
+    pks it gets.
+    :param batch_size: number of events written per round trip.
+    :return: number of cached events.
+    :raises RebuildInterrupted: if a write could not reach the cache, or
+    events kept changing, during the rebuild.
+    """
+    invalidations = client.get(INVALIDATIONS_KEY) or b''
+    generation = client.incr(GENERATION_COUNTER_KEY)
+    client.delete(REBUILD_DIRTY_KEY)
+    client.set(REBUILD_RUNNING_KEY, generation, ex=REBUILD_KEYS_TTL)
+    tmp_sets = {}
+    batch = []
+
+    def tmp_name(key):
+        return '{}:rebuild:{}'.format(key, generation)
+
+    tmp_events = tmp_name(EVENTS_KEY)
+    tmp_by_date = tmp_name(EVENTS_BY_DATE_KEY)
+    tmp_capacity = tmp_name(CAPACITY_KEY)
+
+    def tmp_key(key):
+        tmp_sets[key] = tmp_name(key)
+        return tmp_sets[key]
+
+    def add_to_set(pipe, key, *values):
+        pipe.sadd(tmp_key(key), *values)
+        pipe.expire(tmp_sets[key], REBUILD_KEYS_TTL)
+
+    def add_to_waitlist(pipe, pk, waiting):
+        key = tmp_key(waitlist_key(pk))
+        pipe.zadd(key, waiting)
+        pipe.expire(key, REBUILD_KEYS_TTL)
+
+    def write_event(pipe, obj):
+        data = event_codec.encode(obj, obj.creator.email.split('@')[0])
+        pipe.hset(tmp_events, obj.pk, data)
+        pipe.zadd(tmp_by_date, {index_member(obj.pk): event_score(obj.date)})
+        if obj.capacity is not None:
+            pipe.hset(tmp_capacity, obj.pk, obj.capacity)
+
+    def expire(pipe):
+        pipe.expire(tmp_events, REBUILD_KEYS_TTL)
+        pipe.expire(tmp_by_date, REBUILD_KEYS_TTL)
+        pipe.expire(tmp_capacity, REBUILD_KEYS_TTL)
+
+    def write(batch):
+        users = attendees([obj.pk for obj in batch])
+        waiting = waitlisted([obj.pk for obj in batch])
+        pipe = client.pipeline(transaction=False)
+        for obj in batch:
+            write_event(pipe, obj)
+            if users.get(obj.pk):
+                add_to_set(pipe, attendees_key(obj.pk), *users[obj.pk])
+            for user_id in users.get(obj.pk, []):
+                add_to_set(pipe, user_events_key(user_id), obj.pk)
+            if waiting.get(obj.pk):
+                add_to_waitlist(pipe, obj.pk, dict(waiting[obj.pk]))
+            for user_id, _ in waiting.get(obj.pk, []):
+                add_to_set(pipe, user_waitlist_key(user_id), obj.pk)
+        expire(pipe)
+        pipe.execute()
+
+    def reconcile(pks):
+        """Write events again as they are in Postgres, with the changes
+        of the attendance stream applied, replacing them in the reverse
+        indexes of their previous attendees and waitlist.
+        """
+        # changes are only removed from the stream once saved in
+        # Postgres, so it is read first not to miss any
+        changes = [
+            entry for entry in _iter_attendance(client, batch_size)
+            if entry[1] in pks
+        ]
+        pks = sorted(pks)
+        live = {obj.pk: obj for obj in reload(pks)}
+        users = attendees(list(live))
+        waiting = waitlisted(list(live))
+        attending = {pk: set(users.get(pk, [])) for pk in pks}
+        queued = {pk: dict(waiting.get(pk, [])) for pk in pks}
+        for entry_id, pk, user_id, action in changes:
+            if pk not in live:
+                continue
+            if action == 'join':
+                attending[pk].add(user_id)
+                queued[pk].pop(user_id, None)
+            elif action == 'waitlist':
+                attending[pk].discard(user_id)
+                queued[pk].setdefault(user_id, _entry_time(entry_id))
+            else:
+                attending[pk].discard(user_id)
+                queued[pk].pop(user_id, None)
+        pipe = client.pipeline(transaction=False)
+        for pk in pks:
+            pipe.smembers(tmp_name(attendees_key(pk)))
+            pipe.zrange(tmp_name(waitlist_key(pk)), 0, -1)
+        previous = pipe.execute()
+        pipe = client.pipeline(transaction=False)
+        for pk, old_users, old_waiting in zip(
+                pks, previous[::2], previous[1::2]):
+            old_users = {int(user_id) for user_id in old_users}
+            old_waiting = {int(user_id) for user_id in old_waiting}
+            pipe.delete(
+                tmp_name(attendees_key(pk)), tmp_name(waitlist_key(pk))
+            )
+            if pk in live:
+                write_event(pipe, live[pk])
+            else:
+                pipe.hdel(tmp_events, pk)
+                pipe.zrem(tmp_by_date, index_member(pk))
+            if pk not in live or live[pk].capacity is None:
+                pipe.hdel(tmp_capacity, pk)
+            if attending[pk]:
+                add_to_set(pipe, attendees_key(pk), *attending[pk])
+            if queued[pk]:
+                add_to_waitlist(pipe, pk, queued[pk])
+            for user_id in old_users - attending[pk]:
+                pipe.srem(tmp_name(user_events_key(user_id)), pk)
+            for user_id in attending[pk] - old_users:
+                add_to_set(pipe, user_events_key(user_id), pk)
+            for user_id in old_waiting - set(queued[pk]):
+                pipe.srem(tmp_name(user_waitlist_key(user_id)), pk)
+            for user_id in set(queued[pk]) - old_waiting:
+                add_to_set(pipe, user_waitlist_key(user_id), pk)
+        expire(pipe)
+        pipe.execute()
+
+    try:
+        for obj in events:
+            batch.append(obj)
+            if len(batch) == batch_size:
+                write(batch)
+                batch = []
+        if batch:
+            write(batch)
+        # pages of user lists may be from before the cache was
+        # invalidated
+        stale = set()
+        for pattern in (attendees_key('*'), user_events_key('*'),
+                        waitlist_key('*'), user_waitlist_key('*'),
+                        user_lists_key('*')):
+            stale.update(
+                key.decode()
+                for key in client.scan_iter(match=pattern, count=batch_size)
+            )
+        changed = {
+            entry[1] for entry in _iter_attendance(client, batch_size)
+        }
+        for _ in range(REBUILD_PASSES):
+            if changed:
+                reconcile(changed)
+            pairs = [
+                (EVENTS_KEY, tmp_events), (EVENTS_BY_DATE_KEY, tmp_by_date),
+                (CAPACITY_KEY, tmp_capacity),
+            ] + list(tmp_sets.items())
+            keys = [key for pair in pairs for key in pair]
+            keys += sorted(stale - set(tmp_sets))
+            # unique even if Redis loses the counter, so pages kept in
+            # memory from an older generation are never taken as valid
+            result = client.eval(
+                _PUBLISH_REBUILD_SCRIPT, 6 + len(keys),
+                REBUILD_DIRTY_KEY, INVALIDATIONS_KEY, REBUILD_RUNNING_KEY,
+                GENERATION_KEY, VERSION_KEY, MODIFIED_KEY, *keys,
+                invalidations,
+                '{}:{}'.format(generation, uuid.uuid4().hex),
+                len(pairs), time.time()
+            )
+            if not isinstance(result, list):
+                break
+            changed = {int(pk) for pk in result}
+        if isinstance(result, list) or result == -1:
+            raise RebuildInterrupted()
+    except Exception:
+        client.delete(
+            REBUILD_RUNNING_KEY, REBUILD_DIRTY_KEY, tmp_events, tmp_by_date,
+            tmp_capacity, *tmp_sets.values()
+        )
+        raise
+    return result
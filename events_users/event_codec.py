@@ -0,0 +1,90 @@
+"""Compact representation of the events stored in Redis.
+
+Events are encoded as a JSON array whose first item is the format
+version, followed by a fixed set of fields, e.g.
+
+    [2, 12, "title", "description", "2020-07-30T19:30:00Z", 3, "cesar", 100]
+
+Decoding gives back the dictionary the templates use, which has the same
+shape as the output of the Django serializer. Entries written with an
+older format can still be decoded, so the format can change without
+flushing the cache.
+"""
+from django.core.serializers.json import DjangoJSONEncoder
+from json import loads, dumps
+
+
+FORMAT_VERSION = 2
+_FIELDS = (
+    'title', 'description', 'date', 'creator', 'creator_name', 'capacity'
+)
+_encoder = DjangoJSONEncoder()
+
+
+def to_dict(obj, creator_name):
+    """Build the dictionary of an event straight from the model"""
+    return {
+        'pk': obj.pk,
+        'fields': {
+            'title': obj.title,
+            'description': obj.description,
+            'date': _encoder.default(obj.date),
+            'creator': obj.creator_id,
+            'creator_name': creator_name,
+            'capacity': obj.capacity,
+        },
+    }
+
+
+def encode(obj, creator_name):
+    """Encode an event with the current format"""
+    return dumps(
+        [
+            FORMAT_VERSION, obj.pk, obj.title, obj.description,
+            _encoder.default(obj.date), obj.creator_id, creator_name,
+            obj.capacity,
+        ],
+        separators=(',', ':'),
+        ensure_ascii=False,
+    )
+
+
+def _decode_v1(values):
+    """Events cached before they had a capacity"""
+    return _decode_v2(values + [None])
+
+
+def _decode_v2(values):
+    return {'pk': values[1], 'fields': dict(zip(_FIELDS, values[2:]))}
+
+
+def _decode_serializer(obj_dict):
+    """Events cached before the codec existed, as the Django serializer
+    left them.
+    """
+    obj_dict.pop('model', None)
+    obj_dict['fields'].pop('users', None)
+    obj_dict['fields'].setdefault('capacity', None)
+    return obj_dict
+
+
+_DECODERS = {
+    1: _decode_v1,
+    2: _decode_v2,
+}
+
+
+def decode(data):
+    """Decode an event encoded with any known format.
+
+    :param data: encoded event, as bytes or str.
+    :raises ValueError: if the format is unknown.
+    """
+    values = loads(data)
+    if isinstance(values, dict):
+        return _decode_serializer(values)
+    try:
+        decoder = _DECODERS[values[0]]
+    except (KeyError, IndexError, TypeError):
+        raise ValueError('Unknown event format')
+    return decoder(values)
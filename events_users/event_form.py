@@ -5,5 +5,5 @@ from events_users.models import Event
 class EventForm(forms.ModelForm):
     class Meta:
         model = Event
-        fields = ['title', 'description', 'date']
+        fields = ['title', 'description', 'date', 'capacity']
 
@@ -0,0 +1,84 @@
+"""Rendered markup of the events of the event list.
+
+The markup of an event is the same for every user but for the controls
+to edit, join and withdraw from it, so it is rendered once per version
+of the event, that is per value of the fields it shows, and kept in the
+memory of the process. Each variant of the controls of an event is
+rendered once as well, and requests only pick the ones of their user, so
+rendering a page does not get slower with the number of users viewing
+it.
+"""
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from events_users.local_cache import LocalCache
+import math
+
+
+# fields of the event dictionaries which depend on the user
+USER_FIELDS = ('joined', 'waitlisted')
+_CONTROLS = '<!-- controls -->'
+_fragments = LocalCache(settings.EVENTS_FRAGMENT_CACHE_SIZE)
+
+
+def _version(event):
+    return sorted(
+        (name, value) for name, value in event['fields'].items()
+        if name not in USER_FIELDS
+    )
+
+
+def _get_fragment(event):
+    """Markup of an event around its controls, rendered if the cached
+    one is missing or belongs to another version of the event.
+    """
+    version = _version(event)
+    entry = _fragments.get(event['pk'], math.inf)
+    if entry is not None and entry[0][0] == version:
+        return entry[0][1]
+    html = render_to_string('event/event_row.html', {
+        'event': event, 'controls': mark_safe(_CONTROLS)
+    })
+    head, tail = html.split(_CONTROLS)
+    # the variants of the controls are added as they are needed
+    fragment = {'head': head, 'tail': tail, 'controls': {}}
+    _fragments.set(event['pk'], (version, fragment))
+    return fragment
+
+
+def _get_controls(event, fragment, user_id):
+    is_creator = event['fields']['creator'] == user_id
+    key = (
+        is_creator, event['fields'].get('joined', False),
+        event['fields'].get('waitlisted', False)
+    )
+    html = fragment['controls'].get(key)
+    if html is None:
+        html = render_to_string('event/event_controls.html', {
+            'event': event, 'is_creator': is_creator
+        })
+        fragment['controls'][key] = html
+    return html
+
+
+def render_events(events, user_id, with_controls=True):
+    """Markup of a page of events for a user.
+
+    :param events: event dictionaries, with the joined and waitlisted
+    flags of the user.
+    :param with_controls: False to leave the controls out, e.g. for past
+    events.
+    """
+    parts = []
+    for event in events:
+        fragment = _get_fragment(event)
+        parts.append(fragment['head'])
+        if with_controls:
+            parts.append(_get_controls(event, fragment, user_id))
+        parts.append(fragment['tail'])
+    return mark_safe(''.join(parts))
+
+
+def invalidate(pk):
+    """Drop the markup of an event kept by this process"""
+    _fragments.delete(pk)
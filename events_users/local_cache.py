@@ -0,0 +1,47 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LocalCache:
+    """Bounded LRU cache living in the memory of the process.
+
+    Entries remember when they were stored, so each reader decides how
+    old a value it accepts.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age):
+        """Get a value and its age in seconds.
+
+        :return: (value, age) tuple, None if the key is missing or its
+        value is older than max_age.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            age = time.monotonic() - entry[0]
+            if age >= max_age:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], age
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from events_users.models import (
+    Event, WaitlistEntry, attendee_ids, waitlisted_ids
+)
+from events_users import cache, event_cache
+from datetime import datetime, timedelta, timezone
+import time
+import redis
+
+
+class Command(BaseCommand):
+    help = 'Archive past events, moving them out of the event cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=float,
+            default=settings.EVENTS_ARCHIVE_AFTER_HOURS,
+            help='Archive events which took place more than HOURS ago',
+        )
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.EVENTS_BULK_BATCH_SIZE,
+            help='Number of events archived at once',
+        )
+        parser.add_argument(
+            '--interval', type=float,
+            help='Keep running, archiving events every INTERVAL seconds',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self._archive(options['older_than'], options['batch_size'])
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
+
+    def _archive(self, older_than, batch_size):
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=older_than)
+        missed_cache = False
+        count = 0
+        while True:
+            pks = list(
+                Event.objects.filter(is_archived=False, date__lt=cutoff)
+                .order_by('date', 'pk').values_list('pk', flat=True)
+                [:batch_size]
+            )
+            if not pks:
+                break
+            waitlisted = waitlisted_ids(pks)
+            attendees = attendee_ids(pks)
+            # the events leave the lists of their creators and attendees
+            users = set(Event.objects.filter(pk__in=pks)
+                        .values_list('creator_id', flat=True))
+            for user_ids in attendees.values():
+                users.update(user_ids)
+            with transaction.atomic():
+                # nobody will get a seat of an archived event
+                WaitlistEntry.objects.filter(event_id__in=pks).delete()
+                Event.objects.filter(pk__in=pks).update(is_archived=True)
+            count += len(pks)
+            try:
+                with cache.tracked():
+                    client = cache.get_client()
+                    event_cache.archive_events(
+                        client, pks, attendees, waitlisted
+                    )
+                    event_cache.invalidate_user_lists(client, users)
+            except (cache.CacheUnavailable, redis.RedisError):
+                self.stderr.write(
+                    'Could not remove {} events from the cache'.format(
+                        len(pks)
+                    )
+                )
+                event_cache.invalidate_later()
+                missed_cache = True
+        if missed_cache:
+            self._apply_pending_invalidation()
+        self.stdout.write('Archived {} events'.format(count))
+
+    def _apply_pending_invalidation(self):
+        """Make sure readers stop trusting the cache if it still has
+        archived events.
+        """
+        try:
+            with cache.tracked():
+                event_cache.apply_pending_invalidation(cache.get_client())
+        except (cache.CacheUnavailable, redis.RedisError):
+            self.stderr.write(
+                'The cache still has archived events, rebuild it with '
+                'rebuild_event_cache'
+            )
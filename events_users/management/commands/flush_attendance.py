@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from events_users import cache, event_cache, seats
+import time
+import uuid
+import redis
+
+
+class Command(BaseCommand):
+    help = 'Save the attendance changes recorded in Redis to Postgres'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.EVENTS_ATTENDANCE_FLUSH_BATCH_SIZE,
+            help='Number of attendance changes saved at once',
+        )
+        parser.add_argument(
+            '--interval', type=float,
+            help='Keep running, flushing changes every INTERVAL seconds',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                self._flush(options['batch_size'])
+            except (cache.CacheUnavailable, redis.RedisError) as e:
+                if options['interval'] is None:
+                    raise CommandError('Redis is not available: {}'.format(e))
+                self.stderr.write('Redis is not available: {}'.format(e))
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
+
+    def _flush(self, batch_size):
+        """Save the recorded changes in batches, oldest first.
+
+        Changes are removed from the stream once their batch is committed,
+        so the ones a dead flusher did not remove are saved again by the
+        next one, which is harmless as saving them is idempotent. A lock
+        makes sure a single flusher runs at a time, so changes are saved
+        in the order they were made.
+        """
+        token = uuid.uuid4().hex
+        count = 0
+        moved = 0
+        with cache.tracked():
+            client = cache.get_client()
+            locked = client.set(
+                event_cache.ATTENDANCE_FLUSH_LOCK_KEY, token,
+                nx=True, ex=event_cache.ATTENDANCE_FLUSH_LOCK_TTL
+            )
+            if not locked:
+                self.stdout.write('A flush is already running')
+                return
+            try:
+                while True:
+                    entries = event_cache.read_attendance(client, batch_size)
+                    if not entries:
+                        break
+                    waitlisted = self._save(entries)
+                    # the users see they are waiting for the seats
+                    # they were denied
+                    moved += len(waitlisted)
+                    event_cache.move_to_waitlist(client, waitlisted)
+                    # the lists of the users are read from Postgres
+                    event_cache.invalidate_user_lists(
+                        client, {entry[2] for entry in entries}
+                    )
+                    event_cache.delete_attendance(client, entries)
+                    count += len(entries)
+                    if not cache.renew_lock(
+                            client, event_cache.ATTENDANCE_FLUSH_LOCK_KEY,
+                            token, event_cache.ATTENDANCE_FLUSH_LOCK_TTL):
+                        self.stderr.write('Lost the lock, stopping')
+                        break
+            finally:
+                cache.release_lock(
+                    client, event_cache.ATTENDANCE_FLUSH_LOCK_KEY, token
+                )
+        self.stdout.write('Flushed {} attendance changes'.format(count))
+        if moved:
+            self.stdout.write(
+                'Moved {} joins of full events to their waitlist'.format(moved)
+            )
+
+    def _save(self, entries):
+        """Save a batch of changes in a single transaction. Only the last
+        change of each user to each event matters.
+
+        :return: the (event pk, user id) tuples of the joins which did not
+        fit in their events and were saved in the waitlist.
+        """
+        changes = {}
+        for _, pk, user_id, action in entries:
+            changes[pk, user_id] = action
+        return seats.save_changes(changes, recount=True)
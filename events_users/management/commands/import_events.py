@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from events_users.event_form import EventForm
+from events_users.models import Event
+from events_users import cache, event_cache
+from json import loads
+import csv
+import redis
+import sys
+
+
+def _read_records(source, file_format):
+    """Yield (line number, record) tuples from a CSV or JSON lines file"""
+    if file_format == 'csv':
+        reader = csv.DictReader(source)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_num, line in enumerate(source, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, loads(line)
+        except ValueError as e:
+            raise CommandError('Line {}: {}'.format(line_num, e))
+
+
+class Command(BaseCommand):
+    help = 'Import events in bulk from a CSV or JSON lines file'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='File to import, - to read from stdin. Each '
+            'record has a title, description, date and optionally the '
+            'username of its creator',
+        )
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='Format of the file, guessed from its extension if not '
+            'given',
+        )
+        parser.add_argument(
+            '--creator',
+            help='Username of the creator of records which have none',
+        )
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.EVENTS_BULK_BATCH_SIZE,
+            help='Number of events written at once',
+        )
+
+    def handle(self, *args, **options):
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'csv' if options['path'].endswith('.csv') \
+                else 'jsonl'
+        if options['path'] == '-':
+            return self._import(sys.stdin, file_format, options)
+        with open(options['path'], newline='') as source:
+            return self._import(source, file_format, options)
+
+    def _import(self, source, file_format, options):
+        self.missed_cache = False
+        batch = []
+        count = 0
+        try:
+            for line_num, record in _read_records(source, file_format):
+                batch.append((line_num, record))
+                if len(batch) == options['batch_size']:
+                    count += self._write(batch, options['creator'])
+                    batch = []
+            if batch:
+                count += self._write(batch, options['creator'])
+        except CommandError as e:
+            raise CommandError('{} ({} events imported)'.format(e, count))
+        finally:
+            if self.missed_cache:
+                self._apply_pending_invalidation()
+        self.stdout.write('Imported {} events'.format(count))
+
+    def _write(self, batch, default_creator):
+        """Validate and save a batch of records with a single query, then
+        cache them in a single round trip.
+        """
+        usernames = {r.get('creator') or default_creator for _, r in batch}
+        users = User.objects.in_bulk(usernames, field_name='username')
+        events = []
+        for line_num, record in batch:
+            form = EventForm(record)
+            if not form.is_valid():
+                raise CommandError('Line {}: {}'.format(
+                    line_num, form.errors.as_json()
+                ))
+            creator = users.get(record.get('creator') or default_creator)
+            if creator is None:
+                raise CommandError('Line {}: unknown creator'.format(line_num))
+            obj = form.save(commit=False)
+            obj.creator = creator
+            events.append(obj)
+        events = Event.objects.bulk_create(events)
+        try:
+            with cache.tracked():
+                client = cache.get_client()
+                event_cache.store_events(
+                    client,
+                    [(e, e.creator.email.split('@')[0]) for e in events],
+                    len(events)
+                )
+                event_cache.invalidate_user_lists(
+                    client, {e.creator_id for e in events}
+                )
+        except (cache.CacheUnavailable, redis.RedisError):
+            self.stderr.write('Could not cache {} events'.format(len(events)))
+            event_cache.invalidate_later()
+            self.missed_cache = True
+        return len(events)
+
+    def _apply_pending_invalidation(self):
+        """Make sure readers stop trusting the cache if it missed events"""
+        try:
+            with cache.tracked():
+                event_cache.apply_pending_invalidation(cache.get_client())
+        except (cache.CacheUnavailable, redis.RedisError):
+            self.stderr.write(
+                'The cache is missing events, rebuild it with '
+                'rebuild_event_cache'
+            )
@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from events_users.models import Event, attendee_ids, waitlisted_ids
+from events_users import cache, event_cache
+import time
+import uuid
+import redis
+
+
+# rebuilds tried in a row while writes keep interrupting them
+REBUILD_ATTEMPTS = 3
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Redis event cache from the live events in Postgres'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.EVENTS_CACHE_REBUILD_BATCH_SIZE,
+            help='Number of events read and written at once',
+        )
+        parser.add_argument(
+            '--if-stale', action='store_true',
+            help='Only rebuild if the cache is not trusted by readers',
+        )
+        parser.add_argument(
+            '--interval', type=float,
+            help='Keep running, checking the cache every INTERVAL seconds',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                self._rebuild(options['batch_size'], options['if_stale'])
+            except (cache.CacheUnavailable, redis.RedisError) as e:
+                if options['interval'] is None:
+                    raise CommandError('Redis is not available: {}'.format(e))
+                self.stderr.write('Redis is not available: {}'.format(e))
+            except event_cache.RebuildInterrupted:
+                message = 'Writes kept interrupting the rebuild of the cache'
+                if options['interval'] is None:
+                    raise CommandError(message)
+                self.stderr.write(message)
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
+
+    def _rebuild(self, batch_size, if_stale):
+        token = uuid.uuid4().hex
+        with cache.tracked():
+            client = cache.get_client()
+            if if_stale and client.exists(event_cache.GENERATION_KEY):
+                return
+            locked = client.set(
+                event_cache.REBUILD_LOCK_KEY, token,
+                nx=True, ex=event_cache.REBUILD_KEYS_TTL
+            )
+            if not locked:
+                self.stdout.write('A rebuild is already running')
+                return
+            try:
+                count = self._rebuild_once(client, batch_size)
+            finally:
+                # the lock may have expired and been taken by another
+                # rebuild meanwhile
+                cache.release_lock(client, event_cache.REBUILD_LOCK_KEY, token)
+        self.stdout.write('Cached {} events'.format(count))
+
+    def _rebuild_once(self, client, batch_size):
+        """Rebuild the cache, again if it was interrupted"""
+        live = Event.objects.select_related('creator') \
+            .filter(is_archived=False)
+        for attempt in range(1, REBUILD_ATTEMPTS + 1):
+            try:
+                return event_cache.rebuild(
+                    client,
+                    live.order_by('pk').iterator(chunk_size=batch_size),
+                    lambda pks: list(live.filter(pk__in=pks)),
+                    attendee_ids, waitlisted_ids, batch_size
+                )
+            except event_cache.RebuildInterrupted:
+                if attempt == REBUILD_ATTEMPTS:
+                    raise
+                self.stdout.write(
+                    'A write interrupted the rebuild of the cache, retrying'
+                )
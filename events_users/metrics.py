@@ -0,0 +1,288 @@
+"""Metrics of the hot paths, exposed in the Prometheus text format.
+
+Counters and histograms live in the memory of each process, so every
+process has to be scraped. Nothing is recorded unless METRICS_ENABLED is
+set, in which case recording a value costs a lock and a few additions.
+
+The middleware records the duration of each request along with the
+database queries and Redis round trips it made, which are counted by
+the database connections and the Redis connection classes below.
+"""
+from asgiref.sync import iscoroutinefunction
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.utils.decorators import sync_and_async_middleware
+import threading
+import time
+import redis
+import redis.asyncio
+
+
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+_lock = threading.Lock()
+_registry = []
+
+
+def enabled():
+    return settings.METRICS_ENABLED
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels
+    ) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = defaultdict(float)
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not enabled():
+            return
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] += amount
+
+    def collect(self):
+        with _lock:
+            values = sorted(self._values.items())
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        for labels, value in values:
+            yield '{}{} {}'.format(
+                self.name, _format_labels(labels), _format_value(value)
+            )
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # labels -> [count per bucket, sum]
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not enabled():
+            return
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block in seconds"""
+        if not enabled():
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with _lock:
+            series = sorted(
+                (labels, list(counts), total)
+                for labels, (counts, total) in self._series.items()
+            )
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(labels, [('le', _format_value(bound))]),
+                    _format_value(cumulative)
+                )
+            yield '{}_sum{} {}'.format(
+                self.name, _format_labels(labels), _format_value(total)
+            )
+            yield '{}_count{} {}'.format(
+                self.name, _format_labels(labels), _format_value(cumulative)
+            )
+
+
+def clear():
+    """Forget all the recorded values"""
+    with _lock:
+        for metric in _registry:
+            if isinstance(metric, Counter):
+                metric._values.clear()
+            else:
+                metric._series.clear()
+
+
+def render():
+    """All the metrics in the Prometheus text format"""
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+cache_lookups = Counter(
+    'events_cache_lookups_total',
+    'Pages of events requested to Redis, by result: hit, miss (the cache '
+    'is not trusted) or error (Redis failed)',
+)
+fallback_requests = Counter(
+    'events_fallback_total',
+    'Pages of events requested to Postgres, by how the request was '
+    'coalesced with others',
+)
+local_pages = Counter(
+    'events_local_pages_total',
+    'Pages of events looked up in the memory of the process, by result',
+)
+stage_duration = Histogram(
+    'events_stage_duration_seconds',
+    'Time spent in each stage of the hot paths',
+)
+request_duration = Histogram(
+    'events_request_duration_seconds', 'Time spent serving each view',
+)
+request_queries = Histogram(
+    'events_request_db_queries', 'Database queries made by each view',
+    COUNT_BUCKETS,
+)
+request_round_trips = Histogram(
+    'events_request_redis_round_trips', 'Redis round trips made by each view',
+    COUNT_BUCKETS,
+)
+redis_round_trips = Counter(
+    'events_redis_round_trips_total', 'Requests and pipelines sent to Redis',
+)
+rejected_requests = Counter(
+    'events_rejected_requests_total',
+    'Requests rejected by view and reason: rate_limited, or shed while '
+    'Postgres is slow',
+)
+
+
+class _RequestStats:
+    __slots__ = ('queries', 'round_trips')
+
+    def __init__(self):
+        self.queries = 0
+        self.round_trips = 0
+
+
+# stats of the request being served, which follow it into the threads
+# running its ORM calls
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+    return execute(sql, params, many, context)
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(_instrument_connection)
+
+
+def _count_round_trip():
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.round_trips += 1
+    redis_round_trips.inc()
+
+
+class InstrumentedConnection(redis.Connection):
+    """Connection counting the requests sent to Redis.
+
+    A pipeline is sent as a single request, so this is the number of
+    round trips.
+    """
+
+    def send_packed_command(self, *args, **kwargs):
+        _count_round_trip()
+        return super().send_packed_command(*args, **kwargs)
+
+
+class InstrumentedAsyncConnection(redis.asyncio.Connection):
+    """Same as InstrumentedConnection, for the asyncio client"""
+
+    async def send_packed_command(self, *args, **kwargs):
+        _count_round_trip()
+        return await super().send_packed_command(*args, **kwargs)
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unknown'
+
+
+def _observe_request(request, stats, start):
+    view = _view_name(request)
+    request_duration.observe(time.perf_counter() - start, view=view)
+    request_queries.observe(stats.queries, view=view)
+    request_round_trips.observe(stats.round_trips, view=view)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record the duration, queries and Redis round trips of requests"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not enabled():
+                return await get_response(request)
+            stats = _RequestStats()
+            token = _request_stats.set(stats)
+            start = time.perf_counter()
+            try:
+                return await get_response(request)
+            finally:
+                _request_stats.reset(token)
+                _observe_request(request, stats, start)
+        return middleware
+
+    def middleware(request):
+        if not enabled():
+            return get_response(request)
+        stats = _RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            return get_response(request)
+        finally:
+            _request_stats.reset(token)
+            _observe_request(request, stats, start)
+    return middleware
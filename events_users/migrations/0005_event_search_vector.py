@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:47
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# the text search configuration must match events_users.search.CONFIG
+CREATE_SEARCH_TRIGGER = """
+CREATE FUNCTION events_users_event_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER events_users_event_search_vector
+    BEFORE INSERT OR UPDATE ON events_users_event
+    FOR EACH ROW EXECUTE PROCEDURE events_users_event_search_vector();
+UPDATE events_users_event SET title = title;
+CREATE INDEX events_users_event_search_vector_idx
+    ON events_users_event USING gin (search_vector);
+"""
+DROP_SEARCH_TRIGGER = """
+DROP INDEX events_users_event_search_vector_idx;
+DROP TRIGGER events_users_event_search_vector ON events_users_event;
+DROP FUNCTION events_users_event_search_vector();
+"""
+
+
+def create_search_trigger(apps, schema_editor):
+    """Keep the search vector up to date in Postgres, other databases
+    search the title and description columns instead.
+    """
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SEARCH_TRIGGER)
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SEARCH_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events_users', '0004_event_capacity_waitlist'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
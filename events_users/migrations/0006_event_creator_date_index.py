@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events_users', '0005_event_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['creator', 'date', 'id'], name='events_user_creator_f9d353_idx'),
+        ),
+    ]
@@ -1,3 +1,5 @@
+from collections import defaultdict
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -10,4 +12,73 @@ class Event(models.Model):
         User, on_delete=models.CASCADE, related_name='creator'
     )
     users = models.ManyToManyField(User, related_name='event_attendees')
+    # past events are moved out of the event cache, and can no longer
+    # be edited or joined
+    is_archived = models.BooleanField(default=False)
+    # maximum number of attendees, users joining a full event are put on
+    # its waitlist. None for events anyone can join
+    capacity = models.PositiveIntegerField(null=True, blank=True)
+    # weighted title and description words used by the full-text search.
+    # On Postgres a trigger keeps it up to date on every insert and
+    # update, and it has a GIN index (see migration 0005)
+    search_vector = SearchVectorField(null=True, editable=False)
 
+    class Meta:
+        # the event list is sorted by date and paginated with a
+        # (date, id) cursor. Archived events are the oldest ones, so
+        # windows of live or past events are ranges of this index too
+        indexes = [
+            models.Index(fields=['date', 'id']),
+            # pages of the events each user created
+            models.Index(fields=['creator', 'date', 'id']),
+        ]
+
+
+class WaitlistEntry(models.Model):
+    """User waiting for a seat of a full event.
+
+    Users are given the seats freed by the attendees who withdraw in
+    the order they joined the waitlist.
+    """
+    event = models.ForeignKey(
+        Event, on_delete=models.CASCADE, related_name='waitlist'
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='waitlisted_events'
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['event', 'user'], name='unique_waitlist_entry'
+            ),
+        ]
+        indexes = [models.Index(fields=['event', 'created', 'id'])]
+
+
+def attendee_ids(pks):
+    """Attendee ids of the given events, with a single query.
+
+    :return: dictionary with the list of attendee ids of each event pk.
+    """
+    users = defaultdict(list)
+    rows = Event.users.through.objects.filter(event_id__in=pks)
+    for event_id, user_id in rows.values_list('event_id', 'user_id'):
+        users[event_id].append(user_id)
+    return users
+
+
+def waitlisted_ids(pks):
+    """Waitlisted user ids of the given events, with a single query.
+
+    :return: dictionary with the list of (user id, timestamp of the
+    entry) tuples of each event pk, first come first.
+    """
+    users = defaultdict(list)
+    rows = WaitlistEntry.objects.filter(event_id__in=pks) \
+        .order_by('created', 'id')
+    for event_id, user_id, created in rows.values_list(
+            'event_id', 'user_id', 'created'):
+        users[event_id].append((user_id, created.timestamp()))
+    return users
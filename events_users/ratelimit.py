@@ -0,0 +1,235 @@
+"""Rate limits and load shedding of the views writing to Postgres.
+
+Each user, or IP address for anonymous requests, gets a token bucket per
+limited view, holding up to the number of requests of its limit and
+refilled at that many requests per period. Buckets live in Redis and
+are updated by a script, so the limit is shared by all the processes.
+While Redis cannot be used each process keeps its own buckets, so the
+limit is applied per process instead.
+
+Requests to the limited views are also shed, without waiting for a
+token, while the recent queries of the process to Postgres are slower
+than EVENTS_SHED_DB_LATENCY, so the database can catch up.
+"""
+from asgiref.sync import iscoroutinefunction
+from collections import OrderedDict
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from events_users import cache, metrics
+from functools import wraps
+import logging
+import math
+import threading
+import time
+import redis
+
+
+logger = logging.getLogger(__name__)
+# buckets kept by each process while Redis cannot be used
+LOCAL_BUCKETS = 10000
+_TOKEN_BUCKET_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or limit
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(limit, tokens + math.max(0, now - updated) * limit / period)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) * period / limit
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('expire', KEYS[1], math.ceil(period))
+return tostring(wait)
+"""
+
+
+def _bucket_key(name, request):
+    if request.user.is_authenticated:
+        return 'ratelimit:{}:user:{}'.format(name, request.user.id)
+    return 'ratelimit:{}:ip:{}'.format(name, request.META.get('REMOTE_ADDR'))
+
+
+class _LocalBuckets:
+    """Token buckets of the process, the least recently used ones being
+    dropped.
+    """
+
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, limit, period, now):
+        """Take a token from a bucket.
+
+        :return: seconds to wait for a token, 0 if one was taken.
+        """
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (limit, now))
+            tokens = min(
+                limit, tokens + max(0, now - updated) * limit / period
+            )
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) * period / limit
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+_local_buckets = _LocalBuckets(LOCAL_BUCKETS)
+
+
+def _take(key, limit, period):
+    now = time.time()
+    try:
+        with cache.tracked():
+            return float(cache.get_client().eval(
+                _TOKEN_BUCKET_SCRIPT, 1, key, limit, period, now
+            ))
+    except (cache.CacheUnavailable, redis.RedisError):
+        return _local_buckets.take(key, limit, period, now)
+
+
+async def _atake(key, limit, period):
+    now = time.time()
+    try:
+        with cache.tracked():
+            return float(await cache.get_async_client().eval(
+                _TOKEN_BUCKET_SCRIPT, 1, key, limit, period, now
+            ))
+    except (cache.CacheUnavailable, redis.RedisError):
+        return _local_buckets.take(key, limit, period, now)
+
+
+class _Latency:
+    """Moving average of the duration of the queries of the process.
+
+    It only accounts for the queries of the last EVENTS_SHED_WINDOW
+    seconds, so shedding stops once the slow queries are over, even if
+    no query ran since.
+    """
+
+    # weight of each new query in the average
+    ALPHA = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._average = 0.0
+        self._updated = None
+
+    def observe(self, duration):
+        with self._lock:
+            now = time.monotonic()
+            if self._updated is None or \
+                    now - self._updated > settings.EVENTS_SHED_WINDOW:
+                self._average = duration
+            else:
+                self._average += self.ALPHA * (duration - self._average)
+            self._updated = now
+
+    def get(self):
+        with self._lock:
+            if self._updated is None or time.monotonic() - self._updated > \
+                    settings.EVENTS_SHED_WINDOW:
+                return 0.0
+            return self._average
+
+    def clear(self):
+        with self._lock:
+            self._average = 0.0
+            self._updated = None
+
+
+db_latency = _Latency()
+
+
+def _time_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        db_latency.observe(time.perf_counter() - start)
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+connection_created.connect(_instrument_connection)
+
+
+def _rejected(name, status, reason, wait):
+    metrics.rejected_requests.inc(view=name, reason=reason)
+    response = HttpResponse(
+        'Too many requests' if status == 429 else 'Service unavailable',
+        status=status, content_type='text/plain'
+    )
+    response['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+
+def _shed(name):
+    if db_latency.get() > settings.EVENTS_SHED_DB_LATENCY:
+        logger.warning('Postgres is slow, shedding a request to %s', name)
+        return _rejected(name, 503, 'shed', settings.EVENTS_SHED_RETRY_AFTER)
+    return None
+
+
+def _limited(name, request, methods):
+    return name in settings.EVENTS_RATE_LIMITS and \
+        (methods is None or request.method in methods)
+
+
+def rate_limit(name, methods=None):
+    """Limit the requests of each user, or IP address for anonymous
+    ones, to a view, and shed them while Postgres is slow.
+
+    :param name: key of the limit in EVENTS_RATE_LIMITS, and label of
+    the rejected requests in the metrics.
+    :param methods: methods of the requests limited, None for all.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if _limited(name, request, methods):
+                    response = _shed(name)
+                    if response is not None:
+                        return response
+                    limit, period = settings.EVENTS_RATE_LIMITS[name]
+                    wait = await _atake(
+                        _bucket_key(name, request), limit, period
+                    )
+                    if wait:
+                        return _rejected(name, 429, 'rate_limited', wait)
+                return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if _limited(name, request, methods):
+                response = _shed(name)
+                if response is not None:
+                    return response
+                limit, period = settings.EVENTS_RATE_LIMITS[name]
+                wait = _take(_bucket_key(name, request), limit, period)
+                if wait:
+                    return _rejected(name, 429, 'rate_limited', wait)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,74 @@
+"""Full-text search of the live events.
+
+On Postgres events are matched against their search vector, which is
+kept up to date by a trigger and indexed with GIN, and ranked with
+ts_rank, title words weighing more than description ones. Other
+databases, such as SQLite for local tests, match every word of the query
+against the title and description instead, ranking title matches first.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Case, Count, F, FloatField, Q, Value, When
+from events_users.models import Event
+from events_users import event_codec
+
+
+# text search configuration, must match the trigger of migration 0005
+CONFIG = 'english'
+
+
+def normalize(query):
+    """Query with its case and whitespace normalized, so equivalent
+    queries share their cached results.
+    """
+    return ' '.join(query.lower().split())
+
+
+def _search_postgres(events, query):
+    query = SearchQuery(query, search_type='websearch', config=CONFIG)
+    return events.filter(search_vector=query) \
+        .annotate(rank=SearchRank(F('search_vector'), query))
+
+
+def _search_fallback(events, query):
+    rank = Value(0.0)
+    for word in query.split():
+        events = events.filter(
+            Q(title__icontains=word) | Q(description__icontains=word)
+        )
+        rank = rank + Case(
+            When(title__icontains=word, then=Value(2.0)),
+            When(description__icontains=word, then=Value(1.0)),
+            default=Value(0.0), output_field=FloatField(),
+        )
+    return events.annotate(rank=rank)
+
+
+def search_page(query, page, limit):
+    """Get a page of the live events matching a query, best matches
+    first and then closer events first.
+
+    :param query: normalized query.
+    :param page: number of the page, starting at 1.
+    :param limit: maximum number of events in the page.
+    :return: tuple with the list of event dictionaries and the number of
+    the next page, which is None if there are no more events.
+    """
+    events = Event.objects.select_related('creator') \
+        .filter(is_archived=False)
+    if connection.vendor == 'postgresql':
+        events = _search_postgres(events, query)
+    else:
+        events = _search_fallback(events, query)
+    offset = (page - 1) * limit
+    events = list(
+        events.annotate(attendees=Count('users'))
+        .order_by('-rank', 'date', 'pk')[offset:offset + limit + 1]
+    )
+    next_page = page + 1 if len(events) > limit else None
+    results = []
+    for obj in events[:limit]:
+        obj_dict = event_codec.to_dict(obj, obj.creator.email.split('@')[0])
+        obj_dict['fields']['attendees'] = obj.attendees
+        results.append(obj_dict)
+    return results, next_page
@@ -0,0 +1,247 @@
+"""Seats of capacity-limited events.
+
+While the cache can be trusted, seats are reserved in Redis by scripts
+which check the capacity and take a seat atomically, so concurrent joins
+of a popular event do not wait for each other, and the outcome is then
+saved in Postgres. Otherwise the row of the event is locked in Postgres
+while its seats are counted and taken.
+"""
+from collections import defaultdict
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Q
+from events_users.models import Event, WaitlistEntry
+from events_users import cache, event_cache
+import logging
+import redis
+
+
+logger = logging.getLogger(__name__)
+# attendance changes, as queued in the attendance stream
+JOIN = 'join'
+WAITLIST = 'waitlist'
+WITHDRAW = 'withdraw'
+
+
+def _pairs_query(pairs):
+    """Filter matching the given (event pk, user id) tuples"""
+    users = defaultdict(list)
+    for pk, user_id in pairs:
+        users[pk].append(user_id)
+    query = Q()
+    for pk, user_ids in users.items():
+        query |= Q(event_id=pk, user_id__in=user_ids)
+    return query
+
+
+def _over_capacity(joins):
+    """Joins which do not fit in the capacity of their events.
+
+    Seats are counted again with the rows of the events locked, in case
+    some were taken in Postgres while the joins waited in the attendance
+    stream. Joins which were saved before always fit.
+    """
+    capacities = dict(Event.objects.select_for_update().filter(
+        pk__in={pk for pk, _ in joins}, capacity__isnull=False
+    ).values_list('pk', 'capacity'))
+    if not capacities:
+        return set()
+    attendance = Event.users.through.objects
+    taken = dict(attendance.filter(event_id__in=capacities).values(
+        'event_id'
+    ).annotate(count=Count('id')).values_list('event_id', 'count'))
+    saved = set(attendance.filter(_pairs_query(
+        [(pk, user_id) for pk, user_id in joins if pk in capacities]
+    )).values_list('event_id', 'user_id'))
+    over = set()
+    for pk, user_id in joins:
+        if pk not in capacities or (pk, user_id) in saved:
+            continue
+        if taken.get(pk, 0) < capacities[pk]:
+            taken[pk] = taken.get(pk, 0) + 1
+        else:
+            over.add((pk, user_id))
+    return over
+
+
+def save_changes(changes, recount=False):
+    """Save attendance changes made in Redis in a single transaction.
+
+    Saving the same changes again does nothing, and joins of events
+    which were archived in the meantime, or of users who were deleted,
+    are dropped.
+
+    :param changes: dictionary with the action (JOIN, WAITLIST or
+    WITHDRAW) of each (event pk, user id) tuple.
+    :param recount: whether to count the seats of the events again, and
+    save the joins which do not fit any more in the waitlist instead.
+    Only needed for changes which waited in the attendance stream.
+    :return: the (event pk, user id) tuples of the joins which were
+    saved in the waitlist instead.
+    """
+    by_action = defaultdict(list)
+    for pair, action in changes.items():
+        by_action[action].append(pair)
+    attendance = Event.users.through
+    joins = []
+    over = set()
+    with transaction.atomic():
+        # seats are given up before the joins are counted
+        if by_action[WAITLIST] or by_action[WITHDRAW]:
+            attendance.objects.filter(
+                _pairs_query(by_action[WAITLIST] + by_action[WITHDRAW])
+            ).delete()
+        added = by_action[JOIN] + by_action[WAITLIST]
+        if added:
+            live = set(Event.objects.filter(
+                pk__in={pk for pk, _ in added}, is_archived=False
+            ).values_list('pk', flat=True))
+            users = set(User.objects.filter(
+                pk__in={user_id for _, user_id in added}
+            ).values_list('pk', flat=True))
+            joins = [
+                (pk, user_id) for pk, user_id in by_action[JOIN]
+                if pk in live and user_id in users
+            ]
+            waits = [
+                (pk, user_id) for pk, user_id in by_action[WAITLIST]
+                if pk in live and user_id in users
+            ]
+            if recount and joins:
+                over = _over_capacity(joins)
+            if over:
+                logger.warning(
+                    'Moving %s joins of full events to their waitlist',
+                    len(over)
+                )
+            waits += [pair for pair in joins if pair in over]
+            joins = [pair for pair in joins if pair not in over]
+            attendance.objects.bulk_create([
+                attendance(event_id=pk, user_id=user_id)
+                for pk, user_id in joins
+            ], ignore_conflicts=True)
+            WaitlistEntry.objects.bulk_create([
+                WaitlistEntry(event_id=pk, user_id=user_id)
+                for pk, user_id in waits
+            ], ignore_conflicts=True)
+        # a user is either attending an event or waiting for it
+        if joins or by_action[WITHDRAW]:
+            WaitlistEntry.objects.filter(
+                _pairs_query(joins + by_action[WITHDRAW])
+            ).delete()
+    return sorted(over)
+
+
+def _in_cache(update, pk, user_id):
+    """Run an event_cache seat function.
+
+    :return: (result, client) tuple, where the result is None if the
+    cache cannot be used for it, and the client is None if Redis cannot
+    be reached.
+    """
+    client = None
+    try:
+        with cache.tracked():
+            client = event_cache.get_client()
+            return update(client, pk, user_id), client
+    except event_cache.StaleCache:
+        return None, client
+    except (cache.CacheUnavailable, redis.RedisError):
+        logger.warning('Could not cache attendees of event %s', pk)
+        event_cache.invalidate_later()
+        return None, None
+
+
+def _changed_in_db(client, pk):
+    """Tell a rebuild of the cache running meanwhile to read the seats of
+    an event again, as they were saved in Postgres after the cache.
+    """
+    if client is None:
+        # the cache is invalidated anyway
+        return
+    try:
+        with cache.tracked():
+            event_cache.mark_changed(client, [pk])
+    except redis.RedisError:
+        event_cache.invalidate_later()
+
+
+def join(pk, user_id):
+    """Make a user join a capacity-limited event, or its waitlist if it
+    is full.
+
+    :return: event_cache.JOINED or event_cache.WAITLISTED.
+    """
+    result, client = _in_cache(event_cache.reserve_seat, pk, user_id)
+    if result is None:
+        pending = 0 if client is None else _pending_joins(client, pk)
+        result = _join_in_db(pk, user_id, pending)
+    else:
+        save_changes({
+            (pk, user_id): JOIN if result == event_cache.JOINED
+            else WAITLIST
+        })
+    _changed_in_db(client, pk)
+    return result
+
+
+def withdraw(pk, user_id=None):
+    """Withdraw a user from a capacity-limited event or its waitlist, and
+    give the free seats to the first users of the waitlist.
+
+    :param user_id: None to only give away the free seats, e.g. after
+    the capacity of the event was increased.
+    """
+    promoted, client = _in_cache(event_cache.release_seat, pk, user_id)
+    if promoted is None:
+        _withdraw_in_db(pk, user_id)
+    else:
+        changes = {(pk, promoted_id): JOIN for promoted_id in promoted}
+        if user_id is not None:
+            changes[pk, user_id] = WITHDRAW
+        save_changes(changes)
+    _changed_in_db(client, pk)
+
+
+def _pending_joins(client, pk):
+    """Joins of an event which are only recorded in the attendance
+    stream, and take seats Postgres does not know of yet.
+    """
+    try:
+        with cache.tracked():
+            return event_cache.pending_joins(client, pk)
+    except redis.RedisError:
+        return 0
+
+
+def _join_in_db(pk, user_id, pending=0):
+    with transaction.atomic():
+        obj = Event.objects.select_for_update().get(pk=pk)
+        attendance = Event.users.through.objects.filter(event_id=pk)
+        if attendance.filter(user_id=user_id).exists():
+            return event_cache.JOINED
+        if obj.waitlist.filter(user_id=user_id).exists():
+            return event_cache.WAITLISTED
+        if obj.capacity is None or \
+                attendance.count() + pending < obj.capacity:
+            obj.users.add(user_id)
+            return event_cache.JOINED
+        WaitlistEntry.objects.create(event=obj, user_id=user_id)
+        return event_cache.WAITLISTED
+
+
+def _withdraw_in_db(pk, user_id):
+    with transaction.atomic():
+        obj = Event.objects.select_for_update().get(pk=pk)
+        if user_id is not None:
+            obj.users.remove(user_id)
+            obj.waitlist.filter(user_id=user_id).delete()
+        entries = obj.waitlist.order_by('created', 'id')
+        if obj.capacity is not None:
+            free = obj.capacity - obj.users.count()
+            entries = entries[:max(free, 0)]
+        entries = list(entries)
+        obj.users.add(*[entry.user_id for entry in entries])
+        WaitlistEntry.objects.filter(
+            pk__in=[entry.pk for entry in entries]
+        ).delete()
@@ -0,0 +1,121 @@
+"""Session engine reading the sessions from Redis.
+
+Sessions are still saved in Postgres, which stays the source of truth,
+and a copy of each one is kept in Redis, through the process-wide pool,
+so authenticated requests do not read the session table. While Redis
+cannot be used sessions are read from and written to Postgres only.
+Sessions which could not be updated or deleted in Redis are dropped from
+it as soon as the process can reach it again, so a stale or logged out
+session is not read back from it. Other processes do not know of them,
+and may read them until they expire, so copies are only kept for
+EVENTS_SESSION_CACHE_TTL seconds.
+
+Enable it with SESSION_ENGINE = 'events_users.sessions'.
+"""
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from events_users import cache
+import logging
+import threading
+import redis
+
+
+logger = logging.getLogger(__name__)
+KEY_PREFIX = 'session:'
+_pending_lock = threading.Lock()
+# keys of the sessions whose copy in Redis may be stale
+_pending_deletes = set()
+
+
+def _key(session_key):
+    return KEY_PREFIX + session_key
+
+
+def _forget_later(session_key):
+    with _pending_lock:
+        _pending_deletes.add(session_key)
+
+
+def _get_client():
+    """Redis client, once the stale sessions have been dropped from it"""
+    client = cache.get_client()
+    with _pending_lock:
+        session_keys = list(_pending_deletes)
+        _pending_deletes.clear()
+    if session_keys:
+        try:
+            client.delete(*[_key(key) for key in session_keys])
+        except redis.RedisError:
+            with _pending_lock:
+                _pending_deletes.update(session_keys)
+            raise
+    return client
+
+
+class SessionStore(DBStore):
+    def load(self):
+        data = self._load_from_redis()
+        if data is not None:
+            return data
+        s = self._get_session_from_db()
+        if s is None:
+            return {}
+        self._store_in_redis(
+            s.session_data, self.get_expiry_age(expiry=s.expire_date)
+        )
+        return self.decode(s.session_data)
+
+    def _load_from_redis(self):
+        """Session data cached in Redis, None if it is not there"""
+        if not self.session_key:
+            return None
+        try:
+            with cache.tracked():
+                session_data = _get_client().get(_key(self.session_key))
+        except (cache.CacheUnavailable, redis.RedisError):
+            return None
+        if session_data is None:
+            return None
+        # the data is signed, so a tampered entry decodes to {}
+        return self.decode(session_data.decode())
+
+    def _store_in_redis(self, session_data, expiry_age):
+        ttl = min(expiry_age, settings.EVENTS_SESSION_CACHE_TTL)
+        if ttl <= 0:
+            return
+        try:
+            with cache.tracked():
+                _get_client().set(
+                    _key(self.session_key), session_data, ex=ttl
+                )
+        except (cache.CacheUnavailable, redis.RedisError):
+            logger.warning('Could not cache a session')
+            _forget_later(self.session_key)
+
+    def save(self, must_create=False):
+        super().save(must_create)
+        self._store_in_redis(
+            self.encode(self._get_session(no_load=must_create)),
+            self.get_expiry_age()
+        )
+
+    def delete(self, session_key=None):
+        super().delete(session_key)
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        try:
+            with cache.tracked():
+                _get_client().delete(_key(session_key))
+        except (cache.CacheUnavailable, redis.RedisError):
+            logger.warning('Could not remove a session from the cache')
+            _forget_later(session_key)
+
+    def flush(self):
+        """Remove the current session data from the database and Redis,
+        and regenerate the key.
+        """
+        self.clear()
+        self.delete(self.session_key)
+        self._session_key = None
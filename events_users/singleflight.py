@@ -0,0 +1,139 @@
+"""Coalesce concurrent computations of the same value.
+
+When the event cache cannot be used, every request would otherwise query
+Postgres for the same page at the same time. Here only one of them
+computes it while the others wait for its result or, if there is one,
+get the previous value even if it is slightly stale. Requests which
+waited too long give up rather than querying Postgres too.
+
+Results and locks live in Redis so they are shared by all the processes.
+If Redis is not available they live in the process, and only requests
+served by the same process are coalesced.
+"""
+from collections import Counter
+from events_users import cache, metrics
+from events_users.local_cache import LocalCache
+from json import loads, dumps
+import threading
+import time
+import uuid
+import redis
+
+
+# how many times each outcome happened, for monitoring:
+# fresh: a fresh result was reused
+# computed: the result was computed by this request
+# stale: a stale result was served while another request computed it
+# coalesced: the request waited for the result of another one
+# timeout: the request got tired of waiting and gave up
+stats = Counter()
+_stats_lock = threading.Lock()
+POLL_INTERVAL = 0.05
+LOCAL_MAX_ENTRIES = 128
+
+
+class Busy(Exception):
+    """Raised when another request is computing the value, and did not
+    finish within the time to wait for it.
+    """
+
+
+def _count(outcome):
+    with _stats_lock:
+        stats[outcome] += 1
+    metrics.fallback_requests.inc(outcome=outcome)
+
+
+def _get_redis(client, key, compute, fresh_for, stale_for, wait, lock_for):
+    lock_key = '{}:lock'.format(key)
+    entry = client.get(key)
+    if entry is not None:
+        entry = loads(entry)
+        if time.time() - entry['at'] < fresh_for:
+            _count('fresh')
+            return entry['value']
+    # the lock expires on its own in case its owner dies, and then
+    # another request may take it while this one is still computing
+    token = uuid.uuid4().hex
+    if client.set(lock_key, token, nx=True, px=int(lock_for * 1000)):
+        try:
+            value = compute()
+            client.set(
+                key, dumps({'at': time.time(), 'value': value}),
+                ex=int(fresh_for + stale_for) + 1
+            )
+        finally:
+            cache.release_lock(client, lock_key, token)
+        _count('computed')
+        return value
+    if entry is not None:
+        _count('stale')
+        return entry['value']
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = client.get(key)
+        if entry is not None:
+            _count('coalesced')
+            return loads(entry)['value']
+    _count('timeout')
+    raise Busy()
+
+
+_local_entries = LocalCache(LOCAL_MAX_ENTRIES)
+# striped so that the number of locks does not grow with the keys
+_local_locks = [threading.Lock() for _ in range(64)]
+
+
+def _get_local(key, compute, fresh_for, stale_for, wait):
+    entry = _local_entries.get(key, fresh_for + stale_for)
+    if entry is not None and entry[1] < fresh_for:
+        _count('fresh')
+        return entry[0]
+    lock = _local_locks[hash(key) % len(_local_locks)]
+    if lock.acquire(blocking=False):
+        try:
+            value = compute()
+            _local_entries.set(key, value)
+        finally:
+            lock.release()
+        _count('computed')
+        return value
+    if entry is not None:
+        _count('stale')
+        return entry[0]
+    if lock.acquire(timeout=wait):
+        lock.release()
+        entry = _local_entries.get(key, fresh_for)
+        if entry is not None:
+            _count('coalesced')
+            return entry[0]
+    _count('timeout')
+    raise Busy()
+
+
+def get(client, key, compute, fresh_for, stale_for, wait, lock_for):
+    """Get a value making sure only one request computes it at a time.
+
+    :param client: Redis client, None to coordinate within the process.
+    :param key: key identifying the value.
+    :param compute: function computing the value, which must be JSON
+    serializable.
+    :param fresh_for: seconds a computed value is reused for.
+    :param stale_for: seconds after that a value may still be served
+    while it is being computed again.
+    :param wait: seconds to wait for another request to compute it.
+    :param lock_for: seconds a request computing the value keeps others
+    from computing it at most, in case it dies. Only used with Redis.
+    :raises Busy: if the value was not computed by another request in
+    time. A stale value is served instead if there is one.
+    """
+    if client is not None:
+        try:
+            # the client may be the trial call of the circuit breaker
+            with cache.tracked():
+                return _get_redis(client, key, compute, fresh_for,
+                                  stale_for, wait, lock_for)
+        except redis.RedisError:
+            pass
+    return _get_local(key, compute, fresh_for, stale_for, wait)
@@ -1,11 +1,33 @@
-from django.test import TestCase
-from django.test.client import Client
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import serializers
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, router
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.test.client import AsyncRequestFactory, Client, RequestFactory
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.contrib.auth.models import User
 from django.urls import reverse
 from unittest import mock
-from events_users.models import Event
-from events_users import views
-from datetime import datetime
+from events_users.models import (
+    Event, WaitlistEntry, attendee_ids, waitlisted_ids
+)
+from events_users import (
+    views, async_views, broadcast, cache, db_router, event_cache,
+    event_codec, fragments, metrics, ratelimit, sessions, singleflight,
+    user_cache
+)
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from json import loads, dumps
+import asyncio
+import tempfile
+import threading
+import time
+import redis
 
 
 class ModelTest(TestCase):
@@ -30,6 +52,61 @@ class ModelTest(TestCase):
         self.assertEqual(user, model.creator)
 
 
+class EventCodecTest(TestCase):
+    def setUp(self):
+        """Create an event to encode"""
+        user = User.objects.create(username='user', email='user@mail')
+        self.event = Event.objects.create(
+            title='event',
+            description='desc',
+            date=datetime(2020, 7, 30, 19, 30, tzinfo=timezone.utc),
+            creator=user
+        )
+
+    def test_round_trip(self):
+        """Check a decoded event matches the model"""
+        data = event_codec.encode(self.event, 'user')
+        self.assertEqual(
+            event_codec.to_dict(self.event, 'user'),
+            event_codec.decode(data.encode())
+        )
+        self.assertEqual(
+            {
+                'pk': self.event.pk,
+                'fields': {
+                    'title': 'event',
+                    'description': 'desc',
+                    'date': '2020-07-30T19:30:00Z',
+                    'creator': self.event.creator_id,
+                    'creator_name': 'user',
+                    'capacity': None,
+                },
+            },
+            event_codec.decode(data)
+        )
+
+    def test_decode_v1(self):
+        """Check events cached before they had a capacity still decode"""
+        obj_dict = event_codec.decode(
+            '[1,1,"event","desc","2020-07-30T19:30:00Z",2,"user"]'
+        )
+        self.assertEqual('user', obj_dict['fields']['creator_name'])
+        self.assertIsNone(obj_dict['fields']['capacity'])
+
+    def test_decode_serializer_format(self):
+        """Check events cached by the Django serializer still decode"""
+        data = serializers.serialize('json', [self.event])[1:-1]
+        obj_dict = event_codec.decode(data)
+        self.assertEqual(self.event.pk, obj_dict['pk'])
+        self.assertEqual('event', obj_dict['fields']['title'])
+        self.assertNotIn('users', obj_dict['fields'])
+
+    def test_decode_unknown_format(self):
+        """Check events with an unknown format are rejected"""
+        with self.assertRaises(ValueError):
+            event_codec.decode('[9001, 1]')
+
+
 class LoggedInTest(TestCase):
     def setUp(self):
         """Create a couple of users and log in as one of them"""
@@ -47,10 +124,16 @@ class LoggedInTest(TestCase):
         self.user2.save()
 
         self.client.login(username='user', password='p')
+        self._rebuild_cache()
 
     def tearDown(self):
         client = views._get_redis_client()
         client.flushall()
+        singleflight._local_entries.clear()
+        event_cache._local_pages.clear()
+        fragments._fragments.clear()
+        ratelimit._local_buckets.clear()
+        ratelimit.db_latency.clear()
 
     def _create_event(self):
         """Create an event and return its response and model object"""
@@ -62,6 +145,18 @@ class LoggedInTest(TestCase):
         response = self.client.post(reverse('create_event'), self.event_data)
         return response, Event.objects.all()[0]
 
+    def _redis_down(self):
+        """Make the shared pool connect to a port where Redis does not
+        listen.
+        """
+        return mock.patch('events_users.cache._pool', redis.ConnectionPool(
+            host='127.0.0.1', port=1, socket_connect_timeout=0.1
+        ))
+
+    def _rebuild_cache(self):
+        """Populate the cache from the DB so readers can trust it"""
+        call_command('rebuild_event_cache', stdout=StringIO())
+
     def _log_in_as_another_user(self):
         """Log in as the other created user"""
         self.client.logout()
@@ -153,7 +248,890 @@ class AllEventsTest(LoggedInTest):
         with mock.patch('events_users.views.Event') as e:
             client.side_effect = Exception('oh no')
             self.client.get(reverse('home'))
-            e.objects.all().select_related.assert_called_once_with('creator')
+            e.objects.select_related.assert_called_once_with('creator')
+
+    @mock.patch('events_users.cache.redis.Redis')
+    def test_open_circuit_skips_redis(self, redis_client):
+        """Check Postgres is used straight away when the circuit is open"""
+        breaker = cache.CircuitBreaker(1, 30)
+        breaker.record_failure()
+        with mock.patch('events_users.cache.breaker', breaker):
+            with mock.patch('events_users.views.Event') as e:
+                self.client.get(reverse('home'))
+                e.objects.select_related.assert_called_once_with('creator')
+        redis_client.assert_not_called()
+
+    @mock.patch('events_users.views._get_redis_client')
+    def test_get_all_events_fallback_queries(self, client):
+        """Check a Postgres page costs the same queries for any event count"""
+        self._create_events(['07/30/2020 19:30'] * 3)
+        for event in Event.objects.all():
+            event.users.add(self.user, self.user2)
+        client.side_effect = Exception('oh no')
+        with self.assertNumQueries(2):
+            events, _ = views._get_all_events(self.user.id)
+        self.assertEqual([2, 2, 2], [e['fields']['attendees'] for e in events])
+        self.assertTrue(all(e['fields']['joined'] for e in events))
+
+    def _create_events(self, dates):
+        """Create one event per date in the given list"""
+        for i, date in enumerate(dates):
+            self.client.post(reverse('create_event'), {
+                'title': 'title {}'.format(i),
+                'description': 'desc',
+                'date': date,
+            })
+
+    def _get_titles(self, after=None):
+        """Get the titles in a page of the event list and its next cursor"""
+        data = {'after': after} if after else {}
+        response = self.client.get(reverse('home'), data)
+        titles = [e['fields']['title'] for e in response.context['events']]
+        return titles, response.context['next_cursor']
+
+    @override_settings(EVENTS_PAGE_SIZE=2)
+    def test_all_events_pagination(self):
+        """Check events are paginated in date order using the cursor"""
+        self._create_events([
+            '07/30/2020 19:30', '07/28/2020 19:30',
+            '07/29/2020 19:30', '07/29/2020 19:30',
+        ])
+        titles, cursor = self._get_titles()
+        self.assertEqual(['title 1', 'title 2'], titles)
+        titles, cursor = self._get_titles(cursor)
+        self.assertEqual(['title 3', 'title 0'], titles)
+        self.assertIsNone(cursor)
+
+    @override_settings(EVENTS_PAGE_SIZE=2)
+    @mock.patch('events_users.views._get_redis_client')
+    def test_all_events_pagination_fallback(self, client):
+        """Check Postgres pages follow the same order as Redis ones"""
+        self._create_events([
+            '07/30/2020 19:30', '07/28/2020 19:30', '07/29/2020 19:30',
+        ])
+        client.side_effect = Exception('oh no')
+        titles, cursor = self._get_titles()
+        self.assertEqual(['title 1', 'title 2'], titles)
+        titles, cursor = self._get_titles(cursor)
+        self.assertEqual(['title 0'], titles)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        """Check cursors which are not dates serve the first page and
+        leave the circuit breaker alone.
+        """
+        self._create_events(['07/30/2020 19:30'])
+        for after in ('nan_1', 'inf_1', '-inf_1', '1e300_1', 'x_1'):
+            titles, _ = self._get_titles(after)
+            self.assertEqual(['title 0'], titles)
+        self.assertEqual(0, cache.breaker.status()['failures'])
+
+
+class RebuildCacheTest(LoggedInTest):
+    def _get_titles(self):
+        response = self.client.get(reverse('home'))
+        return [e['fields']['title'] for e in response.context['events']]
+
+    def test_rebuild(self):
+        """Check the cache is rebuilt from the DB"""
+        _, event = self._create_event()
+        event.users.add(self.user2)
+        client = views._get_redis_client()
+        client.flushall()
+        self._rebuild_cache()
+        events, _ = event_cache.get_page(client, None, 10, self.user2.id)
+        self.assertEqual(1, len(events))
+        self.assertEqual(event.pk, events[0]['pk'])
+        self.assertEqual(1, events[0]['fields']['attendees'])
+        self.assertTrue(events[0]['fields']['joined'])
+        self.assertEqual('mail', events[0]['fields']['creator_name'])
+
+    def test_rebuild_removes_stale_sets(self):
+        """Check attendance sets missing from the DB are removed"""
+        _, event = self._create_event()
+        self.client.post(reverse('join_event', args=[event.id]))
+        event.users.remove(self.user)
+        self._rebuild_cache()
+        client = views._get_redis_client()
+        self.assertFalse(client.exists(event_cache.attendees_key(event.id)))
+        self.assertFalse(
+            client.exists(event_cache.user_events_key(self.user.id))
+        )
+
+    def _rebuild(self, client, attendees=attendee_ids):
+        """Rebuild the cache reading the attendees with a function"""
+        live = Event.objects.select_related('creator') \
+            .filter(is_archived=False)
+        return event_cache.rebuild(
+            client, live.order_by('pk'),
+            lambda pks: list(live.filter(pk__in=pks)),
+            attendees, waitlisted_ids, 10
+        )
+
+    def test_write_during_rebuild(self):
+        """Check events written while Postgres is read are read again
+        before the rebuild is published.
+        """
+        _, event = self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        calls = []
+
+        def attendees(pks):
+            calls.append(pks)
+            if len(calls) == 1:
+                # the user joins once the attendees were read
+                event.users.add(self.user2)
+                event_cache.add_attendee(client, event.pk, self.user2.id)
+                return {}
+            return attendee_ids(pks)
+
+        self.assertEqual(1, self._rebuild(client, attendees))
+        self.assertEqual(2, len(calls))
+        self.assertTrue(client.exists(event_cache.GENERATION_KEY))
+        self.assertEqual(
+            {str(self.user2.id).encode()},
+            client.smembers(event_cache.attendees_key(event.pk))
+        )
+        self.assertEqual(
+            {str(event.pk).encode()},
+            client.smembers(event_cache.user_events_key(self.user2.id))
+        )
+        self.assertEqual([], client.keys('*:rebuild:*'))
+
+    def test_withdraw_during_rebuild(self):
+        """Check attendees removed while Postgres is read are removed
+        from the rebuilt reverse indexes too.
+        """
+        _, event = self._create_event()
+        event.users.add(self.user2)
+        client = views._get_redis_client()
+
+        def attendees(pks):
+            users = attendee_ids(pks)
+            if event.users.exists():
+                event.users.remove(self.user2)
+                event_cache.remove_attendee(client, event.pk, self.user2.id)
+            return users
+
+        self._rebuild(client, attendees)
+        self.assertFalse(client.exists(
+            event_cache.attendees_key(event.pk),
+            event_cache.user_events_key(self.user2.id),
+        ))
+
+    def test_rebuild_gives_up(self):
+        """Check a rebuild is dropped if events keep changing"""
+        _, event = self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+
+        def attendees(pks):
+            event_cache.add_attendee(client, event.pk, self.user2.id)
+            return {}
+
+        with self.assertRaises(event_cache.RebuildInterrupted):
+            self._rebuild(client, attendees)
+        self.assertFalse(client.exists(
+            event_cache.GENERATION_KEY, event_cache.REBUILD_RUNNING_KEY,
+            event_cache.REBUILD_DIRTY_KEY,
+        ))
+        self.assertEqual([], client.keys('*:rebuild:*'))
+
+    def test_failed_write_during_rebuild(self):
+        """Check a rebuild is not published if a write could not reach
+        the cache meanwhile, as it does not know which events changed.
+        """
+        self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+
+        def attendees(pks):
+            event_cache.invalidate_later()
+            event_cache.apply_pending_invalidation(client)
+            return {}
+
+        with self.assertRaises(event_cache.RebuildInterrupted):
+            self._rebuild(client, attendees)
+        self.assertFalse(client.exists(event_cache.GENERATION_KEY))
+        self.assertEqual([], client.keys('*:rebuild:*'))
+
+    @override_settings(EVENTS_WRITE_BEHIND_ATTENDANCE=True)
+    def test_rebuild_keeps_pending_attendance(self):
+        """Check changes waiting in the attendance stream are kept by a
+        rebuild.
+        """
+        _, event = self._create_event()
+        self.client.post(reverse('join_event', args=[event.id]))
+        self._rebuild_cache()
+        self.assertEqual(0, event.users.count())
+        client = views._get_redis_client()
+        self.assertEqual(
+            {str(self.user.id).encode()},
+            client.smembers(event_cache.attendees_key(event.pk))
+        )
+        call_command('flush_attendance', stdout=StringIO())
+        self.assertEqual([self.user], list(event.users.all()))
+
+    def test_rebuild_retried(self):
+        """Check the command rebuilds again when it was interrupted"""
+        self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        rebuild = event_cache.rebuild
+
+        def interrupt_once(*args):
+            if mocked.call_count == 1:
+                raise event_cache.RebuildInterrupted()
+            return rebuild(*args)
+
+        with mock.patch('events_users.event_cache.rebuild') as mocked:
+            mocked.side_effect = interrupt_once
+            out = StringIO()
+            call_command('rebuild_event_cache', stdout=out)
+        self.assertEqual(2, mocked.call_count)
+        self.assertIn('Cached 1 events', out.getvalue())
+        self.assertTrue(client.exists(event_cache.GENERATION_KEY))
+
+    def test_lock_taken_over(self):
+        """Check a rebuild whose lock expired leaves the lock of the
+        rebuild which took it over.
+        """
+        client = views._get_redis_client()
+
+        def rebuild(*args):
+            client.set(event_cache.REBUILD_LOCK_KEY, 'other')
+            return 0
+
+        with mock.patch('events_users.event_cache.rebuild', rebuild):
+            self._rebuild_cache()
+        self.assertEqual(b'other', client.get(event_cache.REBUILD_LOCK_KEY))
+
+    def test_rebuild_if_stale(self):
+        """Check a trusted cache is left alone with --if-stale"""
+        self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.EVENTS_KEY)
+        call_command('rebuild_event_cache', if_stale=True, stdout=StringIO())
+        self.assertFalse(client.exists(event_cache.EVENTS_KEY))
+        client.delete(event_cache.GENERATION_KEY)
+        call_command('rebuild_event_cache', if_stale=True, stdout=StringIO())
+        self.assertTrue(client.exists(event_cache.EVENTS_KEY))
+
+    def test_stale_cache_fallback(self):
+        """Check Postgres is used while the cache is not trusted"""
+        self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.EVENTS_BY_DATE_KEY)
+        self.assertEqual([], self._get_titles())
+        client.delete(event_cache.GENERATION_KEY)
+        self.assertEqual(['title'], self._get_titles())
+
+    @mock.patch('events_users.event_cache.store_event')
+    def test_failed_write_invalidates(self, store_event):
+        """Check a write which did not reach Redis invalidates the cache"""
+        store_event.side_effect = redis.ConnectionError('oh no')
+        self._create_event()
+        self.assertEqual(['title'], self._get_titles())
+        client = views._get_redis_client()
+        self.assertFalse(client.exists(event_cache.GENERATION_KEY))
+
+
+class WindowTest(LoggedInTest):
+    def _create_event_at(self, title, date):
+        self.client.post(reverse('create_event'), {
+            'title': title, 'description': 'desc',
+            'date': date.strftime('%m/%d/%Y %H:%M'),
+        })
+        return Event.objects.get(title=title)
+
+    def _get_titles(self, window=None, after=None):
+        params = {}
+        if window:
+            params['window'] = window
+        if after:
+            params['after'] = after
+        response = self.client.get(reverse('home'), params)
+        return [e['fields']['title'] for e in response.context['events']], \
+            response.context['next_cursor']
+
+    def setUp(self):
+        super().setUp()
+        now = datetime.now(timezone.utc)
+        self.past = self._create_event_at('past', now - timedelta(days=2))
+        self._create_event_at('soon', now + timedelta(days=1))
+        self._create_event_at('later', now + timedelta(days=2))
+        self._create_event_at('next year', now + timedelta(days=365))
+
+    def test_windows(self):
+        """Check the live events can be listed by time window"""
+        self.assertEqual(['past', 'soon', 'later', 'next year'],
+                         self._get_titles()[0])
+        self.assertEqual(['soon', 'later', 'next year'],
+                         self._get_titles('upcoming')[0])
+        self.assertEqual(['soon', 'later'], self._get_titles('next30')[0])
+        with self.settings(EVENTS_PAGE_SIZE=1):
+            titles, cursor = self._get_titles('next30')
+            self.assertEqual(['soon'], titles)
+            self.assertEqual(['later'],
+                             self._get_titles('next30', cursor)[0])
+
+    def test_windows_fallback(self):
+        """Check windows are the same when Postgres is used"""
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        self.assertEqual(['soon', 'later', 'next year'],
+                         self._get_titles('upcoming')[0])
+        self.assertEqual(['soon', 'later'], self._get_titles('next30')[0])
+
+    def test_archive(self):
+        """Check past events are moved out of the event cache"""
+        self.client.post(reverse('join_event', args=[self.past.id]))
+        out = StringIO()
+        call_command('archive_events', stdout=out)
+        self.assertIn('Archived 1 events', out.getvalue())
+        self.past.refresh_from_db()
+        self.assertTrue(self.past.is_archived)
+        client = views._get_redis_client()
+        self.assertFalse(client.hexists(event_cache.EVENTS_KEY, self.past.id))
+        self.assertFalse(
+            client.exists(event_cache.attendees_key(self.past.id))
+        )
+        self.assertFalse(
+            client.exists(event_cache.user_events_key(self.user.id))
+        )
+        self.assertEqual(['soon', 'later', 'next year'],
+                         self._get_titles()[0])
+        # the rebuild leaves archived events out too
+        self._rebuild_cache()
+        self.assertEqual(['soon', 'later', 'next year'],
+                         self._get_titles()[0])
+
+    def test_archived_read_only(self):
+        """Check archived events cannot be joined nor edited"""
+        call_command('archive_events', stdout=StringIO())
+        for name in ('join_event', 'withdraw_event', 'edit_event'):
+            response = self.client.get(reverse(name, args=[self.past.id]))
+            self.assertEqual(404, response.status_code)
+
+    def test_past(self):
+        """Check past events are listed latest first from the cold cache"""
+        self._create_event_at(
+            'older', datetime.now(timezone.utc) - timedelta(days=3)
+        )
+        self.client.post(reverse('join_event', args=[self.past.id]))
+        call_command('archive_events', stdout=StringIO())
+        response = self.client.get(reverse('home'), {'window': 'past'})
+        events = response.context['events']
+        self.assertEqual(['past', 'older'],
+                         [e['fields']['title'] for e in events])
+        self.assertEqual([1, 0], [e['fields']['attendees'] for e in events])
+        self.assertEqual([True, False],
+                         [e['fields']['joined'] for e in events])
+        self.assertNotIn(b'Join event', response.content)
+        with mock.patch('events_users.views._get_past_events_page_from_db') \
+                as db:
+            self.assertEqual(['past', 'older'], self._get_titles('past')[0])
+            db.assert_not_called()
+        with self.settings(EVENTS_PAGE_SIZE=1):
+            titles, cursor = self._get_titles('past')
+            self.assertEqual(['past'], titles)
+            self.assertEqual(['older'], self._get_titles('past', cursor)[0])
+
+    def test_past_reports_to_breaker(self):
+        """Check the trial call of the circuit breaker made by the cold
+        cache only closes it if Redis answers.
+        """
+        call_command('archive_events', stdout=StringIO())
+        breaker = cache.CircuitBreaker(1, 0)
+        breaker.record_failure()
+        with mock.patch('events_users.cache.breaker', breaker):
+            with self._redis_down():
+                page, _ = views._get_past_events(self.user.id, None, 10)
+            self.assertEqual(['past'], [e['fields']['title'] for e in page])
+            self.assertEqual(cache.CircuitBreaker.OPEN, breaker.state)
+            views._get_past_events(self.user.id, None, 10)
+        self.assertEqual(cache.CircuitBreaker.CLOSED, breaker.state)
+
+    def test_api_window(self):
+        """Check windows of the JSON API are not validated by date"""
+        response = self.client.get(reverse('api_events'),
+                                   {'window': 'upcoming'})
+        self.assertEqual(['soon', 'later', 'next year'],
+                         [e['title'] for e in response.json()['events']])
+        self.assertTrue(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+        response = self.client.get(reverse('api_events'), {'window': 'past'})
+        self.assertEqual(['past'],
+                         [e['title'] for e in response.json()['events']])
+        self.assertFalse(response.has_header('ETag'))
+
+
+class ImportEventsTest(LoggedInTest):
+    def _import(self, content, suffix, **options):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix) as source:
+            source.write(content)
+            source.flush()
+            out = StringIO()
+            call_command('import_events', source.name, stdout=out,
+                         stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def _get_titles(self):
+        client = views._get_redis_client()
+        events, _ = event_cache.get_page(client, None, 10, self.user.id)
+        return [e['fields']['title'] for e in events]
+
+    def test_import_csv(self):
+        """Check events are imported in batches and cached"""
+        out = self._import(
+            'title,description,date,creator\n'
+            'first,desc,2020-07-30 19:30,user\n'
+            'second,desc,2020-07-31 19:30,user2\n'
+            'third,desc,2020-08-01 19:30,\n',
+            '.csv', creator='user', batch_size=2
+        )
+        self.assertIn('Imported 3 events', out)
+        events = Event.objects.order_by('date')
+        self.assertEqual(
+            [('first', self.user.id), ('second', self.user2.id),
+             ('third', self.user.id)],
+            [(e.title, e.creator_id) for e in events]
+        )
+        self.assertEqual(['first', 'second', 'third'], self._get_titles())
+
+    def test_import_json_lines(self):
+        """Check events can be imported from JSON lines"""
+        self._import(
+            dumps({'title': 'first', 'description': 'desc',
+                   'date': '2020-07-30T19:30:00Z', 'creator': 'user2'}) +
+            '\n\n',
+            '.jsonl'
+        )
+        event = Event.objects.get()
+        self.assertEqual(self.user2.id, event.creator_id)
+        self.assertEqual(['first'], self._get_titles())
+
+    def test_import_invalid(self):
+        """Check the import stops at the first invalid record"""
+        with self.assertRaisesRegex(CommandError, 'Line 3.*1 events'):
+            self._import(
+                'title,description,date\n'
+                'first,desc,2020-07-30 19:30\n'
+                'second,desc,not a date\n',
+                '.csv', creator='user', batch_size=1
+            )
+        with self.assertRaisesRegex(CommandError, 'unknown creator'):
+            self._import(
+                'title,description,date\nfirst,desc,2020-07-30 19:30\n',
+                '.csv'
+            )
+        self.assertEqual(['first'], self._get_titles())
+
+    @mock.patch('events_users.event_cache.store_events')
+    def test_import_invalidates(self, store_events):
+        """Check an import which did not reach Redis invalidates the cache"""
+        store_events.side_effect = redis.ConnectionError('oh no')
+        self._import(
+            'title,description,date\nfirst,desc,2020-07-30 19:30\n',
+            '.csv', creator='user'
+        )
+        client = views._get_redis_client()
+        self.assertFalse(client.exists(event_cache.GENERATION_KEY))
+
+
+class SingleFlightTest(LoggedInTest):
+    def _get_page(self):
+        return views._get_all_events(self.user.id)
+
+    def test_coalesce_with_redis(self):
+        """Check Postgres is queried once for a stale cache"""
+        self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        with mock.patch('events_users.views._get_events_page_from_db',
+                        wraps=views._get_events_page_from_db) as from_db:
+            first, _ = self._get_page()
+            second, _ = self._get_page()
+            from_db.assert_called_once_with(None, 50, None, None)
+        self.assertEqual(first, second)
+        self.assertEqual('title', second[0]['fields']['title'])
+        self.assertTrue(client.keys('events:fallback:*'))
+
+    def test_serve_stale_with_redis(self):
+        """Check a stale page is served while another request computes it"""
+        self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        self._get_page()
+        key = client.keys('events:fallback:*')[0]
+        entry = loads(client.get(key))
+        entry['at'] -= 10
+        client.set(key, dumps(entry))
+        client.set(key + b':lock', 1)
+        stale = singleflight.stats['stale']
+        with mock.patch('events_users.views._get_events_page_from_db') as db:
+            events, _ = self._get_page()
+            db.assert_not_called()
+        self.assertEqual('title', events[0]['fields']['title'])
+        self.assertEqual(stale + 1, singleflight.stats['stale'])
+
+    def test_expired_lock_kept(self):
+        """Check a request whose lock expired while computing does not
+        release the lock another request took since.
+        """
+        client = views._get_redis_client()
+
+        def compute():
+            client.set('key:lock', 'other')
+            return 'value'
+
+        self.assertEqual(
+            'value', singleflight.get(client, 'key', compute, 2, 30, 1, 10)
+        )
+        self.assertEqual(b'other', client.get('key:lock'))
+
+    def test_lock_outlives_wait(self):
+        """Check the lock is held while computing for longer than other
+        requests wait for it.
+        """
+        client = views._get_redis_client()
+        ttls = []
+
+        def compute():
+            ttls.append(client.pttl('key:lock'))
+            return 'value'
+
+        singleflight.get(client, 'key', compute, 2, 30, 1, 10)
+        self.assertGreater(ttls[0], 1000)
+
+    def test_timeout(self):
+        """Check requests give up instead of computing the value when
+        another request takes too long.
+        """
+        client = views._get_redis_client()
+        client.set('key:lock', 'other')
+        compute = mock.Mock(return_value='value')
+        timeout = singleflight.stats['timeout']
+        with self.assertRaises(singleflight.Busy):
+            singleflight.get(client, 'key', compute, 2, 30, 0.1, 10)
+        compute.assert_not_called()
+        self.assertEqual(timeout + 1, singleflight.stats['timeout'])
+
+    def test_busy_view(self):
+        """Check the views answer 503 while Postgres is busy computing
+        their page for another request.
+        """
+        with mock.patch('events_users.singleflight.get') as get:
+            get.side_effect = singleflight.Busy()
+            client = views._get_redis_client()
+            client.delete(event_cache.GENERATION_KEY)
+            for name in ('home', 'api_events'):
+                response = self.client.get(reverse(name))
+                self.assertEqual(503, response.status_code)
+                self.assertEqual('1', response['Retry-After'])
+
+    def test_coalesce_in_process(self):
+        """Check concurrent requests compute a value once without Redis"""
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def compute():
+            started.set()
+            release.wait(1)
+            return 'value'
+
+        def get():
+            results.append(
+                singleflight.get(None, 'key', compute, 2, 30, 1, 10)
+            )
+
+        computing = threading.Thread(target=get)
+        computing.start()
+        started.wait(1)
+        waiting = [threading.Thread(target=get) for _ in range(3)]
+        for thread in waiting:
+            thread.start()
+        release.set()
+        for thread in [computing] + waiting:
+            thread.join()
+        self.assertEqual(['value'] * 4, results)
+        self.assertEqual('value', singleflight.get(
+            None, 'key', mock.Mock(side_effect=Exception), 2, 30, 1, 10
+        ))
+
+
+class ExportTest(LoggedInTest):
+    """Streamed export of all the live events"""
+
+    def setUp(self):
+        """Create a few events in the cache, one of them joined"""
+        super().setUp()
+        for day in (3, 1, 2):
+            Event.objects.create(
+                title='event {}'.format(day), description='desc',
+                date=datetime(2030, 1, day, tzinfo=timezone.utc),
+                creator=self.user
+            )
+        Event.objects.get(title='event 2').users.add(self.user)
+        self._rebuild_cache()
+
+    def _export(self, export_format):
+        response = self.client.get(
+            reverse('export_events'), {'format': export_format}
+        )
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def _export_ndjson(self):
+        return [loads(line) for line in self._export('ndjson').splitlines()]
+
+    @override_settings(EVENTS_EXPORT_BATCH_SIZE=2)
+    def test_ndjson(self):
+        """Check events are exported in date order, in batches"""
+        with mock.patch('events_users.event_cache.read_events',
+                        wraps=event_cache.read_events) as read_events:
+            events = self._export_ndjson()
+        self.assertEqual(2, read_events.call_count)
+        self.assertEqual(
+            ['event 1', 'event 2', 'event 3'], [e['title'] for e in events]
+        )
+        self.assertEqual([False, True, False], [e['joined'] for e in events])
+        self.assertEqual(0, events[0]['attendees'])
+        self.assertEqual(1, events[1]['attendees'])
+
+    @override_settings(EVENTS_EXPORT_BATCH_SIZE=2)
+    def test_stale_cache(self):
+        """Check events are read from Postgres when the cache cannot be
+        trusted, from where the cache stopped.
+        """
+        from_redis = self._export_ndjson()
+        calls = []
+
+        def read_events(*args):
+            calls.append(args)
+            if len(calls) > 1:
+                raise event_cache.StaleCache()
+            return event_cache.read_events(*args)
+
+        with mock.patch('events_users.views.event_cache.read_events',
+                        read_events):
+            self.assertEqual(from_redis, self._export_ndjson())
+        views._get_redis_client().delete(event_cache.GENERATION_KEY)
+        self.assertEqual(from_redis, self._export_ndjson())
+
+    def test_csv(self):
+        """Check the CSV export has a header and a row per event"""
+        rows = self._export('csv').splitlines()
+        self.assertEqual(','.join(views.EXPORT_COLUMNS), rows[0])
+        self.assertEqual(4, len(rows))
+        self.assertIn('event 2', rows[2])
+
+    def test_html(self):
+        """Check the HTML export renders the event list"""
+        html = self._export('html')
+        self.assertTrue(html.startswith('<!DOCTYPE html>'))
+        self.assertLess(html.index('event 1'), html.index('event 3'))
+        self.assertIn('Withdraw from event', html)
+        self.assertTrue(html.rstrip().endswith('</html>'))
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse('export_events'), {'format': 'x'})
+        self.assertEqual(400, response.status_code)
+
+
+class ApiEventsTest(LoggedInTest):
+    def test_api_events(self):
+        """Check the events are returned as JSON"""
+        _, event = self._create_event()
+        self.client.post(reverse('join_event', args=[event.id]))
+        response = self.client.get(reverse('api_events'))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertEqual({
+            'events': [{
+                'id': event.id,
+                'title': 'title',
+                'description': 'desc',
+                'date': '2020-07-30T19:30:00Z',
+                'creator': self.user.id,
+                'creator_name': 'mail',
+                'capacity': None,
+                'attendees': 1,
+                'joined': True,
+                'waitlisted': False,
+            }],
+            'next': None,
+        }, response.json())
+
+    def test_api_events_not_modified(self):
+        """Check polling clients get a 304 until an event changes"""
+        _, event = self._create_event()
+        etag = self.client.get(reverse('api_events'))['ETag']
+        with mock.patch('events_users.views._get_all_events') as get_all:
+            response = self.client.get(
+                reverse('api_events'), HTTP_IF_NONE_MATCH=etag
+            )
+            self.assertEqual(304, response.status_code)
+            get_all.assert_not_called()
+        self.client.post(reverse('join_event', args=[event.id]))
+        response = self.client.get(
+            reverse('api_events'), HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_api_events_etag_per_user(self):
+        """Check users do not share ETags, as the joined flag differs"""
+        self._create_event()
+        etag = self.client.get(reverse('api_events'))['ETag']
+        self._log_in_as_another_user()
+        response = self.client.get(
+            reverse('api_events'), HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(200, response.status_code)
+
+    @mock.patch('events_users.views._get_redis_client')
+    def test_api_events_fallback(self, client):
+        """Check events are returned without ETag if Redis is down"""
+        self._create_event()
+        client.side_effect = Exception('oh no')
+        response = self.client.get(reverse('api_events'))
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEqual(1, len(response.json()['events']))
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTest(LoggedInTest):
+    def tearDown(self):
+        super().tearDown()
+        metrics.clear()
+
+    def _get_metrics(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(200, response.status_code)
+        return response.content.decode().splitlines()
+
+    def test_event_list(self):
+        """Check the hot path of the event list is measured"""
+        self._create_event()
+        self.client.get(reverse('home'))
+        lines = self._get_metrics()
+        self.assertIn('events_cache_lookups_total{result="hit"} 1.0', lines)
+        self.assertIn('events_local_pages_total{result="miss"} 1.0', lines)
+        for stage in ('get_all_events', 'redis', 'decode', 'render',
+                      'update_model'):
+            self.assertIn(
+                'events_stage_duration_seconds_count{{stage="{}"}} 1.0'
+                .format(stage), lines
+            )
+        # the session and the user are read from the database
+        self.assertIn('events_request_db_queries_sum{view="home"} 2.0', lines)
+        self.assertIn(
+            'events_request_redis_round_trips_count{view="home"} 1.0', lines
+        )
+
+    def test_fallback(self):
+        """Check requests served from Postgres are counted"""
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        self.client.get(reverse('home'))
+        lines = self._get_metrics()
+        self.assertIn('events_cache_lookups_total{result="miss"} 1.0', lines)
+        self.assertIn('events_fallback_total{outcome="computed"} 1.0', lines)
+        self.assertIn(
+            'events_stage_duration_seconds_count{stage="db_fallback"} 1.0',
+            lines
+        )
+
+    def test_histogram_format(self):
+        """Check histograms are written with cumulative buckets"""
+        histogram = metrics.Histogram('test_seconds', 'Test', [1, 2])
+        try:
+            histogram.observe(0.5, path='a"b')
+            histogram.observe(1.5, path='a"b')
+            histogram.observe(3, path='a"b')
+            self.assertEqual([
+                '# HELP test_seconds Test',
+                '# TYPE test_seconds histogram',
+                'test_seconds_bucket{path="a\\"b",le="1.0"} 1.0',
+                'test_seconds_bucket{path="a\\"b",le="2.0"} 2.0',
+                'test_seconds_bucket{path="a\\"b",le="+Inf"} 3.0',
+                'test_seconds_sum{path="a\\"b"} 5.0',
+                'test_seconds_count{path="a\\"b"} 3.0',
+            ], list(histogram.collect()))
+        finally:
+            metrics._registry.remove(histogram)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        """Check nothing is recorded nor exposed while disabled"""
+        self.client.get(reverse('home'))
+        self.assertEqual(404, self.client.get(reverse('metrics')).status_code)
+        self.assertNotIn('events_cache_lookups_total{', metrics.render())
+
+
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        """Create a breaker driven by a fake clock"""
+        self.now = 0
+        self.breaker = cache.CircuitBreaker(2, 10, clock=lambda: self.now)
+
+    def test_opens_after_failures(self):
+        """Check Redis is skipped after repeated failures"""
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(cache.CircuitBreaker.OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_cooldown(self):
+        """Check a single trial call is let through after the cooldown"""
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(cache.CircuitBreaker.HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(cache.CircuitBreaker.OPEN, self.breaker.state)
+        self.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(cache.CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+
+    def test_unfinished_trial(self):
+        """Check a new trial is let through when the last one never
+        reported its result.
+        """
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.now = 19
+        self.assertFalse(self.breaker.allow())
+        self.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(cache.CircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_status_view(self):
+        """Check the breaker state is exposed for monitoring"""
+        with mock.patch('events_users.cache.breaker', self.breaker):
+            response = self.client.get(reverse('cache_status'))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('closed', response.json()['state'])
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+            response = self.client.get(reverse('cache_status'))
+            self.assertEqual(503, response.status_code)
+            self.assertEqual('open', response.json()['state'])
+            self.assertEqual(10, response.json()['retry_in'])
 
 
 class SignUpTest(TestCase):
@@ -213,4 +1191,1167 @@ class EventJoinWithdraw(LoggedInTest):
         self.assertEqual(1, len(event.users.values()))
         self.client.post(reverse('withdraw_event', args=[event.id]))
         event = Event.objects.all()[0]
-        self.assertEqual(0, len(event.users.values()))
\ No newline at end of file
+        self.assertEqual(0, len(event.users.values()))
+
+    def _get_event_fields(self):
+        """Fields of the only event in the list"""
+        response = self.client.get(reverse('home'))
+        return response.context['events'][0]['fields']
+
+    def test_attendee_set(self):
+        """Check attendance is kept in the event attendee set"""
+        _, event = self._create_event()
+        client = views._get_redis_client()
+        key = event_cache.attendees_key(event.id)
+        self.client.post(reverse('join_event', args=[event.id]))
+        self.assertEqual({str(self.user.id).encode()}, client.smembers(key))
+        self.assertEqual(
+            {str(event.id).encode()},
+            client.smembers(event_cache.user_events_key(self.user.id))
+        )
+        fields = self._get_event_fields()
+        self.assertEqual(1, fields['attendees'])
+        self.assertTrue(fields['joined'])
+        self.assertEqual('mail', fields['creator_name'])
+        self._log_in_as_another_user()
+        self.client.post(reverse('join_event', args=[event.id]))
+        fields = self._get_event_fields()
+        self.assertEqual(2, fields['attendees'])
+        self.client.post(reverse('withdraw_event', args=[event.id]))
+        fields = self._get_event_fields()
+        self.assertEqual(1, fields['attendees'])
+        self.assertFalse(fields['joined'])
+        self.assertEqual('mail', fields['creator_name'])
+        self.assertFalse(
+            client.exists(event_cache.user_events_key(self.user2.id))
+        )
+
+    def test_local_page_cache(self):
+        """Check pages are kept in memory until an event changes"""
+        _, event = self._create_event()
+        self._get_event_fields()
+        with mock.patch('events_users.event_cache._read_page',
+                        wraps=event_cache._read_page) as read_page:
+            self.assertEqual(0, self._get_event_fields()['attendees'])
+            read_page.assert_not_called()
+            self.client.post(reverse('join_event', args=[event.id]))
+            self.assertEqual(1, self._get_event_fields()['attendees'])
+            self.assertEqual(1, read_page.call_count)
+
+    def test_flags_of_page_only(self):
+        """Check only the events of the page are looked up in the sets of
+        the user, whether the page is kept in memory or not.
+        """
+        _, event = self._create_event()
+        client = views._get_redis_client()
+        client.sadd(event_cache.user_events_key(self.user.id), *range(
+            event.id + 1, event.id + 1000
+        ))
+        self.client.post(reverse('join_event', args=[event.id]))
+        for _ in range(2):
+            with mock.patch.object(
+                    client.__class__, 'smembers',
+                    side_effect=AssertionError('smembers')):
+                self.assertTrue(self._get_event_fields()['joined'])
+        self._log_in_as_another_user()
+        self.assertFalse(self._get_event_fields()['joined'])
+
+    @mock.patch('events_users.views._get_redis_client')
+    def test_joined_fallback(self, client):
+        """Check the joined flag is right when Postgres is used"""
+        self._create_event()
+        self._create_event()
+        event, other_event = Event.objects.order_by('pk')
+        event.users.add(self.user)
+        other_event.users.add(self.user2)
+        client.side_effect = Exception('oh no')
+        response = self.client.get(reverse('home'))
+        joined = {
+            e['pk']: e['fields']['joined'] for e in response.context['events']
+        }
+        self.assertEqual({event.id: True, other_event.id: False}, joined)
+
+
+    def test_bulk_attendance(self):
+        """Check a user can join and withdraw from many events at once"""
+        for _ in range(3):
+            self._create_event()
+        pks = list(Event.objects.order_by('pk').values_list('pk', flat=True))
+        client = views._get_redis_client()
+        with self.settings(EVENTS_BULK_BATCH_SIZE=2):
+            response = self.client.post(
+                reverse('bulk_attendance'),
+                {'action': 'join', 'event': pks + [9001]}
+            )
+        self.assertEqual(
+            {'action': 'join', 'events': pks, 'waitlisted': []},
+            response.json()
+        )
+        self.assertEqual(
+            pks, sorted(self.user.event_attendees.values_list('pk', flat=True))
+        )
+        self.assertEqual(
+            {str(pk).encode() for pk in pks},
+            client.smembers(event_cache.user_events_key(self.user.id))
+        )
+        self.assertTrue(all(f['joined'] for f in self._get_all_fields()))
+        # joining again does nothing
+        self.client.post(
+            reverse('bulk_attendance'), {'action': 'join', 'event': pks}
+        )
+        self.assertEqual(3, self.user.event_attendees.count())
+        self.client.post(
+            reverse('bulk_attendance'),
+            {'action': 'withdraw', 'event': pks[:2]}
+        )
+        self.assertEqual(
+            [pks[2]],
+            list(self.user.event_attendees.values_list('pk', flat=True))
+        )
+        self.assertEqual(
+            [0, 0, 1], [f['attendees'] for f in self._get_all_fields()]
+        )
+
+    def test_bulk_attendance_invalid(self):
+        """Check invalid bulk attendance requests are rejected"""
+        url = reverse('bulk_attendance')
+        self.assertEqual(405, self.client.get(url).status_code)
+        response = self.client.post(url, {'action': 'leave', 'event': [1]})
+        self.assertEqual(400, response.status_code)
+        response = self.client.post(url, {'action': 'join', 'event': ['a']})
+        self.assertEqual(400, response.status_code)
+        with self.settings(EVENTS_BULK_MAX_EVENTS=1):
+            response = self.client.post(
+                url, {'action': 'join', 'event': [1, 2]}
+            )
+        self.assertEqual(400, response.status_code)
+
+    def _get_all_fields(self):
+        response = self.client.get(reverse('home'))
+        return [e['fields'] for e in response.context['events']]
+
+@override_settings(EVENTS_WRITE_BEHIND_ATTENDANCE=True)
+class WriteBehindAttendanceTest(LoggedInTest):
+    def _flush(self, **options):
+        out = StringIO()
+        call_command('flush_attendance', stdout=out, **options)
+        return out.getvalue()
+
+    def _get_fields(self):
+        response = self.client.get(reverse('home'))
+        return response.context['events'][0]['fields']
+
+    def test_join_withdraw(self):
+        """Check attendance is shown at once and saved when flushed"""
+        _, event = self._create_event()
+        self.client.post(reverse('join_event', args=[event.id]))
+        self.assertEqual(0, event.users.count())
+        fields = self._get_fields()
+        self.assertEqual(1, fields['attendees'])
+        self.assertTrue(fields['joined'])
+        self.assertIn('Flushed 1 ', self._flush())
+        self.assertEqual([self.user], list(event.users.all()))
+        client = views._get_redis_client()
+        self.assertEqual(
+            0, client.xlen(event_cache.ATTENDANCE_STREAM_KEY)
+        )
+        self.client.post(reverse('withdraw_event', args=[event.id]))
+        self.assertEqual(1, event.users.count())
+        self.assertFalse(self._get_fields()['joined'])
+        self._flush()
+        self.assertEqual(0, event.users.count())
+
+    def test_last_change_wins(self):
+        """Check only the last change of a user to an event is saved"""
+        self._create_event()
+        self._create_event()
+        event, other_event = Event.objects.order_by('pk')
+        for _ in range(2):
+            self.client.post(reverse('join_event', args=[event.id]))
+            self.client.post(reverse('withdraw_event', args=[event.id]))
+            self.client.post(reverse('join_event', args=[other_event.id]))
+        self._log_in_as_another_user()
+        self.client.post(reverse('join_event', args=[event.id]))
+        # joining an event again is not recorded
+        self.assertIn('Flushed 6 ', self._flush(batch_size=2))
+        self.assertEqual([self.user2], list(event.users.all()))
+        self.assertEqual([self.user], list(other_event.users.all()))
+
+    def test_recovery(self):
+        """Check changes which were not flushed are saved by the next
+        flush, and saving them twice is harmless.
+        """
+        _, event = self._create_event()
+        self.client.post(reverse('join_event', args=[event.id]))
+        with mock.patch('events_users.event_cache.delete_attendance') as \
+                delete:
+            delete.side_effect = redis.ConnectionError('oh no')
+            with self.assertRaises(CommandError):
+                self._flush()
+        self.assertEqual(1, event.users.count())
+        self.assertIn('Flushed 1 ', self._flush())
+        self.assertEqual(1, event.users.count())
+        self.assertIn('Flushed 0 ', self._flush())
+
+    def test_single_flusher(self):
+        """Check a single flush runs at a time"""
+        client = views._get_redis_client()
+        client.set(event_cache.ATTENDANCE_FLUSH_LOCK_KEY, 'other')
+        self.assertIn('already running', self._flush())
+
+    def test_lock_taken_over(self):
+        """Check a flusher whose lock expired stops, and leaves the lock
+        of the flusher which took it over.
+        """
+        _, event = self._create_event()
+        self.client.post(reverse('join_event', args=[event.id]))
+        client = views._get_redis_client()
+
+        def save_changes(changes, recount):
+            client.set(event_cache.ATTENDANCE_FLUSH_LOCK_KEY, 'other')
+            return []
+
+        err = StringIO()
+        with mock.patch('events_users.seats.save_changes', save_changes):
+            call_command('flush_attendance', stdout=StringIO(), stderr=err)
+        self.assertIn('Lost the lock', err.getvalue())
+        self.assertEqual(
+            b'other', client.get(event_cache.ATTENDANCE_FLUSH_LOCK_KEY)
+        )
+
+    def test_archived_event(self):
+        """Check archived events cannot be joined, even if they are
+        archived before the join is flushed.
+        """
+        self._create_event()
+        self._create_event()
+        event, other_event = Event.objects.order_by('pk')
+        self.client.post(reverse('join_event', args=[event.id]))
+        Event.objects.filter(pk=event.id).update(is_archived=True)
+        self._flush()
+        self.assertEqual(0, event.users.count())
+        call_command('archive_events', older_than=0, stdout=StringIO())
+        response = self.client.post(
+            reverse('join_event', args=[other_event.id])
+        )
+        self.assertEqual(404, response.status_code)
+
+    def test_stale_cache(self):
+        """Check attendance is saved right away if the cache is stale"""
+        _, event = self._create_event()
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        self.client.post(reverse('join_event', args=[event.id]))
+        self.assertEqual(1, event.users.count())
+        self.assertEqual(
+            0, client.xlen(event_cache.ATTENDANCE_STREAM_KEY)
+        )
+
+
+class CapacityTest(LoggedInTest):
+    def setUp(self):
+        super().setUp()
+        self.client.post(reverse('create_event'), {
+            'title': 'title', 'description': 'desc',
+            'date': '07/30/2020 19:30', 'capacity': 1,
+        })
+        self.event = Event.objects.get()
+        self.user3 = User.objects.create(username='user3', email='mail3')
+
+    def _join(self, user, name='join_event'):
+        client = Client()
+        client.force_login(user)
+        client.post(reverse(name, args=[self.event.id]))
+
+    def _get_fields(self, user):
+        client = Client()
+        client.force_login(user)
+        response = client.get(reverse('home'))
+        return response.context['events'][0]['fields']
+
+    def _check_seats(self, attendees, waitlist):
+        """Check the attendees and waitlist both in Postgres and Redis"""
+        self.assertEqual(
+            {user.id for user in attendees},
+            set(self.event.users.values_list('pk', flat=True))
+        )
+        self.assertEqual(
+            [user.id for user in waitlist],
+            list(self.event.waitlist.order_by('created', 'id')
+                 .values_list('user_id', flat=True))
+        )
+        client = views._get_redis_client()
+        self.assertEqual(
+            {str(user.id).encode() for user in attendees},
+            client.smembers(event_cache.attendees_key(self.event.id))
+        )
+        self.assertEqual(
+            [str(user.id).encode() for user in waitlist],
+            client.zrange(event_cache.waitlist_key(self.event.id), 0, -1)
+        )
+
+    def test_waitlist(self):
+        """Check users join the waitlist of a full event, and get the seats
+        which are freed in order.
+        """
+        self._join(self.user)
+        self._join(self.user2)
+        self._join(self.user3)
+        self._check_seats([self.user], [self.user2, self.user3])
+        fields = self._get_fields(self.user2)
+        self.assertEqual((1, 1), (fields['attendees'], fields['capacity']))
+        self.assertTrue(fields['waitlisted'])
+        self.assertFalse(fields['joined'])
+        self._join(self.user, 'withdraw_event')
+        self._check_seats([self.user2], [self.user3])
+        self.assertTrue(self._get_fields(self.user2)['joined'])
+        self._join(self.user3, 'withdraw_event')
+        self._check_seats([self.user2], [])
+
+    def test_waitlist_fallback(self):
+        """Check seats are reserved in Postgres when the cache is stale"""
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        self._join(self.user)
+        self._join(self.user2)
+        self._join(self.user3)
+        self.assertEqual([self.user], list(self.event.users.all()))
+        self._join(self.user, 'withdraw_event')
+        self.assertEqual([self.user2], list(self.event.users.all()))
+        self.assertEqual(
+            [self.user3.id],
+            [entry.user_id for entry in self.event.waitlist.all()]
+        )
+        # the rebuild takes the attendees and the waitlist from Postgres
+        self._rebuild_cache()
+        self._check_seats([self.user2], [self.user3])
+        self.assertTrue(self._get_fields(self.user3)['waitlisted'])
+
+    def test_capacity_increased(self):
+        """Check the waitlist gets the new seats of an event"""
+        self._join(self.user)
+        self._join(self.user2)
+        self._join(self.user3)
+        self.client.post(reverse('edit_event', args=[self.event.id]), {
+            'title': 'title', 'description': 'desc',
+            'date': '07/30/2020 19:30', 'capacity': 2,
+        })
+        self._check_seats([self.user, self.user2], [self.user3])
+        self.client.post(reverse('edit_event', args=[self.event.id]), {
+            'title': 'title', 'description': 'desc',
+            'date': '07/30/2020 19:30',
+        })
+        self._check_seats([self.user, self.user2, self.user3], [])
+
+    def test_edit_keeps_seats(self):
+        """Check seats are only given away when the capacity changes"""
+        with mock.patch('events_users.seats.withdraw') as withdraw:
+            self.client.post(reverse('edit_event', args=[self.event.id]), {
+                'title': 'other title', 'description': 'desc',
+                'date': '07/30/2020 19:30', 'capacity': 1,
+            })
+            withdraw.assert_not_called()
+        self.assertEqual('other title', Event.objects.get().title)
+
+    def test_no_overbooking(self):
+        """Check concurrent reservations never take more seats than the
+        capacity of the event.
+        """
+        client = views._get_redis_client()
+        client.hset(event_cache.CAPACITY_KEY, self.event.id, 5)
+        results = []
+
+        def reserve(user_ids):
+            client = cache.get_client()
+            for user_id in user_ids:
+                results.append(event_cache.reserve_seat(
+                    client, self.event.id, user_id
+                ))
+
+        threads = [
+            threading.Thread(target=reserve, args=(range(100 + i, 120, 5),))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(5, results.count(event_cache.JOINED))
+        self.assertEqual(15, results.count(event_cache.WAITLISTED))
+        self.assertEqual(
+            5, client.scard(event_cache.attendees_key(self.event.id))
+        )
+
+    @override_settings(EVENTS_WRITE_BEHIND_ATTENDANCE=True)
+    def test_write_behind(self):
+        """Check the waitlist is saved by flush_attendance"""
+        self._join(self.user)
+        self._join(self.user2)
+        self.assertEqual(0, self.event.users.count())
+        call_command('flush_attendance', stdout=StringIO())
+        self._check_seats([self.user], [self.user2])
+        self._join(self.user, 'withdraw_event')
+        call_command('flush_attendance', stdout=StringIO())
+        self._check_seats([self.user2], [])
+
+    @override_settings(EVENTS_WRITE_BEHIND_ATTENDANCE=True)
+    def test_write_behind_no_overbooking(self):
+        """Check seats reserved in Postgres while the cache is stale
+        account for the joins waiting to be flushed.
+        """
+        self._join(self.user)
+        client = views._get_redis_client()
+        client.delete(event_cache.GENERATION_KEY)
+        self._join(self.user2)
+        out = StringIO()
+        call_command('flush_attendance', stdout=out)
+        self.assertNotIn('Moved', out.getvalue())
+        self.assertFalse(client.exists(event_cache.ATTENDANCE_JOINS_KEY))
+        self._rebuild_cache()
+        self._check_seats([self.user], [self.user2])
+
+    @override_settings(EVENTS_WRITE_BEHIND_ATTENDANCE=True)
+    def test_write_behind_moved_to_waitlist(self):
+        """Check joins which no longer fit when they are flushed go to
+        the waitlist, both in Postgres and in the cache.
+        """
+        self._join(self.user)
+        self.event.users.add(self.user3)
+        out = StringIO()
+        call_command('flush_attendance', stdout=out)
+        self.assertIn('Moved 1 joins', out.getvalue())
+        self.assertEqual([self.user3], list(self.event.users.all()))
+        self.assertEqual(
+            [self.user.id],
+            [entry.user_id for entry in self.event.waitlist.all()]
+        )
+        fields = self._get_fields(self.user)
+        self.assertEqual(0, fields['attendees'])
+        self.assertTrue(fields['waitlisted'])
+        self.assertFalse(fields['joined'])
+
+    def test_reservation_trusted(self):
+        """Check seats reserved in Redis are saved without counting them
+        again in Postgres.
+        """
+        with mock.patch('events_users.seats._over_capacity') as recount:
+            self._join(self.user)
+            self._join(self.user2)
+            recount.assert_not_called()
+        self._check_seats([self.user], [self.user2])
+
+    def test_archive(self):
+        """Check archived events lose their waitlist"""
+        self._join(self.user)
+        self._join(self.user2)
+        call_command('archive_events', stdout=StringIO())
+        self.assertFalse(WaitlistEntry.objects.exists())
+        client = views._get_redis_client()
+        self.assertFalse(client.exists(
+            event_cache.waitlist_key(self.event.id),
+            event_cache.user_waitlist_key(self.user2.id),
+        ))
+        self.assertFalse(
+            client.hexists(event_cache.CAPACITY_KEY, self.event.id)
+        )
+
+
+class SearchTest(LoggedInTest):
+    def setUp(self):
+        super().setUp()
+        for title, description, date in [
+            ('Jazz night', 'Live music downtown', '07/30/2020 19:30'),
+            ('Book club', 'Talking about jazz age novels', '07/28/2020 19:30'),
+            ('Football', 'Watching the final', '07/29/2020 19:30'),
+        ]:
+            self.client.post(reverse('create_event'), {
+                'title': title, 'description': description, 'date': date,
+            })
+
+    def _search(self, **params):
+        response = self.client.get(reverse('api_search'), params)
+        self.assertEqual(200, response.status_code)
+        return [e['title'] for e in response.json()['events']], \
+            response.json()['next']
+
+    def test_search(self):
+        """Check events are ranked by where the words match"""
+        self.assertEqual((['Jazz night', 'Book club'], None),
+                         self._search(q='JAZZ'))
+        self.assertEqual((['Jazz night'], None),
+                         self._search(q='jazz  music'))
+        self.assertEqual(([], None), self._search(q='tennis'))
+
+    def test_pagination(self):
+        """Check results are paginated"""
+        with self.settings(EVENTS_PAGE_SIZE=1):
+            self.assertEqual((['Jazz night'], 2), self._search(q='jazz'))
+            self.assertEqual((['Book club'], None),
+                             self._search(q='jazz', page=2))
+
+    def test_cache(self):
+        """Check popular queries are served from the cache, with the
+        joined flag of each user.
+        """
+        self._search(q='jazz')
+        event = Event.objects.get(title='Jazz night')
+        event.users.add(self.user)
+        with mock.patch('events_users.search.search_page') as search_page:
+            response = self.client.get(reverse('api_search'), {'q': 'Jazz'})
+            search_page.assert_not_called()
+        self.assertEqual(
+            [True, False], [e['joined'] for e in response.json()['events']]
+        )
+
+    def test_archived(self):
+        """Check archived events are not found"""
+        call_command('archive_events', stdout=StringIO())
+        self.assertEqual(([], None), self._search(q='jazz'))
+
+    def test_reports_to_breaker(self):
+        """Check a search failing to reach Redis reports it to the
+        circuit breaker, and still answers from Postgres.
+        """
+        breaker = cache.CircuitBreaker(2, 30)
+        with mock.patch('events_users.cache.breaker', breaker):
+            with self._redis_down():
+                self.assertEqual((['Jazz night', 'Book club'], None),
+                                 self._search(q='jazz'))
+                self.assertEqual((['Jazz night'], None),
+                                 self._search(q='music'))
+            self.assertEqual(cache.CircuitBreaker.OPEN, breaker.state)
+
+    def test_invalid(self):
+        """Check invalid queries are rejected"""
+        url = reverse('api_search')
+        self.assertEqual(400, self.client.get(url).status_code)
+        self.assertEqual(400, self.client.get(url, {'q': ' '}).status_code)
+        self.assertEqual(
+            400, self.client.get(url, {'q': 'a' * 201}).status_code
+        )
+        self.assertEqual(
+            400, self.client.get(url, {'q': 'a', 'page': 21}).status_code
+        )
+
+
+class UserListsTest(LoggedInTest):
+    def setUp(self):
+        super().setUp()
+        for title in ('first', 'second'):
+            self.client.post(reverse('create_event'), {
+                'title': title, 'description': 'desc',
+                'date': '07/30/2020 19:30',
+            })
+        self._log_in_as_another_user()
+        self.client.post(reverse('create_event'), {
+            'title': 'other', 'description': 'desc',
+            'date': '07/29/2020 19:30',
+        })
+        self.other = Event.objects.get(title='other')
+        self.client.post(reverse('join_event', args=[self.other.id]))
+        self.client.logout()
+        self.client.login(username='user', password='p')
+
+    def _get_titles(self, user_list):
+        response = self.client.get(reverse('api_user_events'),
+                                   {'list': user_list})
+        return [e['title'] for e in response.json()['events']]
+
+    def test_lists(self):
+        """Check the events a user attends or created are listed"""
+        self.assertEqual([], self._get_titles('attending'))
+        self.assertEqual(['first', 'second'], self._get_titles('created'))
+        self.client.post(reverse('join_event', args=[self.other.id]))
+        response = self.client.get(reverse('user_events'))
+        events = response.context['events']
+        self.assertEqual(['other'], [e['fields']['title'] for e in events])
+        self.assertEqual(2, events[0]['fields']['attendees'])
+        self.assertTrue(events[0]['fields']['joined'])
+        with self.settings(EVENTS_PAGE_SIZE=1):
+            response = self.client.get(reverse('user_events'),
+                                       {'list': 'created'})
+            self.assertIn(b'?list=created&after=', response.content)
+
+    def test_cache(self):
+        """Check lists are cached until the events of the user change"""
+        self._get_titles('attending')
+        self._get_titles('created')
+        with mock.patch('events_users.views._get_user_list_page_from_db',
+                        wraps=views._get_user_list_page_from_db) as db:
+            self.assertEqual([], self._get_titles('attending'))
+            db.assert_not_called()
+            self.client.post(reverse('join_event', args=[self.other.id]))
+            self.assertEqual(['other'], self._get_titles('attending'))
+            self.assertEqual(1, db.call_count)
+            # edited by its creator
+            self._log_in_as_another_user()
+            self.client.post(reverse('edit_event', args=[self.other.id]), {
+                'title': 'edited', 'description': 'desc',
+                'date': '07/29/2020 19:30',
+            })
+            self.client.logout()
+            self.client.login(username='user', password='p')
+            self.assertEqual(['edited'], self._get_titles('attending'))
+            self.client.post(reverse('withdraw_event', args=[self.other.id]))
+            self.assertEqual([], self._get_titles('attending'))
+            self.assertEqual(['first', 'second'],
+                             self._get_titles('created'))
+            self.assertEqual(4, db.call_count)
+
+    def test_invalidated_while_computed(self):
+        """Check a page computed before an invalidation is not cached"""
+        client = views._get_redis_client()
+        page, version = event_cache.get_user_list_page(
+            client, self.user.id, 'field'
+        )
+        self.assertIsNone(page)
+        event_cache.invalidate_user_lists(client, [self.user.id])
+        event_cache.cache_user_list_page(
+            client, self.user.id, 'field', version, [[], None]
+        )
+        page, _ = event_cache.get_user_list_page(
+            client, self.user.id, 'field'
+        )
+        self.assertIsNone(page)
+
+    def test_archived(self):
+        """Check archived events leave the lists"""
+        self.assertEqual(['first', 'second'], self._get_titles('created'))
+        call_command('archive_events', stdout=StringIO())
+        self.assertEqual([], self._get_titles('created'))
+
+
+class FragmentTest(LoggedInTest):
+    """Markup of the events rendered once and reused by all the users"""
+
+    def _get_rows(self):
+        """Markup of the events in the list"""
+        response = self.client.get(reverse('home'))
+        return response.context['rows']
+
+    def test_markup_shared_by_users(self):
+        """Check the markup of an event is only rendered once"""
+        _, event = self._create_event()
+        self.client.post(reverse('join_event', args=[event.id]))
+        rows = self._get_rows()
+        self.assertIn('Edit event', rows)
+        self.assertIn('Withdraw from event', rows)
+        self._log_in_as_another_user()
+        with mock.patch('events_users.fragments.render_to_string',
+                        wraps=fragments.render_to_string) as render:
+            rows = self._get_rows()
+            self._get_rows()
+        # only the controls of the other user were rendered
+        render.assert_called_once()
+        self.assertEqual(
+            'event/event_controls.html', render.call_args[0][0]
+        )
+        self.assertNotIn('Edit event', rows)
+        self.assertIn('Join event', rows)
+
+    def test_new_version_rendered(self):
+        """Check edits and attendee counts show up in the markup"""
+        _, event = self._create_event()
+        self.assertIn('<span class="attendees">0</span>', self._get_rows())
+        self._log_in_as_another_user()
+        self.client.post(reverse('join_event', args=[event.id]))
+        self.assertIn('<span class="attendees">1</span>', self._get_rows())
+        self.client.logout()
+        self.client.login(username='user', password='p')
+        self.event_data['title'] = 'new title'
+        self.client.post(
+            reverse('edit_event', args=[event.id]), self.event_data
+        )
+        rows = self._get_rows()
+        self.assertIn('new title', rows)
+        self.assertIn('<span class="attendees">1</span>', rows)
+
+    def test_markup_escaped(self):
+        """Check the fields of the events are escaped"""
+        self.event_data = {
+            'title': '<b>title</b>',
+            'description': 'desc',
+            'date': '07/30/2020 19:30'
+        }
+        self.client.post(reverse('create_event'), self.event_data)
+        rows = self._get_rows()
+        self.assertIn('&lt;b&gt;title&lt;/b&gt;', rows)
+        self.assertNotIn('<b>', rows)
+
+    def test_past_events_without_controls(self):
+        """Check past events have no controls"""
+        self._create_event()
+        response = self.client.get(reverse('home') + '?window=past')
+        self.assertIn('title', response.context['rows'])
+        self.assertNotIn('Join event', response.context['rows'])
+
+
+@override_settings(
+    SESSION_ENGINE='events_users.sessions',
+    AUTHENTICATION_BACKENDS=['events_users.user_cache.CachedModelBackend'],
+)
+class ProductionProfileTest(LoggedInTest):
+    """Sessions and users read from Redis by the production profile"""
+
+    def tearDown(self):
+        sessions._pending_deletes.clear()
+        super().tearDown()
+
+    def _open_breaker(self):
+        breaker = cache.CircuitBreaker(1, 30)
+        breaker.record_failure()
+        return mock.patch('events_users.cache.breaker', breaker)
+
+    def _auth_queries(self):
+        """Queries of the session and user tables made by the event list"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(200, response.status_code)
+        return [
+            query['sql'] for query in queries.captured_queries
+            if 'FROM "django_session"' in query['sql'] or
+            'FROM "auth_user"' in query['sql']
+        ]
+
+    def test_no_session_or_user_queries(self):
+        """Check the event list reads the session and user from Redis"""
+        self.client.get(reverse('home'))
+        self.assertEqual([], self._auth_queries())
+        client = cache.get_client()
+        self.assertTrue(client.exists(
+            sessions.KEY_PREFIX + self.client.session.session_key
+        ))
+        self.assertTrue(client.exists(user_cache.user_key(self.user.id)))
+
+    def test_redis_unavailable(self):
+        """Check sessions and users are read from Postgres without Redis"""
+        with self._open_breaker():
+            self.assertEqual(2, len(self._auth_queries()))
+
+    def test_logout_without_redis(self):
+        """Check a session deleted while Redis is unreachable is not read
+        back from it later on.
+        """
+        self.client.get(reverse('home'))
+        session_key = self.client.session.session_key
+        with self._open_breaker():
+            self.client.logout()
+        self.client.cookies['sessionid'] = session_key
+        response = self.client.get(reverse('home'))
+        self.assertEqual(302, response.status_code)
+        self.assertFalse(cache.get_client().exists(
+            sessions.KEY_PREFIX + session_key
+        ))
+
+    def test_session_ttl(self):
+        """Check sessions are kept in Redis for a short time only, as
+        other processes may read logged out ones until they expire.
+        """
+        self.client.get(reverse('home'))
+        ttl = cache.get_client().ttl(
+            sessions.KEY_PREFIX + self.client.session.session_key
+        )
+        self.assertTrue(0 < ttl <= settings.EVENTS_SESSION_CACHE_TTL)
+
+    def test_saved_user_is_reloaded(self):
+        """Check changes to a user are seen by the next request"""
+        self.client.get(reverse('home'))
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(reverse('home'))
+        self.assertEqual(302, response.status_code)
+
+    def test_cached_user(self):
+        """Check a user read from Redis matches the one in Postgres"""
+        backend = user_cache.CachedModelBackend()
+        user = User.objects.get(pk=self.user.id)
+        backend.get_user(self.user.id)
+        with self.assertNumQueries(0):
+            cached = backend.get_user(self.user.id)
+        self.assertEqual(user.pk, cached.pk)
+        self.assertEqual(user.password, cached.password)
+        self.assertEqual(user.last_login, cached.last_login)
+        self.assertEqual(user.date_joined, cached.date_joined)
+        self.assertFalse(cached._state.adding)
+
+
+@override_settings(EVENTS_READ_REPLICAS=['replica'])
+class ReplicaRouterTest(LoggedInTest):
+    """Reads of events sent to the read replicas"""
+
+    databases = {'default', 'replica'}
+
+    def _request(self, request, write=False):
+        """Run a request through the middleware.
+
+        :return: databases events were read from, and the response.
+        """
+        reads = []
+
+        def get_response(request):
+            reads.append(router.db_for_read(Event))
+            if write:
+                router.db_for_write(Event)
+                reads.append(router.db_for_read(Event))
+            return HttpResponse()
+
+        response = db_router.replica_middleware(get_response)(request)
+        return reads, response
+
+    def test_get_reads_from_replica(self):
+        """Check GET requests read events from the replicas only"""
+        reads, response = self._request(RequestFactory().get('/'))
+        self.assertEqual(['replica'], reads)
+        self.assertNotIn(db_router.STICKY_COOKIE, response.cookies)
+        self.assertEqual('default', router.db_for_read(Event))
+
+    def test_primary(self):
+        """Check other requests, users and writes use the primary"""
+        reads, _ = self._request(RequestFactory().post('/'))
+        self.assertEqual(['default'], reads)
+        self.assertEqual('default', router.db_for_write(Event))
+
+        def get_response(request):
+            reads.append(router.db_for_read(User))
+            return HttpResponse()
+
+        db_router.replica_middleware(get_response)(RequestFactory().get('/'))
+        self.assertEqual(['default', 'default'], reads)
+
+    def test_read_your_writes(self):
+        """Check clients read from the primary for a while after writing"""
+        reads, response = self._request(RequestFactory().get('/'), True)
+        self.assertEqual(['replica', 'default'], reads)
+        cookie = response.cookies[db_router.STICKY_COOKIE].value
+        request = RequestFactory().get('/')
+        request.COOKIES[db_router.STICKY_COOKIE] = cookie
+        self.assertEqual(['default'], self._request(request)[0])
+        later = time.time() + settings.EVENTS_REPLICA_STICKY_SECONDS + 1
+        with mock.patch('django.core.signing.time.time',
+                        return_value=later):
+            self.assertEqual(['replica'], self._request(request)[0])
+        request.COOKIES[db_router.STICKY_COOKIE] = 'forged'
+        self.assertEqual(['replica'], self._request(request)[0])
+
+    def test_streamed_response(self):
+        """Check streamed content is read from the replicas too"""
+        reads = []
+
+        def content():
+            reads.append(router.db_for_read(Event))
+            yield b''
+
+        response = db_router.replica_middleware(
+            lambda request: StreamingHttpResponse(content())
+        )(RequestFactory().get('/'))
+        b''.join(response.streaming_content)
+        self.assertEqual(['replica'], reads)
+
+    def _export_titles(self):
+        """Titles of the events exported from the database"""
+        views._get_redis_client().delete(event_cache.GENERATION_KEY)
+        response = self.client.get(reverse('export_events'))
+        return [loads(line)['title'] for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_read_from_replica(self):
+        """Check events are read from the replica by GET requests, and
+        from the primary by the client after it changed one.
+        """
+        User.objects.using('replica').create(
+            pk=self.user.pk, username='user', email='mail'
+        )
+        Event.objects.using('replica').create(
+            title='replicated', description='desc',
+            date=datetime(2030, 1, 1, tzinfo=timezone.utc),
+            creator_id=self.user.pk
+        )
+        self.assertEqual(['replicated'], self._export_titles())
+        self.assertEqual(0, Event.objects.count())
+        self._create_event()
+        self.assertEqual(['title'], self._export_titles())
+        self.client.cookies.pop(db_router.STICKY_COOKIE)
+        self.assertEqual(['replicated'], self._export_titles())
+
+    def test_join_uses_primary(self):
+        """Check joining an event reads it from the primary and makes
+        the client stick to it.
+        """
+        _, event = self._create_event()
+        response = self.client.get(reverse('join_event', args=[event.id]))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, event.users.count())
+        self.assertIn(db_router.STICKY_COOKIE, response.cookies)
+
+
+class ChangesTest(LoggedInTest):
+    """Changes of events published on the changes channel"""
+
+    def setUp(self):
+        super().setUp()
+        self.pubsub = cache.get_client().pubsub()
+        self.pubsub.subscribe(event_cache.CHANGES_CHANNEL)
+        self.pubsub.get_message(timeout=0.2)
+
+    def tearDown(self):
+        self.pubsub.close()
+        super().tearDown()
+
+    def _get_changes(self):
+        changes = []
+        while True:
+            message = self.pubsub.get_message(timeout=0.2)
+            if message is None:
+                return changes
+            changes.append(loads(message['data']))
+
+    def test_event_changes(self):
+        """Check created and edited events are published"""
+        _, event = self._create_event()
+        self.event_data['title'] = 'new title'
+        self.client.post(
+            reverse('edit_event', args=[event.id]), self.event_data
+        )
+        changes = self._get_changes()
+        self.assertEqual(['event', 'event'], [c['type'] for c in changes])
+        self.assertEqual(event.id, changes[0]['id'])
+        self.assertEqual('title', changes[0]['event']['title'])
+        self.assertEqual('new title', changes[1]['event']['title'])
+
+    def test_attendance_changes(self):
+        """Check the attendees of events are published as they change"""
+        _, event = self._create_event()
+        self._get_changes()
+        self.client.post(reverse('join_event', args=[event.id]))
+        self.client.post(reverse('withdraw_event', args=[event.id]))
+        self.assertEqual([
+            {'type': 'attendance', 'id': event.id, 'attendees': 1},
+            {'type': 'attendance', 'id': event.id, 'attendees': 0},
+        ], self._get_changes())
+
+    def test_seat_changes(self):
+        """Check the seat scripts publish the attendees they change"""
+        self.event_data = {
+            'title': 'title', 'description': 'desc',
+            'date': '07/30/2020 19:30', 'capacity': 1,
+        }
+        self.client.post(reverse('create_event'), self.event_data)
+        event = Event.objects.get()
+        self._get_changes()
+        self.client.post(reverse('join_event', args=[event.id]))
+        self._log_in_as_another_user()
+        # only joining the waitlist does not change the attendees
+        self.client.post(reverse('join_event', args=[event.id]))
+        self.assertEqual(1, len(self._get_changes()))
+        self.client.logout()
+        self.client.login(username='user', password='p')
+        self.client.post(reverse('withdraw_event', args=[event.id]))
+        # the seat went to the waitlist
+        self.assertEqual([
+            {'type': 'attendance', 'id': event.id, 'attendees': 1},
+        ], self._get_changes())
+
+    def test_slow_stream_closed(self):
+        """Check streams which fall behind are closed"""
+        broadcaster = broadcast._Broadcaster()
+        broadcaster._task = 'listening'
+        with override_settings(EVENTS_STREAM_QUEUE_SIZE=2):
+            queue = broadcaster.subscribe()
+        for i in range(3):
+            broadcaster._send(str(i))
+        self.assertIsNone(queue.get_nowait())
+        self.assertEqual(set(), broadcaster._queues)
+
+
+class AsyncViewsTest(LoggedInTest):
+    """Coroutine views served by the ASGI profile"""
+
+    def _request(self, path):
+        request = AsyncRequestFactory().get(path)
+        request.session = self.client.session
+        return request
+
+    async def test_all_events(self):
+        """Check the event list is read from the cache"""
+        await sync_to_async(self._create_event)()
+        with mock.patch('events_users.views._get_events_page_from_db') as db:
+            response = await async_views.all_events(self._request('/'))
+            db.assert_not_called()
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'title', response.content)
+
+    async def test_all_events_fallback(self):
+        """Check Postgres is queried when the cache cannot be used"""
+        await sync_to_async(self._create_event)()
+        with mock.patch('events_users.cache.get_async_client') as client:
+            client.side_effect = redis.ConnectionError('oh no')
+            response = await async_views.all_events(self._request('/'))
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'title', response.content)
+
+    async def test_join_withdraw(self):
+        """Check attendance is kept in Postgres and the attendee sets"""
+        _, event = await sync_to_async(self._create_event)()
+        client = cache.get_async_client()
+        key = event_cache.attendees_key(event.id)
+        response = await async_views.join_event(
+            self._request('/'), event.id
+        )
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, await event.users.acount())
+        self.assertEqual({str(self.user.id).encode()},
+                         await client.smembers(key))
+        await async_views.withdraw_event(self._request('/'), event.id)
+        self.assertEqual(0, await event.users.acount())
+        self.assertEqual(set(), await client.smembers(key))
+
+    async def test_join_404(self):
+        """Check joining a non-existing event won't work"""
+        with self.assertRaises(Http404):
+            await async_views.join_event(self._request('/'), 9001)
+
+    def test_fallback_reports_to_breaker(self):
+        """Check the fallback reports the Redis failures of coordinating
+        its queries, so they add up to open the circuit breaker.
+        """
+        self._create_event()
+        breaker = cache.CircuitBreaker(2, 30)
+        with mock.patch('events_users.cache.breaker', breaker), \
+                self._redis_down():
+            for _ in range(2):
+                page, _ = async_views._get_events_from_db(
+                    None, 10, self.user.id, True, None, None
+                )
+                self.assertEqual(
+                    ['title'], [e['fields']['title'] for e in page]
+                )
+        self.assertEqual(cache.CircuitBreaker.OPEN, breaker.state)
+
+    async def test_login_required(self):
+        """Check anonymous users are sent to the login page"""
+        request = AsyncRequestFactory().get('/events/all')
+        request.session = SessionStore()
+        response = await async_views.all_events(request)
+        self.assertEqual(302, response.status_code)
+        self.assertIn('next=/events/all', response.url)
+
+    async def test_event_stream(self):
+        """Check changes are streamed as server-sent events"""
+        response = await async_views.event_stream(self._request('/'))
+        self.assertEqual('text/event-stream', response['Content-Type'])
+        content = response.streaming_content
+        self.assertEqual(b'retry: 3000\n\n', await anext(content))
+        change = dumps({'type': 'attendance', 'id': 1, 'attendees': 2})
+        client = cache.get_async_client()
+        # the listener subscribes in the background
+        for _ in range(50):
+            (_, subscribers), = await client.pubsub_numsub(
+                event_cache.CHANGES_CHANNEL
+            )
+            if subscribers:
+                break
+            await asyncio.sleep(0.02)
+        await client.publish(event_cache.CHANGES_CHANNEL, change)
+        self.assertEqual(
+            'data: {}\n\n'.format(change).encode(), await anext(content)
+        )
+        await content.aclose()
+        broadcast._broadcasters[asyncio.get_running_loop()]._task.cancel()
+
+
+@override_settings(EVENTS_RATE_LIMITS={
+    'join_event': (2, 60), 'bulk_attendance': (1, 60),
+    'create_event': (1, 60), 'sign_up': (1, 60)
+})
+class RateLimitTest(LoggedInTest):
+    def _join(self, event):
+        return self.client.get(reverse('join_event', args=[event.id]))
+
+    def test_join_limited(self):
+        """Check each user is limited on their own, and told when to
+        retry.
+        """
+        _, event = self._create_event()
+        self.assertEqual(302, self._join(event).status_code)
+        self.assertEqual(302, self._join(event).status_code)
+        response = self._join(event)
+        self.assertEqual(429, response.status_code)
+        self.assertEqual('30', response['Retry-After'])
+        self._log_in_as_another_user()
+        self.assertEqual(302, self._join(event).status_code)
+
+    def test_bulk_attendance_limited(self):
+        """Check bulk attendance changes are limited and shed as well"""
+        _, event = self._create_event()
+        url = reverse('bulk_attendance')
+        data = {'action': 'join', 'event': [event.id]}
+        self.assertEqual(200, self.client.post(url, data).status_code)
+        self.assertEqual(429, self.client.post(url, data).status_code)
+        self._log_in_as_another_user()
+        ratelimit.db_latency.clear()
+        ratelimit.db_latency.observe(10)
+        with override_settings(EVENTS_SHED_DB_LATENCY=1):
+            self.assertEqual(503, self.client.post(url, data).status_code)
+
+    def test_only_listed_views(self):
+        """Check views left out of the limits are not limited"""
+        _, event = self._create_event()
+        for _ in range(3):
+            response = self.client.get(
+                reverse('withdraw_event', args=[event.id])
+            )
+            self.assertEqual(302, response.status_code)
+
+    def test_sign_up_posts_only(self):
+        """Check the sign up form can be shown while posting it is
+        limited.
+        """
+        client = Client()
+        for _ in range(2):
+            self.assertEqual(200, client.get(reverse('sign_up')).status_code)
+        self.assertEqual(200, client.post(reverse('sign_up')).status_code)
+        self.assertEqual(429, client.post(reverse('sign_up')).status_code)
+
+    def test_redis_unavailable(self):
+        """Check each process limits requests on its own without Redis"""
+        _, event = self._create_event()
+        breaker = cache.CircuitBreaker(1, 30)
+        breaker.record_failure()
+        with mock.patch('events_users.cache.breaker', breaker):
+            self.assertEqual(302, self._join(event).status_code)
+            self.assertEqual(302, self._join(event).status_code)
+            self.assertEqual(429, self._join(event).status_code)
+
+    def test_refill(self):
+        """Check tokens come back over time and old buckets are dropped"""
+        buckets = ratelimit._LocalBuckets(2)
+        self.assertEqual(0, buckets.take('a', 1, 10, 0))
+        self.assertEqual(9, buckets.take('a', 1, 10, 1))
+        self.assertEqual(0, buckets.take('a', 1, 10, 11))
+        buckets.take('b', 1, 10, 11)
+        buckets.take('c', 1, 10, 11)
+        self.assertEqual(0, buckets.take('a', 1, 10, 11))
+
+    @override_settings(EVENTS_SHED_DB_LATENCY=0.1)
+    def test_shed(self):
+        """Check writes are shed while Postgres is slow, and only then"""
+        ratelimit.db_latency.clear()
+        ratelimit.db_latency.observe(1)
+        response = self.client.post(reverse('create_event'), {})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('5', response['Retry-After'])
+        with override_settings(EVENTS_SHED_WINDOW=0):
+            self.assertEqual(0, ratelimit.db_latency.get())
+            response, _ = self._create_event()
+        self.assertEqual(302, response.status_code)
+
+    async def test_async_join_limited(self):
+        """Check the coroutine views are limited as well"""
+        _, event = await sync_to_async(self._create_event)()
+        for status_code in (302, 302, 429):
+            request = AsyncRequestFactory().get('/')
+            request.session = await sync_to_async(
+                lambda: self.client.session
+            )()
+            response = await async_views.join_event(request, event.id)
+            self.assertEqual(status_code, response.status_code)
@@ -1,12 +1,29 @@
+from django.conf import settings
 from django.urls import path
-from events_users import views
+from events_users import views, async_views
 
 
+# the ASGI profile serves the hottest views as coroutines
+event_views = async_views if settings.EVENTS_ASYNC_VIEWS else views
+
 urlpatterns = [
-    path('all', views.all_events, name='home'),
+    path('all', event_views.all_events, name='home'),
+    path('mine', views.user_events, name='user_events'),
     path('', views.EventView.as_view(), name='create_event'),
     path('<int:event_id>/', views.EventEditView.as_view(), name='edit_event'),
-    path('<int:event_id>/join', views.join_event, name='join_event'),
+    path('<int:event_id>/join', event_views.join_event, name='join_event'),
     path('<int:event_id>/withdraw',
-         views.withdraw_event, name='withdraw_event'),
+         event_views.withdraw_event, name='withdraw_event'),
+    path('cache/status', views.cache_status, name='cache_status'),
+    path('api/events', views.api_events, name='api_events'),
+    path('export', views.export_events, name='export_events'),
+    path('api/search', views.api_search, name='api_search'),
+    path('api/mine', views.api_user_events, name='api_user_events'),
+    path('api/attendance', views.bulk_attendance, name='bulk_attendance'),
 ]
+if settings.EVENTS_ASYNC_VIEWS:
+    # streams are only served as coroutines, as a thread per browser
+    # would not scale
+    urlpatterns.append(
+        path('stream', async_views.event_stream, name='event_stream')
+    )
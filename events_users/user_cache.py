@@ -0,0 +1,108 @@
+"""Authentication backend caching the users of authenticated requests.
+
+Django loads the user of every authenticated request from Postgres. The
+backend below keeps each user loaded that way in Redis for
+EVENTS_USER_CACHE_TTL seconds, including its password hash, which the
+session checks. Users are dropped from Redis whenever they are saved or
+deleted, and those changes which cannot reach Redis show up once the
+entry expires.
+
+Enable it with AUTHENTICATION_BACKENDS = [
+'events_users.user_cache.CachedModelBackend'].
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+from events_users import cache
+from json import dumps, loads
+import datetime
+import logging
+import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+def user_key(user_id):
+    return 'user:{}:auth'.format(user_id)
+
+
+class _Encoder(DjangoJSONEncoder):
+    def default(self, o):
+        # keep the microseconds DjangoJSONEncoder drops
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def _encode(user):
+    return dumps({
+        field.attname: getattr(user, field.attname)
+        for field in user._meta.concrete_fields
+    }, cls=_Encoder)
+
+
+def _decode(model, data):
+    """User model instance, None if its fields changed since it was
+    cached.
+    """
+    values = loads(data)
+    fields = model._meta.concrete_fields
+    if set(values) != {field.attname for field in fields}:
+        return None
+    return model.from_db(
+        DEFAULT_DB_ALIAS,
+        [field.attname for field in fields],
+        [field.to_python(values[field.attname]) for field in fields],
+    )
+
+
+def invalidate_user(user_id):
+    """Drop a user from the cache"""
+    try:
+        with cache.tracked():
+            cache.get_client().delete(user_key(user_id))
+    except (cache.CacheUnavailable, redis.RedisError):
+        logger.warning('Could not remove user %s from the cache', user_id)
+
+
+def _invalidate_saved_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        user = self._get_cached_user(user_id)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                self._cache_user(user)
+            return user
+        return user if self.user_can_authenticate(user) else None
+
+    def _get_cached_user(self, user_id):
+        try:
+            with cache.tracked():
+                data = cache.get_client().get(user_key(user_id))
+        except (cache.CacheUnavailable, redis.RedisError):
+            return None
+        if data is None:
+            return None
+        return _decode(get_user_model(), data)
+
+    def _cache_user(self, user):
+        try:
+            with cache.tracked():
+                cache.get_client().set(
+                    user_key(user.pk), _encode(user),
+                    ex=settings.EVENTS_USER_CACHE_TTL
+                )
+        except (cache.CacheUnavailable, redis.RedisError):
+            logger.warning('Could not cache user %s', user.pk)
+
+
+post_save.connect(_invalidate_saved_user, sender=settings.AUTH_USER_MODEL)
+post_delete.connect(_invalidate_saved_user, sender=settings.AUTH_USER_MODEL)
@@ -1,14 +1,37 @@
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db.models import Count, Q
 from django.shortcuts import render, redirect, get_object_or_404
-from django.core import serializers
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import (
+    condition, require_POST, require_safe
+)
+from django.urls import reverse
 from django.views import View
-from django.http import HttpResponseForbidden
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+    JsonResponse, StreamingHttpResponse
+)
+from django.template.loader import render_to_string
 from events_users.event_form import EventForm
 from events_users.user_creation_form import UserCreationFormWithEmail
-from events_users.models import Event
-from json import loads, dumps
+from events_users.models import Event, WaitlistEntry
+from events_users import (
+    cache, db_router, event_cache, event_codec, fragments, metrics,
+    ratelimit, search, seats, singleflight
+)
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from json import dumps
+from itertools import islice
+import csv
+import hashlib
+import logging
+import math
 import redis
 
 
@@ -21,6 +44,7 @@ class EventView(View):
         context['form'] = form
         return render(request,'event/create_event.html', context)
 
+    @method_decorator(ratelimit.rate_limit('create_event'))
     def post(self, request):
         """Send form to create an event"""
         context = {}
@@ -36,7 +60,7 @@ class EventView(View):
 class EventEditView(View):
     def get(self, request, event_id):
         """Render form to edit an event"""
-        obj = get_object_or_404(Event, pk=event_id)
+        obj = get_object_or_404(Event, pk=event_id, is_archived=False)
         if request.user.id != obj.creator.id:
             return HttpResponseForbidden()
         form = EventForm(request.POST or None, instance=obj)
@@ -45,56 +69,676 @@ class EventEditView(View):
 
     def post(self, request, event_id):
         """Send form to edit an event"""
-        obj = get_object_or_404(Event, pk=event_id)
+        obj = get_object_or_404(Event, pk=event_id, is_archived=False)
         if request.user.id != obj.creator.id:
             return HttpResponseForbidden()
         form = EventForm(request.POST or None, instance=obj)
         if form.is_valid():
             _update_form_in_model(request, form, set_creator=True)
+            if 'capacity' in form.changed_data:
+                # seats may have been added for the waitlist
+                seats.withdraw(obj.pk)
             return redirect('home')
         context = {'form': form}
         return render(request,'event/create_event.html', context)
 
 
-def _get_redis_client():
-    return redis.Redis(host='cache', port=6379, db=1)
+logger = logging.getLogger(__name__)
+# windows of the event list, besides all the live events
+WINDOWS = ('upcoming', 'next30', 'past')
+# lists of events of the logged user
+USER_LISTS = ('attending', 'created')
 
 
-def _get_all_events():
-    """Fetch all the events and sort them accordingly.
+_get_redis_client = event_cache.get_client
+
+
+def _busy_response():
+    logger.warning('Postgres is busy computing a page, answering 503')
+    response = HttpResponse(
+        'Service unavailable', status=503, content_type='text/plain'
+    )
+    response['Retry-After'] = str(
+        max(1, math.ceil(settings.EVENTS_FALLBACK_WAIT))
+    )
+    return response
+
+
+def _unavailable_while_busy(view):
+    """Answer 503 when a page read from Postgres by another request is
+    not ready in time, instead of querying it too.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            try:
+                return await view(request, *args, **kwargs)
+            except singleflight.Busy:
+                return _busy_response()
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except singleflight.Busy:
+            return _busy_response()
+    return wrapper
+
+
+def _window_bounds(window):
+    """Dates between which the live events of a window of the list are.
+
+    :param window: upcoming, next30 or None for all the live events.
+    :return: (start, end) tuple, where None means unbounded.
+    """
+    if window is None:
+        return None, None
+    # rounded so pages of a window can be kept in memory for a while
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    if window == 'next30':
+        return now, now + timedelta(days=30)
+    return now, None
+
+
+def _page_from_rows(events, limit):
+    """Build a page of event dictionaries out of limit + 1 rows"""
+    events = list(events[:limit + 1])
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = event_cache.encode_cursor(
+            event_cache.event_score(events[-1].date), events[-1].pk
+        )
+    return _to_dicts(events), next_cursor
+
+
+def _to_dicts(events):
+    """Event dictionaries of models annotated with their attendees"""
+    page = []
+    for obj in events:
+        obj_dict = event_codec.to_dict(obj, obj.creator.email.split('@')[0])
+        obj_dict['fields']['attendees'] = obj.attendees
+        page.append(obj_dict)
+    return page
+
+
+def _filter_after(events, after):
+    """Events sorted after the cursor of the previous page"""
+    if after is None:
+        return events
+    date = event_cache.score_date(after[0])
+    return events.filter(Q(date__gt=date) | Q(date=date, pk__gt=after[1]))
+
+
+def _get_events_page_from_db(after, limit, start=None, end=None):
+    """Get a page of live events from Postgres, sorted like the Redis
+    index.
+
+    Sorting, pagination and attendee counts are all done in SQL, so a
+    page costs a single query no matter how many events or attendees
+    there are.
+    """
+    events = Event.objects.select_related('creator') \
+        .filter(is_archived=False) \
+        .annotate(attendees=Count('users')).order_by('date', 'pk')
+    if start is not None:
+        events = events.filter(date__gte=start)
+    if end is not None:
+        events = events.filter(date__lte=end)
+    return _page_from_rows(_filter_after(events, after), limit)
+
+
+def _get_user_list_page_from_db(user, user_list, after, limit):
+    """Get a page of the live events a user attends or created, closer
+    events first.
+
+    :param user_list: one of USER_LISTS.
+    """
+    if user_list == 'attending':
+        # filtered with a subquery so all the attendees of each event are
+        # counted, not only the user
+        events = Event.objects.filter(
+            pk__in=user.event_attendees.values('pk')
+        )
+    else:
+        events = user.creator.all()
+    events = events.select_related('creator').filter(is_archived=False) \
+        .annotate(attendees=Count('users')).order_by('date', 'pk')
+    page, next_cursor = _page_from_rows(_filter_after(events, after), limit)
+    return _with_joined_flag(page, user.id), next_cursor
+
+
+def _get_past_events_page_from_db(after, limit):
+    """Get a page of past events from Postgres, latest first"""
+    events = Event.objects.select_related('creator') \
+        .filter(date__lt=datetime.now(timezone.utc)) \
+        .annotate(attendees=Count('users')).order_by('-date', '-pk')
+    if after is not None:
+        date = event_cache.score_date(after[0])
+        events = events.filter(
+            Q(date__lt=date) | Q(date=date, pk__lt=after[1])
+        )
+    return _page_from_rows(events, limit)
+
+
+def _with_joined_flag(page, user_id):
+    """Flag the events of a page the user joined or is waiting for"""
+    joined = _get_joined_event_ids(user_id, [e['pk'] for e in page])
+    # only capacity-limited events have a waitlist
+    limited = [
+        e['pk'] for e in page if e['fields'].get('capacity') is not None
+    ]
+    waitlisted = set()
+    if limited:
+        waitlisted = set(WaitlistEntry.objects.filter(
+            user_id=user_id, event_id__in=limited
+        ).values_list('event_id', flat=True))
+    return event_cache.flag_events(page, joined, waitlisted)
+
+
+def _get_shared_events_page_from_db(client, after, limit, user_id,
+                                    start=None, end=None):
+    """Get a page of events from Postgres, coalescing concurrent requests.
+
+    The page is computed by a single request at a time and shared with
+    the rest, only the joined flag is computed for each user.
+
+    :param client: Redis client used to coordinate the requests of all
+    the processes, None if Redis is not available.
+    """
+    key = 'events:fallback:{}:{}:{}:{}'.format(
+        event_cache.encode_cursor(*after) if after else '', limit,
+        event_cache.event_score(start) if start else '',
+        event_cache.event_score(end) if end else '',
+    )
+    page, next_cursor = singleflight.get(
+        client, key,
+        lambda: _get_events_page_from_db(after, limit, start, end),
+        settings.EVENTS_FALLBACK_FRESH_FOR,
+        settings.EVENTS_FALLBACK_STALE_FOR,
+        settings.EVENTS_FALLBACK_WAIT,
+        settings.EVENTS_FALLBACK_LOCK_TTL,
+    )
+    return _with_joined_flag(page, user_id), next_cursor
+
+
+def _get_past_events(user_id, after, limit):
+    """Fetch a page of past events, latest first.
+
+    Past events are not in the event cache. Pages of them are kept in a
+    separate cold cache in Redis for EVENTS_ARCHIVE_CACHE_TTL seconds,
+    which is shared by all the processes.
+    """
+    try:
+        client = cache.get_client()
+    except cache.CacheUnavailable:
+        client = None
+    key = 'events:archive:{}:{}'.format(
+        event_cache.encode_cursor(*after) if after else '', limit
+    )
+    page, next_cursor = singleflight.get(
+        client, key, lambda: _get_past_events_page_from_db(after, limit),
+        settings.EVENTS_ARCHIVE_CACHE_TTL,
+        settings.EVENTS_ARCHIVE_CACHE_TTL,
+        settings.EVENTS_FALLBACK_WAIT,
+        settings.EVENTS_FALLBACK_LOCK_TTL,
+    )
+    return _with_joined_flag(page, user_id), next_cursor
+
+
+def _get_joined_event_ids(user_id, pks):
+    """Ids of the events in the list the user joined, in a single query"""
+    rows = Event.users.through.objects.filter(
+        user_id=user_id, event_id__in=pks
+    )
+    return set(rows.values_list('event_id', flat=True))
+
+
+def _get_all_events(user_id, after=None, limit=None, window=None):
+    """Fetch a page of events, closer events first.
 
     Will try to get data from Redis first, and fallback to Postgres
-    if anything fails.
+    if anything fails or the cache cannot be trusted. Concurrent
+    requests for the same page then only query Postgres once.
+
+    :param user_id: id of the user the joined flag of events refers to.
+    :param after: (score, pk) tuple of the last event in the previous
+    page, None to get the first page.
+    :param limit: maximum number of events in the page.
+    :param window: one of WINDOWS, None for all the live events.
+    :return: tuple with the list of events and the cursor of the next
+    page, which is None if there are no more events.
     """
+    if limit is None:
+        limit = settings.EVENTS_PAGE_SIZE
+    if window == 'past':
+        with metrics.stage_duration.time(stage='past'):
+            return _get_past_events(user_id, after, limit)
+    start, end = _window_bounds(window)
+    client = None
     try:
-        client = _get_redis_client()
-        events = client.hgetall('events')
-        events = [loads(e.decode()) for e in events.values()]
-        # will sort closer events first
-        return sorted(events, key=lambda event: event['fields']['date'])
+        with cache.tracked(), metrics.stage_duration.time(stage='redis'):
+            client = _get_redis_client()
+            page = event_cache.get_page(
+                client, after, limit, user_id, start, end
+            )
+        metrics.cache_lookups.inc(result='hit')
+        return page
+    except event_cache.StaleCache:
+        # Redis works, so it can still coordinate the fallback
+        metrics.cache_lookups.inc(result='miss')
     except Exception:
         # fallback to Postgres
-        events = Event.objects.all().select_related('creator')
-        obj_list = loads(serializers.serialize('json', events))
-        for obj_dict, obj in zip(obj_list, events):
-            obj_dict['fields']['creator_name'] = \
-                obj.creator.email.split('@')[0]
-        return sorted(obj_list, key=lambda event: event['fields']['date'])
+        metrics.cache_lookups.inc(result='error')
+        client = None
+    with metrics.stage_duration.time(stage='db_fallback'):
+        return _get_shared_events_page_from_db(
+            client, after, limit, user_id, start, end
+        )
+
+
+def _get_user_list(user, user_list, after, limit):
+    """Fetch a page of the events a user attends or created.
+
+    Pages are computed from Postgres and kept in Redis for
+    EVENTS_USER_LISTS_CACHE_TTL seconds, or until the user joins or
+    withdraws from an event, or one of their events is edited or
+    archived. The number of attendees may lag behind until then.
+
+    :return: tuple with the list of events and the cursor of the next
+    page.
+    """
+    field = '{}:{}:{}'.format(
+        user_list, event_cache.encode_cursor(*after) if after else '', limit
+    )
+    client = None
+    try:
+        with cache.tracked():
+            client = _get_redis_client()
+            page, version = event_cache.get_user_list_page(
+                client, user.id, field
+            )
+        if page is not None:
+            metrics.cache_lookups.inc(result='hit')
+            return page
+        metrics.cache_lookups.inc(result='miss')
+    except event_cache.StaleCache:
+        metrics.cache_lookups.inc(result='miss')
+        client = None
+    except Exception:
+        metrics.cache_lookups.inc(result='error')
+        client = None
+    page = _get_user_list_page_from_db(user, user_list, after, limit)
+    if client is not None:
+        try:
+            with cache.tracked():
+                event_cache.cache_user_list_page(
+                    client, user.id, field, version, page
+                )
+        except (cache.CacheUnavailable, redis.RedisError):
+            pass
+    return page
+
+
+def _invalidate_user_lists(user_ids):
+    """Drop the cached lists of events of some users after a change in
+    Postgres.
+    """
+    try:
+        with cache.tracked():
+            event_cache.invalidate_user_lists(_get_redis_client(), user_ids)
+    except (cache.CacheUnavailable, redis.RedisError):
+        logger.warning('Could not invalidate lists of %s users',
+                       len(user_ids))
+        event_cache.invalidate_later()
+
+
+def _get_user_list_name(request):
+    user_list = request.GET.get('list')
+    return user_list if user_list in USER_LISTS else USER_LISTS[0]
 
 
 @login_required
-def all_events(request):
-    """Render page with all the events."""
-    events_as_dict = _get_all_events()
-    for event in events_as_dict:
-        if request.user.id in event['fields']['users']:
-            event['fields']['joined'] = True
-        else:
-            event['fields']['joined'] = False
-    context = {"events": events_as_dict, "user": request.user}
+def user_events(request):
+    """Render a page of the events the logged user attends or created"""
+    user_list = _get_user_list_name(request)
+    events_as_dict, next_cursor = _get_user_list(
+        request.user, user_list,
+        event_cache.decode_cursor(request.GET.get('after')),
+        settings.EVENTS_PAGE_SIZE
+    )
+    context = {
+        "events": events_as_dict,
+        "user": request.user,
+        "next_cursor": next_cursor,
+        "user_list": user_list,
+    }
+    return _render_event_list(request, context)
+
+
+@login_required
+@require_safe
+def api_user_events(request):
+    """Page of the events the logged user attends or created as JSON"""
+    try:
+        limit = int(request.GET['limit'])
+        limit = max(1, min(limit, settings.EVENTS_PAGE_SIZE))
+    except (KeyError, ValueError):
+        limit = settings.EVENTS_PAGE_SIZE
+    events, next_cursor = _get_user_list(
+        request.user, _get_user_list_name(request),
+        event_cache.decode_cursor(request.GET.get('after')), limit
+    )
+    response = JsonResponse({
+        'events': [dict(e['fields'], id=e['pk']) for e in events],
+        'next': next_cursor,
+    })
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _render_event_list(request, context):
+    """Render a page of the event list out of the markup of its events,
+    which is rendered once and reused by all the users.
+    """
+    context['rows'] = fragments.render_events(
+        context['events'], request.user.id,
+        with_controls=context.get('window') != 'past'
+    )
+    if settings.EVENTS_ASYNC_VIEWS:
+        # changes are only streamed by the ASGI profile
+        context['stream_url'] = reverse('event_stream')
     return render(request, 'event/show_events.html', context)
 
 
+def _get_window(request):
+    """Window of the event list requested, None for all live events"""
+    window = request.GET.get('window')
+    return window if window in WINDOWS else None
+
+
+@login_required
+@_unavailable_while_busy
+def all_events(request):
+    """Render a page of events."""
+    after = event_cache.decode_cursor(request.GET.get('after'))
+    window = _get_window(request)
+    with metrics.stage_duration.time(stage='get_all_events'):
+        events_as_dict, next_cursor = _get_all_events(
+            request.user.id, after, window=window
+        )
+    context = {
+        "events": events_as_dict,
+        "user": request.user,
+        "next_cursor": next_cursor,
+        "window": window,
+    }
+    with metrics.stage_duration.time(stage='render'):
+        return _render_event_list(request, context)
+
+
+def _events_version(request):
+    """Version of the cached events, fetched once per request.
+
+    None if it cannot be known, in which case no conditional request
+    is answered.
+    """
+    if not hasattr(request, '_events_version'):
+        try:
+            with cache.tracked():
+                request._events_version = event_cache.get_version(
+                    _get_redis_client()
+                )
+        except Exception:
+            request._events_version = None
+    return request._events_version
+
+
+def _api_events_etag(request):
+    window = _get_window(request)
+    if window == 'past':
+        # past events are not versioned by the event cache
+        return None
+    version = _events_version(request)
+    if version is None:
+        return None
+    # the joined flag depends on the user, and the page on the query and
+    # on the time for the windows starting now
+    start, _ = _window_bounds(window)
+    tag = '{}:{}:{}:{}:{}:{}'.format(
+        version[0], version[1], request.user.id,
+        request.GET.get('after', ''), request.GET.get('limit', ''),
+        event_cache.event_score(start) if start else ''
+    )
+    return hashlib.sha1(tag.encode()).hexdigest()
+
+
+def _api_events_last_modified(request):
+    if _get_window(request) is not None:
+        # windows change with time, not only with writes
+        return None
+    version = _events_version(request)
+    if version is None or version[2] is None:
+        return None
+    return datetime.fromtimestamp(version[2], tz=timezone.utc)
+
+
+@login_required
+@require_safe
+@condition(
+    etag_func=_api_events_etag, last_modified_func=_api_events_last_modified
+)
+@_unavailable_while_busy
+def api_events(request):
+    """Page of events as JSON.
+
+    Answers conditional requests with 304 only checking the version of
+    the cache, so polling clients cost almost nothing while no event
+    changes.
+    """
+    after = event_cache.decode_cursor(request.GET.get('after'))
+    try:
+        limit = int(request.GET['limit'])
+        limit = max(1, min(limit, settings.EVENTS_PAGE_SIZE))
+    except (KeyError, ValueError):
+        limit = settings.EVENTS_PAGE_SIZE
+    events, next_cursor = _get_all_events(
+        request.user.id, after, limit, _get_window(request)
+    )
+    response = JsonResponse({
+        'events': [dict(e['fields'], id=e['pk']) for e in events],
+        'next': next_cursor,
+    })
+    # clients may keep the response, but must check it is still valid
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _search_events(user_id, query, page):
+    """Fetch a page of the live events matching a query.
+
+    Pages of results are kept in Redis, shared by all the processes, for
+    EVENTS_SEARCH_CACHE_TTL seconds, so popular queries only reach
+    Postgres once in a while.
+    """
+    try:
+        client = cache.get_client()
+    except cache.CacheUnavailable:
+        client = None
+    key = 'events:search:{}:{}'.format(
+        hashlib.sha1(query.encode()).hexdigest(), page
+    )
+    events, next_page = singleflight.get(
+        client, key,
+        lambda: search.search_page(query, page, settings.EVENTS_PAGE_SIZE),
+        settings.EVENTS_SEARCH_CACHE_TTL,
+        settings.EVENTS_SEARCH_CACHE_TTL,
+        settings.EVENTS_FALLBACK_WAIT,
+        settings.EVENTS_FALLBACK_LOCK_TTL,
+    )
+    return _with_joined_flag(events, user_id), next_page
+
+
+@login_required
+@require_safe
+@_unavailable_while_busy
+def api_search(request):
+    """Page of the live events matching a full-text query as JSON, best
+    matches first.
+
+    Expects the query in q and optionally the number of the page.
+    """
+    query = search.normalize(request.GET.get('q', ''))
+    if not query:
+        return HttpResponseBadRequest('Missing query')
+    if len(query) > settings.EVENTS_SEARCH_MAX_QUERY_LENGTH:
+        return HttpResponseBadRequest('Query too long')
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        page = 1
+    if page > settings.EVENTS_SEARCH_MAX_PAGES:
+        return HttpResponseBadRequest('Page too far')
+    events, next_page = _search_events(request.user.id, query, page)
+    if next_page and next_page > settings.EVENTS_SEARCH_MAX_PAGES:
+        next_page = None
+    response = JsonResponse({
+        'events': [dict(e['fields'], id=e['pk']) for e in events],
+        'next': next_page,
+    })
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _iter_events_from_db(user_id, after, batch_size):
+    """Batches of live events from Postgres, in date order.
+
+    Events are read through a server-side cursor, and the attendees of
+    each batch are counted on their own, so the first batch does not
+    wait for the whole table to be aggregated.
+    """
+    events = _filter_after(
+        Event.objects.select_related('creator').filter(is_archived=False)
+        .order_by('date', 'pk'), after
+    ).iterator(chunk_size=batch_size)
+    while True:
+        batch = list(islice(events, batch_size))
+        if not batch:
+            return
+        counts = dict(
+            Event.users.through.objects
+            .filter(event_id__in=[obj.pk for obj in batch])
+            .values('event_id').annotate(count=Count('user_id'))
+            .values_list('event_id', 'count')
+        )
+        for obj in batch:
+            obj.attendees = counts.get(obj.pk, 0)
+        yield _with_joined_flag(_to_dicts(batch), user_id)
+
+
+def _iter_events(user_id, batch_size):
+    """Batches of all the live events, in date order.
+
+    They are read from Redis while the cache can be trusted, and from
+    Postgres from where it stopped otherwise, so memory does not grow
+    with the number of events.
+    """
+    after = None
+    generation = None
+    try:
+        while True:
+            with cache.tracked():
+                events, next_cursor, generation = event_cache.read_events(
+                    _get_redis_client(), after, batch_size, user_id,
+                    generation
+                )
+            yield events
+            if next_cursor is None:
+                return
+            after = event_cache.decode_cursor(next_cursor)
+    except (event_cache.StaleCache, cache.CacheUnavailable,
+            redis.RedisError):
+        pass
+    yield from _iter_events_from_db(user_id, after, batch_size)
+
+
+class _Echo:
+    """File-like object returning what is written to it, for csv"""
+
+    def write(self, value):
+        return value
+
+
+# columns of the CSV export, in order
+EXPORT_COLUMNS = (
+    'id', 'title', 'description', 'date', 'creator', 'creator_name',
+    'capacity', 'attendees', 'joined', 'waitlisted',
+)
+
+
+def _stream_csv(batches):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for events in batches:
+        yield ''.join(
+            writer.writerow([
+                dict(e['fields'], id=e['pk']).get(column)
+                for column in EXPORT_COLUMNS
+            ])
+            for e in events
+        )
+
+
+def _stream_ndjson(batches):
+    for events in batches:
+        yield ''.join(
+            dumps(dict(e['fields'], id=e['pk'])) + '\n' for e in events
+        )
+
+
+def _stream_html(request, batches):
+    # the rows of each batch are streamed in place of the marker
+    marker = '<!-- events -->'
+    head, tail = render_to_string('event/show_events.html', {
+        'events': [], 'user': request.user, 'rows': mark_safe(marker),
+    }, request).split(marker)
+    yield head
+    for events in batches:
+        yield fragments.render_events(events, request.user.id)
+    yield tail
+
+
+@login_required
+@require_safe
+def export_events(request):
+    """Stream all the live events, closer events first.
+
+    Expects the format in format, which is html, ndjson (the default)
+    or csv.
+    """
+    batches = _iter_events(
+        request.user.id, settings.EVENTS_EXPORT_BATCH_SIZE
+    )
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format == 'html':
+        response = StreamingHttpResponse(_stream_html(request, batches))
+    elif export_format == 'csv':
+        response = StreamingHttpResponse(
+            _stream_csv(batches), content_type='text/csv'
+        )
+        response['Content-Disposition'] = \
+            'attachment; filename="events.csv"'
+    elif export_format == 'ndjson':
+        response = StreamingHttpResponse(
+            _stream_ndjson(batches), content_type='application/x-ndjson'
+        )
+    else:
+        return HttpResponseBadRequest('Unknown format')
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 def _update_form_in_model(request, event_form, set_creator=False):
     """Save changes in form to database.
 
@@ -114,17 +758,62 @@ def _update_model(request, obj, set_creator=False):
     """
     if set_creator:
         obj.creator = request.user
-    obj.save()
-    pk = obj.pk
-    # django serializer needs a list, so we need to do all this
-    # serializer-related back and forth
-    obj_dict = loads(serializers.serialize('json', [obj,]))[0]
-    if set_creator:
-        obj_dict['fields']['creator_name'] = request.user.email.split('@')[0]
-    client = _get_redis_client()
-    client.hset('events', pk, dumps(obj_dict))
+    with metrics.stage_duration.time(stage='update_model'):
+        obj.save()
+        fragments.invalidate(obj.pk)
+        # the event is in the lists of its creator and attendees
+        _invalidate_user_lists(
+            [obj.creator_id] + list(obj.users.values_list('pk', flat=True))
+        )
+        creator_name = obj.creator.email.split('@')[0]
+        try:
+            with cache.tracked():
+                event_cache.store_event(
+                    _get_redis_client(), obj, creator_name
+                )
+        except (cache.CacheUnavailable, redis.RedisError):
+            # the event is already in Postgres, which is the source of
+            # truth, so just make sure the cache is not trusted until it
+            # is rebuilt
+            logger.warning('Could not cache event %s', obj.pk)
+            event_cache.invalidate_later()
+
+
+def _update_attendance(obj, user, update):
+    """Apply an attendance change, already saved in DB, to the cache.
+
+    :param obj: event the user joined or withdrew from.
+    :param user: user who joined or withdrew.
+    :param update: event_cache function applying the change.
+    """
+    try:
+        with cache.tracked():
+            update(_get_redis_client(), obj.pk, user.id)
+    except (cache.CacheUnavailable, redis.RedisError):
+        logger.warning('Could not cache attendees of event %s', obj.pk)
+        event_cache.invalidate_later()
+
 
+def _record_attendance(event_id, user, join):
+    """Record an attendance change in Redis only, in write-behind mode.
 
+    :return: whether it was recorded, if not it has to be saved in DB
+    right away.
+    """
+    if not settings.EVENTS_WRITE_BEHIND_ATTENDANCE:
+        return False
+    update = event_cache.reserve_seat if join else event_cache.release_seat
+    try:
+        with cache.tracked():
+            return update(
+                _get_redis_client(), event_id, user.id, write_behind=True
+            ) is not None
+    except (event_cache.StaleCache, cache.CacheUnavailable,
+            redis.RedisError):
+        return False
+
+
+@ratelimit.rate_limit('sign_up', methods=('POST',))
 def sign_up(request):
     """Form to create a new user in the system"""
     context = {}
@@ -139,22 +828,117 @@ def sign_up(request):
 
 
 @login_required
+@db_router.use_primary
+@ratelimit.rate_limit('join_event')
 def join_event(request, event_id):
     """Add the logged user to a particular event"""
-    obj = get_object_or_404(Event, pk=event_id)
+    if _record_attendance(event_id, request.user, join=True):
+        return redirect('home')
+    obj = get_object_or_404(Event, pk=event_id, is_archived=False)
+    if obj.capacity is not None:
+        seats.join(obj.pk, request.user.id)
+        return redirect('home')
     obj.users.add(request.user)
-    _update_model(request, obj)
+    _update_attendance(obj, request.user, event_cache.add_attendee)
     return redirect('home')
 
 
 @login_required
+@db_router.use_primary
+@ratelimit.rate_limit('withdraw_event')
 def withdraw_event(request, event_id):
     """Withdraw the logged user from a particular event"""
-    obj = get_object_or_404(Event, pk=event_id)
+    if _record_attendance(event_id, request.user, join=False):
+        return redirect('home')
+    obj = get_object_or_404(Event, pk=event_id, is_archived=False)
+    if obj.capacity is not None:
+        seats.withdraw(obj.pk, request.user.id)
+        return redirect('home')
     try:
         obj.users.remove(request.user)
-        _update_model(request, obj)
+        _update_attendance(obj, request.user, event_cache.remove_attendee)
     except TypeError:
         # if the user does not exist in the array, do nothing
         pass
     return redirect('home')
+
+
+@login_required
+@require_POST
+@ratelimit.rate_limit('bulk_attendance')
+def bulk_attendance(request):
+    """Join or withdraw the logged user from many events at once.
+
+    Expects the action (join or withdraw) and any number of event ids as
+    form fields. Attendance is written in batches, each of them with a
+    single query and a single round trip to Redis. Seats of
+    capacity-limited events are reserved one by one, putting the user on
+    the waitlist of the full ones. Events which do not exist or are
+    archived are ignored.
+    """
+    action = request.POST.get('action')
+    try:
+        pks = {int(pk) for pk in request.POST.getlist('event')}
+    except ValueError:
+        return HttpResponseBadRequest('Event ids must be integers')
+    if action not in ('join', 'withdraw'):
+        return HttpResponseBadRequest('Unknown action')
+    if len(pks) > settings.EVENTS_BULK_MAX_EVENTS:
+        return HttpResponseBadRequest('Too many events')
+    events = Event.objects.filter(pk__in=pks, is_archived=False)
+    capacities = dict(events.values_list('pk', 'capacity'))
+    pks = sorted(
+        pk for pk, capacity in capacities.items() if capacity is None
+    )
+    waitlisted = []
+    for pk in sorted(set(capacities) - set(pks)):
+        if action == 'withdraw':
+            seats.withdraw(pk, request.user.id)
+        elif seats.join(pk, request.user.id) == event_cache.WAITLISTED:
+            waitlisted.append(pk)
+    batch_size = settings.EVENTS_BULK_BATCH_SIZE
+    attendance = Event.users.through.objects
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        if action == 'join':
+            attendance.bulk_create([
+                Event.users.through(event_id=pk, user_id=request.user.id)
+                for pk in batch
+            ], ignore_conflicts=True)
+        else:
+            attendance.filter(
+                user_id=request.user.id, event_id__in=batch
+            ).delete()
+    update = event_cache.add_attendees if action == 'join' \
+        else event_cache.remove_attendees
+    try:
+        with cache.tracked():
+            update(_get_redis_client(), pks, request.user.id, batch_size)
+    except (cache.CacheUnavailable, redis.RedisError):
+        logger.warning('Could not cache attendees of %s events', len(pks))
+        event_cache.invalidate_later()
+    return JsonResponse({
+        'action': action,
+        'events': sorted(set(capacities) - set(waitlisted)),
+        'waitlisted': waitlisted,
+    })
+
+
+def prometheus_metrics(request):
+    """Metrics of this process in the Prometheus text format"""
+    if not metrics.enabled():
+        raise Http404('Metrics are disabled')
+    return HttpResponse(
+        metrics.render(), content_type='text/plain; version=0.0.4'
+    )
+
+
+def cache_status(request):
+    """Report the state of the Redis circuit breaker for monitoring.
+
+    Answers with 503 while the circuit is open so it can be alerted on.
+    """
+    status = cache.breaker.status()
+    status['singleflight'] = dict(singleflight.stats)
+    code = 503 if status['state'] == cache.CircuitBreaker.OPEN else 200
+    return JsonResponse(status, status=code)